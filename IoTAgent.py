@@ -1,43 +1,103 @@
+import time
+
+# 记录进程启动时刻，用于统计冷启动耗时
+BOOT_START = time.perf_counter()
+
 import json
 import threading
-import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from getmac import get_mac_address
 
 from services.ota_service import OTAService
+from services.device_manager import (
+    CONFIG_FIELDS,
+    DeviceRecord,
+    DeviceSnapshot,
+    build_device_detail,
+    diff_devices,
+    get_device_sign,
+)
 from utils.mqtt_manager import MQTTManager
 from utils.http import HttpTool
+from utils.topic_router import TopicRouter
+from utils.common import get_mac_address
+from utils.profiler import Profiler, ProfilerBusy, compress
+from utils.heartbeat_ipc import HeartbeatServer
+from utils.health import HealthAggregator
+from utils.extract_backends import EXTRACTORS
 from utils.process_manager import kill_process, find_and_start_app
+from utils import metrics
+from utils.metrics import (
+    HEARTBEAT_LATENESS_SECONDS,
+    HEARTBEAT_TIMEOUTS_TOTAL,
+    MQTT_HANDLE_SECONDS,
+    MQTT_PUBLISH_ENQUEUE_SECONDS,
+    PROCESS_RESTARTS_TOTAL,
+)
 
 from config.constant import (
     GET_MSG_UP_TOPIC,
     GET_MSG_DOWN_TOPIC,
     GET_HEARTBEAT_TOPIC,
+    GET_HEARTBEAT_BATCH_TOPIC,
+    GET_HEALTH_TOPIC,
     DEVICE_ID,
     MQTT_BROKER,
     MQTT_TMS_BROKER,
     HTTP_BASE_URL,
-    HTTP_TMS_BASE_URL
+    HTTP_TMS_BASE_URL,
+    MQTT_WILDCARD_SUBSCRIBE,
+    METRICS_HTTP_PORT,
+    METRICS_TEXTFILE_PATH,
+    METRICS_MQTT_INTERVAL,
+    PROFILE_UPLOAD_URL,
+    PROFILE_MAX_SECONDS,
+    PROFILE_MAX_OVERHEAD,
+    PROFILE_TRACEMALLOC_TIMEOUT,
+    HEARTBEAT_IPC_ALLOWED_UIDS,
+    HEARTBEAT_IPC_SOCKET,
+    HEARTBEAT_FORWARD_INTERVAL,
+    HEARTBEAT_TIMEOUT,
+    HEALTH_MIN_INTERVAL,
+    HEALTH_MAX_INTERVAL,
+    HEALTH_RETENTION,
+    HEALTH_MAX_PROGRAMS,
+    EXTRACT_CALIBRATION,
+    EXTRACT_CALIBRATION_CACHE,
 )
 
+startup_timings = {"import": time.perf_counter() - BOOT_START}
 
 logger = logging.getLogger(__name__)
 
-# 连接mqtt
-mqtt_manager = MQTTManager(MQTT_BROKER, 1883)
-mqtt_tms_manager = MQTTManager(MQTT_TMS_BROKER, 1883)
+# mqtt连接（在start_agent中与HTTP查询并行建立）
+mqtt_manager = None
+mqtt_tms_manager = None
 # 创建HTTP工具类
 http = HttpTool(retries=3, timeout=5, base_url=HTTP_BASE_URL)
 http_tms = HttpTool(retries=3, timeout=5, base_url=HTTP_TMS_BASE_URL)
-# OTA服务类
-ota_service = OTAService(mqtt_manager)
+# OTA服务类（mqtt连接建立后创建）
+ota_service = None
+
+# 远程诊断采集（同一时间只运行一个）
+profiler = Profiler(
+    max_seconds=PROFILE_MAX_SECONDS,
+    max_overhead=PROFILE_MAX_OVERHEAD,
+    tracemalloc_timeout=PROFILE_TRACEMALLOC_TIMEOUT,
+)
 
 # 绑定的设备信息（设备id、设备运行目录、OTA升级状态）
 device_info = {}
+# 绑定设备本地快照
+device_snapshot = DeviceSnapshot()
 
 # 是否初始化订阅mqtt主题的标志
 init_subscribe_mqtt_flag = False
+# 保护设备主题订阅状态的锁
+subscribe_lock = threading.Lock()
+# 下发主题路由（主题 -> 处理函数、设备标识）
+topic_router = TopicRouter()
 
 # 当前机器人code
 robot_code = None
@@ -45,6 +105,30 @@ robot_code = None
 mqtt_heartbeat_flag = False
 # 记录所有程序心跳时间
 last_heartbeats = {}
+# 本机通道收到、待汇总转发的心跳（程序名 -> 最近心跳时间）
+ipc_heartbeats = {}
+ipc_heartbeats_lock = threading.Lock()
+
+
+def publish_health(summary):
+    """发布整机健康摘要（未获取到机器人code时通过agent上行主题发布）"""
+    if robot_code and mqtt_tms_manager:
+        mqtt_tms_manager.safe_publish(GET_HEALTH_TOPIC(robot_code), json.dumps(summary))
+    elif mqtt_manager:
+        mqtt_manager.safe_publish(
+            GET_MSG_UP_TOPIC(DEVICE_ID), json.dumps(dict(summary, type="health"))
+        )
+
+
+# 程序健康状态汇总
+health = HealthAggregator(
+    publish_health,
+    heartbeat_timeout=HEARTBEAT_TIMEOUT,
+    min_interval=HEALTH_MIN_INTERVAL,
+    max_interval=HEALTH_MAX_INTERVAL,
+    retention=HEALTH_RETENTION,
+    max_programs=HEALTH_MAX_PROGRAMS,
+)
 
 def get_robot_code():
     """获取当前机器人信息"""
@@ -60,7 +144,7 @@ def get_robot_code():
             robot_info = res.get("data").get("list")[0]
             robot_code = robot_info.get("robotCode")
             if robot_code:
-                if mqtt_tms_manager.check_connection():
+                if mqtt_tms_manager and mqtt_tms_manager.check_connection():
                     # 监听机器人运行程序心跳
                     mqtt_subscribe_heartbeat()
                     mqtt_heartbeat_flag = True
@@ -74,44 +158,83 @@ def mqtt_subscribe_heartbeat():
     global robot_code
     mqtt_tms_manager.client.subscribe(GET_HEARTBEAT_TOPIC(robot_code))
 
+def subscribe_device_topics(device_signs):
+    """注册设备主题路由并批量订阅（初始订阅完成前由mqtt_loop统一订阅）"""
+    with subscribe_lock:
+        topics = []
+        for device_sign in device_signs:
+            device_detail = device_info.get(device_sign)
+            if not device_detail or device_detail.get("isCustomDevice"):
+                continue
+            topic = GET_MSG_DOWN_TOPIC(device_sign)
+            topic_router.add(topic, handle_device_message, device_sign)
+            topics.append(topic)
+        if init_subscribe_mqtt_flag and topics and not MQTT_WILDCARD_SUBSCRIBE:
+            mqtt_manager.subscribe_many(topics)
+
+
+def unsubscribe_device_topics(device_signs):
+    """移除设备主题路由并批量取消订阅"""
+    with subscribe_lock:
+        topics = [
+            GET_MSG_DOWN_TOPIC(device_sign)
+            for device_sign in device_signs
+            if topic_router.remove(GET_MSG_DOWN_TOPIC(device_sign))
+        ]
+        if init_subscribe_mqtt_flag and topics and not MQTT_WILDCARD_SUBSCRIBE:
+            mqtt_manager.unsubscribe_many(topics)
+
+
 def get_agent_bind_devices():
-    """获取agent绑定的设备信息"""
+    """与服务端增量同步agent绑定的设备信息（基于ETag，只应用差异部分）"""
     try:
-        global init_subscribe_mqtt_flag
-        res = http.get("/api/agentDevices", params={"agentDeviceId": DEVICE_ID}).json()
-        if res and res.get("status") == 200 and res.get("data"):
-            for item in res.get("data"):
-                device_id = None
-                if item.get("isCustomDevice"):
-                    device_id = item.get("directory") + "/" + item.get("entryName")
-                else:
-                    device_id = item.get("device", {}).get("deviceId")
-                if not device_id:
-                    continue
-                device_info[device_id] = {
-                    "isCustomDevice": item.get("isCustomDevice"),
-                    "directory": item.get("directory"),
-                    "entryName": item.get("entryName"),
-                    "condaEnv": item.get("condaEnv"),
-                    "startCommand": item.get("startCommand"),
-                    "MSG_UP_TOPIC": (
-                        GET_MSG_UP_TOPIC(device_id)
-                        if not item.get("isCustomDevice")
-                        else GET_MSG_UP_TOPIC(DEVICE_ID)
-                    ),
-                    "downloading": False,
-                    "stop_flag": False,
-                    "updating": False,
-                }
-                if not item.get("isCustomDevice") and mqtt_manager.check_connection():
-                    # 订阅设备消息下发主题
-                    mqtt_manager.client.subscribe(GET_MSG_DOWN_TOPIC(device_id))
-                    init_subscribe_mqtt_flag = True
-                print(f"设备信息：{device_id}")
+        headers = {}
+        if device_snapshot.etag:
+            headers["If-None-Match"] = device_snapshot.etag
+        response = http.get(
+            "/api/agentDevices", params={"agentDeviceId": DEVICE_ID}, headers=headers
+        )
+        if response.status_code == 304:
+            logger.info("绑定设备信息未变化")
+            return
+        res = response.json()
+        if not res or res.get("status") != 200 or res.get("data") is None:
+            return
+
+        latest = {}
+        for item in res.get("data"):
+            device_sign = get_device_sign(item)
+            if device_sign:
+                latest[device_sign] = build_device_detail(item, device_sign)
+
+        added, updated, removed = diff_devices(device_info, latest)
+        for device_sign in added:
+            device_info[device_sign] = latest[device_sign]
+            print(f"设备信息：{device_sign}")
+        subscribe_device_topics(added)
+        for device_sign in updated:
+            for key in CONFIG_FIELDS:
+                device_info[device_sign][key] = latest[device_sign][key]
+            print(f"更新设备信息：{device_sign}")
+        # 升级中的设备暂不移除
+        deferred = [device_sign for device_sign in removed if device_info[device_sign].busy]
+        removed = [device_sign for device_sign in removed if device_sign not in deferred]
+        unsubscribe_device_topics(removed)
+        for device_sign in removed:
+            device_info.pop(device_sign)
+            print(f"移除设备信息：{device_sign}")
+
+        # 有暂缓移除的设备时不更新ETag，下次同步服务端返回完整列表，重新尝试移除
+        etag = None if deferred else response.headers.get("ETag")
+        device_snapshot.save(device_info, etag=etag)
+        logger.info(
+            f"绑定设备同步完成: 新增{len(added)} 更新{len(updated)} 删除{len(removed)}"
+            + (f" 暂缓删除{len(deferred)}" if deferred else "")
+        )
     except Exception as e:
         logger.error(f"获取设备信息失败: {str(e)}")
 
-def check_heartbeats(timeout = 5):
+def check_heartbeats(timeout = HEARTBEAT_TIMEOUT):
     """检查所有程序的心跳"""
     global last_heartbeats
     while True:
@@ -122,259 +245,500 @@ def check_heartbeats(timeout = 5):
         for program, beat_info in list(last_heartbeats.items()):
             if current_time - beat_info["timestamp"] > timeout:
                 logger.warning(f"程序 {program} 心跳超时")
-                programs_to_restart.append(beat_info["reload_command"])
+                HEARTBEAT_TIMEOUTS_TOTAL.inc()
+                health.program_timeout(program)
+                programs_to_restart.append((program, beat_info.get("reload_command")))
                 # 移除超时的程序，避免重复重启
                 del last_heartbeats[program]
         
-        # 重启超时的程序
-        for program_restart_command in programs_to_restart:
-           find_and_start_app(None, {"startCommand": program_restart_command})
+        # 重启超时的程序（单个程序重启失败不影响后续检查）
+        for program, program_restart_command in programs_to_restart:
+            if not program_restart_command:
+                logger.warning(f"程序 {program} 心跳未携带重启命令，跳过重启")
+                health.forget(program)
+                continue
+            try:
+                PROCESS_RESTARTS_TOTAL.inc(reason="heartbeat_timeout")
+                health.process_started(
+                    program, find_and_start_app(None, {"startCommand": program_restart_command})
+                )
+            except Exception as e:
+                logger.error(f"程序 {program} 重启失败: {str(e)}")
+                health.forget(program)
         
         time.sleep(10)  # 每10秒检查一次
 
 def on_tms_message(client, userdata, message):
-    global robot_code, last_heartbeats
+    with MQTT_HANDLE_SECONDS.time(handler="tms"):
+        handle_tms_message(message)
+
+
+def handle_tms_message(message):
+    global robot_code
     msg = message.payload.decode()
     params = json.loads(msg)
     if message.topic == GET_HEARTBEAT_TOPIC(robot_code):
         # 处理心跳
-        program_name = params.get("program")
-        timestamp = params.get("timestamp")
-        if program_name and timestamp:
-            last_heartbeats[program_name] = {
-                "timestamp": timestamp,
-                "reload_command": params.get("reload_command")
-            }
-            logger.info(f"收到来自 {program_name} 的心跳")
-
-# 消息处理
+        record_heartbeat(params)
+
+
+def record_heartbeat(params):
+    """记录程序心跳（TMS心跳主题与本机心跳通道共用）"""
+    program_name = params.get("program")
+    timestamp = params.get("timestamp")
+    if program_name and timestamp:
+        HEARTBEAT_LATENESS_SECONDS.observe(max(0.0, time.time() - timestamp))
+        last_heartbeats[program_name] = {
+            "timestamp": timestamp,
+            "reload_command": params.get("reload_command")
+        }
+        logger.info(f"收到来自 {program_name} 的心跳")
+        health.program_seen(program_name, timestamp)
+        # 蓝绿升级依据心跳判断新版本就绪
+        if ota_service:
+            ota_service.notify_heartbeat(params)
+
+
+def on_ipc_heartbeat(params):
+    """本机心跳通道收到的心跳，直接进入心跳监控并等待汇总转发"""
+    record_heartbeat(params)
+    if HEARTBEAT_FORWARD_INTERVAL and params.get("program"):
+        with ipc_heartbeats_lock:
+            ipc_heartbeats[params["program"]] = params.get("timestamp")
+
+
+def heartbeat_forward_loop():
+    """将本机心跳按固定间隔汇总为一条消息转发到TMS broker"""
+    while True:
+        time.sleep(HEARTBEAT_FORWARD_INTERVAL)
+        with ipc_heartbeats_lock:
+            programs = dict(ipc_heartbeats)
+            ipc_heartbeats.clear()
+        if not programs or not robot_code:
+            continue
+        try:
+            mqtt_tms_manager.safe_publish(
+                GET_HEARTBEAT_BATCH_TOPIC(robot_code),
+                json.dumps(
+                    {
+                        "robotCode": robot_code,
+                        "programs": programs,
+                        "timestamp": time.time(),
+                    }
+                ),
+            )
+        except Exception as e:
+            logger.error(f"心跳汇总转发失败: {str(e)}")
+
+# 消息处理耗时指标按消息类型分组，类型来自远程消息，只使用已知类型作为标签值
+MESSAGE_TYPES = frozenset(
+    (
+        "OTA",
+        "groupOTA",
+        "profile",
+        "extractBackends",
+        "otaTraces",
+        "agentDeviceAdd",
+        "agentDeviceUpdate",
+        "agentDeviceDelete",
+        "restart",
+    )
+)
+
+
 def on_message(client, userdata, message):
+    routes = topic_router.match(message.topic)
+    if not routes:
+        # 通配符订阅时未绑定设备的消息直接忽略
+        return
     msg = message.payload.decode()
     params = json.loads(msg)
     # print(f"Received message: {msg}")
-    device_id = message.topic.split("/")[2]
-    if device_id in device_info or device_id == DEVICE_ID:
-        print("Received msg down:", msg)
-        # 消息下发逻辑处理
-        if params.get("type") == "OTA":
-            # OTA升级逻辑
-            # 获取对应设备信息
-            device_detail = device_info.get(device_id)
-            if device_id == DEVICE_ID:
-                # 处理本机设备id(自定义设备OTA升级)
-                _device_sign = params.get("processPath") + "/" + params.get("entry")
-                if _device_sign in device_info:
-                    device_detail = device_info.get(_device_sign)
-                else:
-                    device_detail = {
-                        "isCustomDevice": True,
-                        "directory": params.get("processPath"),
-                        "entryName": params.get("entry"),
-                        "condaEnv": params.get("condaEnv"),
-                        "startCommand": params.get("startCommand"),
-                        "MSG_UP_TOPIC": GET_MSG_UP_TOPIC(DEVICE_ID),
-                        "downloading": False,
-                        "stop_flag": False,
-                        "updating": False,
+    message_type = params.get("type")
+    if not isinstance(message_type, str) or message_type not in MESSAGE_TYPES:
+        message_type = "other"
+    with MQTT_HANDLE_SECONDS.time(handler=message_type):
+        for handler, device_id in routes:
+            handler(device_id, params, msg)
+
+
+def handle_device_message(device_id, params, msg):
+    """处理设备消息下发（device_id由主题路由解析）"""
+    print("Received msg down:", msg)
+    # 消息下发逻辑处理
+    if params.get("type") == "OTA":
+        # OTA升级逻辑
+        # 获取对应设备信息
+        device_detail = device_info.get(device_id)
+        if device_id == DEVICE_ID:
+            # 处理本机设备id(自定义设备OTA升级)
+            _device_sign = params.get("processPath") + "/" + params.get("entry")
+            if _device_sign in device_info:
+                device_detail = device_info.get(_device_sign)
+            else:
+                device_detail = DeviceRecord(
+                    isCustomDevice=True,
+                    directory=params.get("processPath"),
+                    entryName=params.get("entry"),
+                    condaEnv=params.get("condaEnv"),
+                    startCommand=params.get("startCommand"),
+                    MSG_UP_TOPIC=GET_MSG_UP_TOPIC(DEVICE_ID),
+                )
+                # 并发到达的消息只保留先创建的记录
+                device_detail = device_info.setdefault(_device_sign, device_detail)
+        elif not device_detail:
+            print("未找到设备信息")
+            mqtt_manager.safe_publish(
+                GET_MSG_DOWN_TOPIC(device_id),
+                json.dumps(
+                    {
+                        "type": "OTA",
+                        "status": "update failed",
+                        "error": "未找到设备信息",
                     }
-                    device_info[_device_sign] = device_detail
-            elif not device_detail:
-                print("未找到设备信息")
+                ),
+            )
+            return
+        if params.get("url"):
+            # 下载文件
+            ota_service.download_file(
+                params.get("url"),
+                params.get("md5"),
+                device_detail,
+                manifest=params.get("manifest"),
+            )
+        elif params.get("stop"):
+            # 停止升级
+            print("设置停止升级")
+            if not device_detail.request_stop():
+                # 没有进行中的任务，直接停止
+                mqtt_manager.safe_publish(
+                    device_detail["MSG_UP_TOPIC"],
+                    json.dumps({"type": "OTA", "status": "update stopped"}),
+                )
+        elif params.get("startUpdate"):
+            # 开始升级
+            target_path = params.get("processPath") or device_detail.get(
+                "directory"
+            )
+            if not target_path:
+                print("未找到目标路径")
                 mqtt_manager.safe_publish(
-                    GET_MSG_DOWN_TOPIC(device_id),
+                    device_detail["MSG_UP_TOPIC"],
                     json.dumps(
                         {
                             "type": "OTA",
                             "status": "update failed",
-                            "error": "未找到设备信息",
+                            "error": "未找到目标路径",
                         }
                     ),
                 )
                 return
-            if params.get("url"):
-                # 下载文件
-                ota_service.download_file(
-                    params.get("url"), params.get("md5"), device_detail
-                )
-            elif params.get("stop"):
-                # 停止升级
-                print("设置停止升级")
-                if (
-                    device_detail["updating"] == False
-                    and device_detail["downloading"] == False
-                ):
-                    # 直接停止
-                    device_detail["stop_flag"] = False
-                    mqtt_manager.safe_publish(
-                        device_detail["MSG_UP_TOPIC"],
-                        json.dumps({"type": "OTA", "status": "update stopped"}),
-                    )
-                else:
-                    device_detail["stop_flag"] = True
-            elif params.get("startUpdate"):
-                # 开始升级
-                target_path = params.get("processPath") or device_detail.get(
-                    "directory"
-                )
-                if not target_path:
-                    print("未找到目标路径")
-                    mqtt_manager.safe_publish(
-                        device_detail["MSG_UP_TOPIC"],
-                        json.dumps(
-                            {
-                                "type": "OTA",
-                                "status": "update failed",
-                                "error": "未找到目标路径",
-                            }
-                        ),
-                    )
-                    return
-                if not device_detail["updating"]:
-                    device_detail["updating"] = True
-                    # 启动独立线程处理更新，否则会阻塞mqtt消息发布
-                    threading.Thread(
-                        target=ota_service.handle_start_update,
-                        args=(
-                            params,
-                            target_path,
-                            device_detail,
-                        ),
-                        daemon=True,
-                    ).start()
-        # 绑定设备信息变更操作
-        elif "agentDevice" in params.get("type"):
-            if not params.get("deviceId"):
-                print("消息下发有误，未找到设备id")
-                return
-            _agent_device = params.get("agentDevice", {})
-            device_sign = None
-            if _agent_device.get("isCustomDevice"):
-                device_sign = (
-                    _agent_device.get("directory")
-                    + "/"
-                    + _agent_device.get("entryName")
-                )
-            else:
-                device_sign = params.get("deviceId")
-            if params.get("type") == "agentDeviceAdd":
-                # 添加绑定设备信息
-                device_info[device_sign] = {
-                    "isCustomDevice": _agent_device.get("isCustomDevice"),
-                    "directory": _agent_device.get("directory"),
-                    "entryName": _agent_device.get("entryName"),
-                    "condaEnv": _agent_device.get("condaEnv"),
-                    "startCommand": _agent_device.get("startCommand"),
-                    "MSG_UP_TOPIC": (
-                        GET_MSG_UP_TOPIC(device_sign)
-                        if not _agent_device.get("isCustomDevice")
-                        else GET_MSG_UP_TOPIC(DEVICE_ID)
+            if device_detail.begin(DeviceRecord.UPDATING):
+                # 启动独立线程处理更新，否则会阻塞mqtt消息发布
+                threading.Thread(
+                    target=ota_service.handle_start_update,
+                    args=(
+                        params,
+                        target_path,
+                        device_detail,
                     ),
-                    "downloading": False,
-                    "stop_flag": False,
-                    "updating": False,
+                    daemon=True,
+                ).start()
+    elif params.get("type") == "groupOTA":
+        # 组升级：一次下载，多个绑定设备并行升级
+        threading.Thread(
+            target=ota_service.handle_group_update,
+            args=(params, device_info, GET_MSG_UP_TOPIC(device_id)),
+            daemon=True,
+        ).start()
+    elif params.get("type") == "profile":
+        # 远程诊断采集（CPU采样、内存差异、线程栈），在独立线程中运行
+        threading.Thread(target=run_profile, args=(params,), daemon=True).start()
+    elif params.get("type") == "extractBackends":
+        # 查询解压后端选择与校准结果
+        mqtt_manager.safe_publish(
+            GET_MSG_UP_TOPIC(device_id),
+            json.dumps(
+                {"type": "extractBackends", "diagnostics": EXTRACTORS.diagnostics()}
+            ),
+        )
+    elif params.get("type") == "otaTraces":
+        # 查询最近的OTA任务耗时追踪
+        mqtt_manager.safe_publish(
+            GET_MSG_UP_TOPIC(device_id),
+            json.dumps(
+                {
+                    "type": "otaTraces",
+                    "traces": ota_service.trace_history.recent(params.get("count")),
                 }
-                print("新增绑定设备信息:", device_sign)
-                if not _agent_device.get("isCustomDevice"):
-                    # 订阅设备消息下发主题
-                    mqtt_manager.client.subscribe(GET_MSG_DOWN_TOPIC(device_sign))
+            ),
+        )
+    # 绑定设备信息变更操作
+    elif "agentDevice" in params.get("type"):
+        if not params.get("deviceId"):
+            print("消息下发有误，未找到设备id")
+            return
+        _agent_device = params.get("agentDevice", {})
+        device_sign = None
+        if _agent_device.get("isCustomDevice"):
+            device_sign = (
+                _agent_device.get("directory")
+                + "/"
+                + _agent_device.get("entryName")
+            )
+        else:
+            device_sign = params.get("deviceId")
+        if params.get("type") == "agentDeviceAdd":
+            # 添加绑定设备信息
+            device_info[device_sign] = build_device_detail(_agent_device, device_sign)
+            print("新增绑定设备信息:", device_sign)
+            if not _agent_device.get("isCustomDevice"):
+                # 订阅设备消息下发主题
+                subscribe_device_topics([device_sign])
+                print(
+                    "订阅新绑定设备消息下发主题:", GET_MSG_DOWN_TOPIC(device_sign)
+                )
+        elif params.get("type") == "agentDeviceUpdate":
+            # 更新绑定设备信息
+            device_detail = device_info.get(device_sign)
+            if not device_detail:
+                print("未找到绑定设备信息")
+            else:
+                device_detail["directory"] = _agent_device.get("directory")
+                device_detail["entryName"] = _agent_device.get("entryName")
+                device_detail["condaEnv"] = _agent_device.get("condaEnv")
+                device_detail["startCommand"] = _agent_device.get("startCommand")
+                print("更新绑定设备信息:", device_sign)
+        elif params.get("type") == "agentDeviceDelete":
+            # 删除绑定设备信息
+            device_detail = device_info.get(device_sign)
+            if not device_detail:
+                print("未找到绑定设备信息")
+            else:
+                if not device_detail.get("isCustomDevice"):
+                    # 取消订阅设备消息下发主题
+                    unsubscribe_device_topics([device_sign])
                     print(
-                        "订阅新绑定设备消息下发主题:", GET_MSG_DOWN_TOPIC(device_sign)
+                        "取消订阅绑定设备消息下发主题:",
+                        GET_MSG_DOWN_TOPIC(device_sign),
                     )
-            elif params.get("type") == "agentDeviceUpdate":
-                # 更新绑定设备信息
-                device_detail = device_info.get(device_sign)
-                if not device_detail:
-                    print("未找到绑定设备信息")
-                else:
-                    device_detail["directory"] = _agent_device.get("directory")
-                    device_detail["entryName"] = _agent_device.get("entryName")
-                    device_detail["condaEnv"] = _agent_device.get("condaEnv")
-                    device_detail["startCommand"] = _agent_device.get("startCommand")
-                    print("更新绑定设备信息:", device_sign)
-            elif params.get("type") == "agentDeviceDelete":
-                # 删除绑定设备信息
-                device_detail = device_info.get(device_sign)
-                if not device_detail:
-                    print("未找到绑定设备信息")
-                else:
-                    if not device_detail.get("isCustomDevice"):
-                        # 取消订阅设备消息下发主题
-                        mqtt_manager.client.unsubscribe(GET_MSG_DOWN_TOPIC(device_sign))
-                        print(
-                            "取消订阅绑定设备消息下发主题:",
-                            GET_MSG_DOWN_TOPIC(device_sign),
-                        )
-                    device_info.pop(device_sign)
-                    print("删除绑定设备信息:", device_sign)
-        elif params.get("type") == "restart":
-            # 终止进程
-            _detail_info = {
-                "isCustomDevice": params.get("isCustomDevice"),
-                "directory": params.get("directory"),
-                "entryName": params.get("entryName"),
-                "condaEnv": params.get("condaEnv"),
-                "startCommand": params.get("startCommand"),
-                "stop_flag": False,
-                "updating": False,
-                "downloading": False,
-            }
-            kill_process(_detail_info["entryName"])
-            print("重启设备")
-            # 重新启动进程
-            find_and_start_app(Path(params.get("directory")), _detail_info)
+                device_info.pop(device_sign)
+                print("删除绑定设备信息:", device_sign)
+        # 绑定关系变更后同步更新本地快照
+        device_snapshot.save(device_info)
+    elif params.get("type") == "restart":
+        # 终止进程
+        _detail_info = DeviceRecord(
+            isCustomDevice=params.get("isCustomDevice"),
+            directory=params.get("directory"),
+            entryName=params.get("entryName"),
+            condaEnv=params.get("condaEnv"),
+            startCommand=params.get("startCommand"),
+        )
+        kill_process(_detail_info["entryName"])
+        print("重启设备")
+        PROCESS_RESTARTS_TOTAL.inc(reason="restart_command")
+        # 重新启动进程
+        health.process_started(
+            _detail_info["entryName"],
+            find_and_start_app(Path(params.get("directory")), _detail_info),
+        )
+
+
+def run_profile(params):
+    """执行诊断采集，压缩后上传并上报结果"""
+    mode = params.get("mode", "cpu")
+    message = {"type": "profile", "mode": mode}
+    try:
+        report, info = profiler.run(
+            mode,
+            duration=params.get("duration"),
+            interval=params.get("interval"),
+            action=params.get("action"),
+            top=params.get("top"),
+        )
+        data = compress(report)
+        http.post(
+            PROFILE_UPLOAD_URL,
+            data=data,
+            params={"agentDeviceId": DEVICE_ID, "mode": mode, "requestId": params.get("requestId")},
+            headers={"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip"},
+            timeout=30,
+        )
+        message.update(status="profile uploaded", size=len(data), info=info)
+    except ProfilerBusy as e:
+        message.update(status="profile busy", error=str(e))
+    except Exception as e:
+        logger.error(f"诊断采集失败: {str(e)}")
+        message.update(status="profile failed", error=str(e))
+    mqtt_manager.safe_publish(GET_MSG_UP_TOPIC(DEVICE_ID), json.dumps(message))
+
+
+def timed_phase(name, func, *args, **kwargs):
+    """执行启动阶段并记录耗时"""
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+
+
+def report_startup_timings():
+    """输出启动耗时明细"""
+    detail = ", ".join(
+        f"{name}={duration * 1000:.0f}ms" for name, duration in startup_timings.items()
+    )
+    logger.info(f"启动耗时明细: {detail}")
+    print(f"启动耗时明细: {detail}")
+
+
+def start_metrics_exporters():
+    """按配置启动指标导出（HTTP接口、textfile）"""
+    try:
+        if METRICS_HTTP_PORT:
+            metrics.start_http_server(METRICS_HTTP_PORT)
+        if METRICS_TEXTFILE_PATH:
+            metrics.start_textfile_exporter(METRICS_TEXTFILE_PATH)
+    except OSError as e:
+        logger.error(f"指标导出启动失败: {str(e)}")
+
+
+def metrics_loop():
+    """周期性通过MQTT上报指标摘要"""
+    while True:
+        time.sleep(METRICS_MQTT_INTERVAL)
+        try:
+            mqtt_manager.safe_publish(
+                GET_MSG_UP_TOPIC(DEVICE_ID),
+                json.dumps(
+                    {
+                        "type": "metrics",
+                        "metrics": metrics.REGISTRY.summary(),
+                        "timestamp": time.time(),
+                    }
+                ),
+            )
+        except Exception as e:
+            logger.error(f"指标上报失败: {str(e)}")
+
+
+def extract_calibration_dir():
+    """解压后端在程序目录所在的文件系统上校准（取第一个存在的设备目录），没有时使用agent目录"""
+    for device_detail in list(device_info.values()):
+        directory = device_detail.get("directory")
+        if directory and Path(directory).is_dir():
+            return directory
+    return "."
+
+
+def start_agent():
+    """并行初始化：两个MQTT连接与HTTP查询同时进行，绑定设备先从本地快照恢复"""
+    global mqtt_manager, mqtt_tms_manager, ota_service
+    start_metrics_exporters()
+    device_info.update(timed_phase("device_snapshot", device_snapshot.load))
+    if EXTRACT_CALIBRATION:
+        # 校准在后台进行，完成前使用Python实现解压
+        threading.Thread(
+            target=EXTRACTORS.calibrate,
+            args=(extract_calibration_dir(), EXTRACT_CALIBRATION_CACHE),
+            daemon=True,
+        ).start()
+    subscribe_device_topics(list(device_info))
+    # 与服务端的设备同步在后台进行，不阻塞启动
+    threading.Thread(
+        target=timed_phase,
+        args=("bind_devices_sync", get_agent_bind_devices),
+        daemon=True,
+    ).start()
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="startup") as executor:
+        mqtt_future = executor.submit(
+            timed_phase, "mqtt_connect", MQTTManager, MQTT_BROKER, 1883
+        )
+        tms_future = executor.submit(
+            timed_phase, "mqtt_tms_connect", MQTTManager, MQTT_TMS_BROKER, 1883
+        )
+        robot_future = executor.submit(timed_phase, "robot_code", get_robot_code)
+        mqtt_manager = mqtt_future.result()
+        ota_service = OTAService(mqtt_manager, on_process_started=health.process_started)
+        # 恢复上次运行中断的OTA任务（可能需要重启程序，不阻塞启动）
+        threading.Thread(
+            target=ota_service.recover_jobs, args=(device_info,), daemon=True
+        ).start()
+        mqtt_tms_manager = tms_future.result()
+        robot_future.result()
+    startup_timings["init"] = time.perf_counter() - BOOT_START
 
 
 # 发送mqtt
 def mqtt_loop():
-    time.sleep(1)
+    global init_subscribe_mqtt_flag
     while True:
-        if mqtt_manager.check_connection():
-            # 订阅mqtt主题
-            mqtt_manager.client.subscribe(GET_MSG_DOWN_TOPIC(DEVICE_ID))
-            if not init_subscribe_mqtt_flag:
-                for device_id in device_info.keys():
-                    if not device_info[device_id].get("isCustomDevice"):
-                        mqtt_manager.client.subscribe(GET_MSG_DOWN_TOPIC(device_id))
+        # 收到CONNACK后立即继续，无需固定等待
+        if mqtt_manager.wait_until_connected(1) and mqtt_manager.check_connection():
+            # 订阅mqtt主题：通配符订阅或单个SUBSCRIBE报文批量订阅
+            with subscribe_lock:
+                topic_router.add(
+                    GET_MSG_DOWN_TOPIC(DEVICE_ID), handle_device_message, DEVICE_ID
+                )
+                if MQTT_WILDCARD_SUBSCRIBE:
+                    mqtt_manager.subscribe_many([GET_MSG_DOWN_TOPIC("+")])
+                else:
+                    mqtt_manager.subscribe_many(topic_router.filters())
+                init_subscribe_mqtt_flag = True
             mqtt_manager.client.on_message = on_message
+            startup_timings["serving"] = time.perf_counter() - BOOT_START
+            report_startup_timings()
             break
         else:
             print("Connection lost, reconnecting...")
-            time.sleep(1)
 
     global mqtt_heartbeat_flag
     while True:
-        if mqtt_tms_manager.check_connection():
-            if not mqtt_heartbeat_flag:
+        if mqtt_tms_manager.wait_until_connected(1) and mqtt_tms_manager.check_connection():
+            if not mqtt_heartbeat_flag and robot_code:
                 mqtt_subscribe_heartbeat()
             mqtt_tms_manager.client.on_message = on_tms_message
             break
         else:
             print("Connection lost, reconnecting...")
-            time.sleep(1)
 
     while True:
         try:
-            mqtt_manager.client.publish(
-                GET_MSG_UP_TOPIC(DEVICE_ID), json.dumps({"status": "online"})
-            )
+            with MQTT_PUBLISH_ENQUEUE_SECONDS.time(broker=mqtt_manager.host):
+                mqtt_manager.client.publish(
+                    GET_MSG_UP_TOPIC(DEVICE_ID), json.dumps({"status": "online"})
+                )
         except Exception as e:
             print(f"MQTT发送失败: {str(e)}")
         time.sleep(2)
 
 
 try:
-    get_robot_code()
-    get_agent_bind_devices()
+    start_agent()
     mqtt_thread = threading.Thread(target=mqtt_loop)
     mqtt_thread.daemon = True
     mqtt_thread.start()
     monitor_thread = threading.Thread(target=check_heartbeats)
     monitor_thread.daemon = True
     monitor_thread.start()
+    if METRICS_MQTT_INTERVAL:
+        threading.Thread(target=metrics_loop, daemon=True).start()
+    threading.Thread(target=health.run, daemon=True).start()
+    try:
+        heartbeat_server = HeartbeatServer(
+            on_ipc_heartbeat, HEARTBEAT_IPC_SOCKET, HEARTBEAT_IPC_ALLOWED_UIDS
+        ).start()
+        if HEARTBEAT_FORWARD_INTERVAL:
+            threading.Thread(target=heartbeat_forward_loop, daemon=True).start()
+    except OSError as e:
+        logger.error(f"本机心跳通道启动失败: {str(e)}")
     # 保持主线程运行
     while True:
         time.sleep(0.5)
 except KeyboardInterrupt:
-    mqtt_manager.stop()
-    mqtt_tms_manager.stop()
+    if mqtt_manager:
+        mqtt_manager.stop()
+    if mqtt_tms_manager:
+        mqtt_tms_manager.stop()
     print("程序已安全退出")
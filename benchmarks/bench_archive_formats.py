@@ -0,0 +1,151 @@
+"""
+压缩格式基准：对比zip/7z/tar/tar.gz/tar.zst的压缩率与ArchiveHandler解压速度
+
+在项目根目录运行（可用 --source 指定真实程序包目录代替生成的测试数据）：
+    python -m benchmarks.bench_archive_formats --rounds 3 --output bench_formats.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+from benchmarks.bench_ota_pipeline import PROFILES, git_revision, write_package_tree
+from utils.archive_handler import ArchiveHandler
+
+
+def tree_size(root):
+    return sum(p.stat().st_size for p in root.rglob("*") if p.is_file())
+
+
+def write_zip(tree_root, path):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for item in sorted(tree_root.rglob("*")):
+            zf.write(item, item.relative_to(tree_root.parent))
+
+
+def write_7z(tree_root, path):
+    import py7zr
+
+    with py7zr.SevenZipFile(path, "w") as z7:
+        z7.writeall(tree_root, tree_root.name)
+
+
+def write_tar(tree_root, path, mode="w"):
+    with tarfile.open(path, mode) as tf:
+        tf.add(tree_root, tree_root.name)
+
+
+def write_tar_zst(tree_root, path, level):
+    import pyzstd
+
+    # 压缩可多线程（解压仍为单线程）
+    option = {
+        pyzstd.CParameter.compressionLevel: level,
+        pyzstd.CParameter.nbWorkers: os.cpu_count() or 1,
+    }
+    with pyzstd.ZstdFile(path, "w", level_or_option=option) as zf:
+        with tarfile.open(fileobj=zf, mode="w|") as tf:
+            tf.add(tree_root, tree_root.name)
+
+
+WRITERS = {
+    "zip": (".zip", write_zip),
+    "7z": (".7z", write_7z),
+    "tar": (".tar", write_tar),
+    "tar.gz": (".tar.gz", lambda src, dst: write_tar(src, dst, "w:gz")),
+    "tar.zst-3": (".tar.zst", lambda src, dst: write_tar_zst(src, dst, 3)),
+    "tar.zst-19": (".tar.zst", lambda src, dst: write_tar_zst(src, dst, 19)),
+}
+
+
+def bench_extract(archive, work_dir, rounds):
+    """取多轮中的最好成绩"""
+    best_wall = best_cpu = None
+    for i in range(rounds):
+        target = work_dir / f"extract_{i}" / "app"
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        ArchiveHandler(archive, target).extract_archive()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+    return best_wall, best_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", help="真实程序包目录（单一顶层目录）")
+    parser.add_argument(
+        "--profiles", default=",".join(PROFILES), help="未指定--source时生成的测试包规格"
+    )
+    parser.add_argument("--formats", default=",".join(WRITERS), help="测试的格式，逗号分隔")
+    parser.add_argument("--rounds", type=int, default=3, help="每种格式的解压次数（取最好成绩）")
+    parser.add_argument("--output", help="结果JSON输出文件，默认输出到标准输出")
+    args = parser.parse_args()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.time(),
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        if args.source:
+            trees = {Path(args.source).name: Path(args.source).resolve()}
+        else:
+            trees = {
+                profile: write_package_tree(tmp / "src" / profile, "main.py", *PROFILES[profile])
+                for profile in args.profiles.split(",")
+            }
+
+        for name, tree_root in trees.items():
+            raw_bytes = tree_size(tree_root)
+            for fmt in args.formats.split(","):
+                suffix, writer = WRITERS[fmt]
+                archive = tmp / "archives" / f"{name}_{fmt}{suffix}"
+                archive.parent.mkdir(parents=True, exist_ok=True)
+                start = time.perf_counter()
+                try:
+                    writer(tree_root, archive)
+                except ImportError as e:
+                    print(f"{fmt}: 缺少依赖，跳过（{e}）", file=sys.stderr)
+                    continue
+                compress_s = time.perf_counter() - start
+
+                work_dir = tmp / "work" / f"{name}_{fmt}"
+                wall, cpu = bench_extract(archive, work_dir, args.rounds)
+                archive_bytes = archive.stat().st_size
+                result = {
+                    "package": name,
+                    "format": fmt,
+                    "raw_bytes": raw_bytes,
+                    "archive_bytes": archive_bytes,
+                    "ratio": round(raw_bytes / max(archive_bytes, 1), 3),
+                    "compress_s": round(compress_s, 3),
+                    "extract_s": round(wall, 3),
+                    "extract_cpu_s": round(cpu, 3),
+                    "extract_mb_per_s": round(raw_bytes / 1048576 / max(wall, 1e-6), 1),
+                }
+                report["results"].append(result)
+                print(f"{name}/{fmt}: {result}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(output, encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+OTA全流程基准：本地HTTP文件服务 + 进程内MQTT broker替身，
+按阶段（下载、校验、备份、解压、启动）计时，并测量完整startUpdate流程的停机时间
+
+在项目根目录运行：
+    python -m benchmarks.bench_ota_pipeline --output bench_ota.json
+结果为JSON，可在不同提交之间对比
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+from pathlib import Path
+
+from benchmarks.local_servers import InProcessBroker, LocalFileServer
+from services.device_manager import DeviceRecord
+from services.ota_service import OTAService
+from utils.archive_handler import ArchiveHandler
+from utils.downloader import SecureFileDownloader
+from utils.process_manager import find_and_start_app, kill_process
+from utils.trace import OTATrace
+
+# 测试包规格：名称 -> (文件数, 单个文件大小)
+PROFILES = {
+    "many_small_files": (2000, 4 * 1024),
+    "few_huge_files": (3, 64 * 1024 * 1024),
+}
+
+
+def write_package_tree(root, entry_name, file_count, file_size):
+    """生成单一顶层目录的程序包内容"""
+    app_dir = root / "app"
+    app_dir.mkdir(parents=True)
+    (app_dir / entry_name).write_text("import time\ntime.sleep(30)\n")
+    block = os.urandom(min(file_size, 1024 * 1024))
+    for i in range(file_count):
+        sub = app_dir / f"data{i % 20:02d}"
+        sub.mkdir(exist_ok=True)
+        with open(sub / f"file{i:05d}.bin", "wb") as f:
+            remaining = file_size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+    return app_dir
+
+
+def build_archives(tree_root, out_dir, name):
+    """生成各格式压缩包，缺少对应工具的格式跳过"""
+    archives = {}
+    zip_path = out_dir / f"{name}.zip"
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path in sorted(tree_root.rglob("*")):
+            zf.write(path, path.relative_to(tree_root.parent))
+    archives["zip"] = zip_path
+
+    try:
+        import py7zr
+
+        seven_path = out_dir / f"{name}.7z"
+        with py7zr.SevenZipFile(seven_path, "w") as z7:
+            z7.writeall(tree_root, tree_root.name)
+        archives["7z"] = seven_path
+    except ImportError:
+        print("py7zr未安装，跳过7z格式", file=sys.stderr)
+
+    if shutil.which("rar"):
+        rar_path = out_dir / f"{name}.rar"
+        subprocess.run(
+            ["rar", "a", "-r", "-idq", str(rar_path), tree_root.name],
+            cwd=tree_root.parent,
+            check=True,
+        )
+        archives["rar"] = rar_path
+    else:
+        print("未找到rar命令，跳过rar格式", file=sys.stderr)
+    return archives
+
+
+def md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, round(time.perf_counter() - start, 4)
+
+
+def bench_phases(archive, url, work_dir, entry_name):
+    """逐阶段计时"""
+    phases = {}
+    expected_md5 = md5sum(archive)
+    downloader = SecureFileDownloader(work_dir / "downloads")
+    trace = OTATrace()
+    result, phases["download"] = timed(
+        downloader.download, url, save_name=archive.name, expected_md5=expected_md5, trace=trace
+    )
+    if result["status"] != "success":
+        raise RuntimeError(result["message"])
+    # 取下载器自身记录的校验耗时：MD5边下载边计算，已包含在download中（不重复计入），
+    # 分块清单校验在下载之后进行
+    phases["verify"] = round(
+        sum(span[2] for span in trace.spans if span[0] == "verify") / 1000, 4
+    )
+
+    target_dir = work_dir / "device" / "app"
+    ArchiveHandler(Path(result["path"]), target_dir).extract_archive()
+    ota_service = OTAService(InProcessBroker())
+    _, phases["backup"] = timed(ota_service.backup_directory, target_dir)
+    _, phases["extract"] = timed(
+        ArchiveHandler(Path(result["path"]), target_dir).extract_archive
+    )
+    device_detail = {"entryName": entry_name, "startCommand": None, "condaEnv": None}
+    process, phases["start"] = timed(find_and_start_app, target_dir, device_detail)
+    process.terminate()
+    process.wait()
+    return phases
+
+
+def bench_end_to_end(archive, url, work_dir, entry_name):
+    """完整流程：download_file_thread + handle_start_update（含预解压）"""
+    broker = InProcessBroker()
+    ota_service = OTAService(broker)
+    ota_service.downloader = SecureFileDownloader(work_dir / "downloads")
+    device_dir = work_dir / "device"
+    device_detail = DeviceRecord(
+        isCustomDevice=True,
+        directory=str(device_dir),
+        entryName=entry_name,
+        MSG_UP_TOPIC="/bench/up",
+    )
+    device_detail.begin(DeviceRecord.DOWNLOADING)
+
+    start = time.perf_counter()
+    ota_service.download_file_thread(url, md5sum(archive), device_detail)
+    download_done = time.perf_counter()
+    path = next(
+        json.loads(payload)["path"]
+        for _, _, payload in broker.messages
+        if json.loads(payload).get("status") == "download success"
+    )
+    params = {"path": path, "filename": "app", "version": "bench"}
+    device_detail.begin(DeviceRecord.UPDATING)
+    ota_service.handle_start_update(params, str(device_dir), device_detail)
+    total = time.perf_counter() - start
+    kill_process(entry_name)
+
+    final = json.loads(broker.messages[-1][2])
+    return {
+        "status": final.get("status"),
+        "error": final.get("error"),
+        "download_and_stage": round(download_done - start, 4),
+        "update": round(total - (download_done - start), 4),
+        "downtime": final.get("downtime"),
+        "total": round(total, 4),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="结果JSON输出文件，默认输出到标准输出")
+    parser.add_argument(
+        "--profiles", default=",".join(PROFILES), help="测试包规格，逗号分隔"
+    )
+    args = parser.parse_args()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.time(),
+        "results": [],
+    }
+    # 唯一的入口文件名，避免kill_process误杀其他程序
+    entry_name = f"ota_bench_{uuid.uuid4().hex[:8]}.py"
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        # OTAService会写入./version.json，切换到临时目录运行
+        os.chdir(tmp)
+        try:
+            serve_dir = tmp / "serve"
+            serve_dir.mkdir()
+            with LocalFileServer(serve_dir) as server:
+                for profile in args.profiles.split(","):
+                    file_count, file_size = PROFILES[profile]
+                    tree = write_package_tree(
+                        tmp / "src" / profile, entry_name, file_count, file_size
+                    )
+                    for fmt, archive in build_archives(tree, serve_dir, profile).items():
+                        url = server.url(archive.name)
+                        work_dir = tmp / "work" / f"{profile}_{fmt}"
+                        phases = bench_phases(archive, url, work_dir, entry_name)
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                        end_to_end = bench_end_to_end(archive, url, work_dir, entry_name)
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                        report["results"].append(
+                            {
+                                "profile": profile,
+                                "format": fmt,
+                                "archive_bytes": archive.stat().st_size,
+                                "phases": phases,
+                                "end_to_end": end_to_end,
+                            }
+                        )
+                        print(f"{profile}/{fmt}: {phases}", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(output, encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""基准测试用的本地服务"""
+
+import multiprocessing
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.topic_router import TopicRouter
+
+
+class _RangeFileHandler(SimpleHTTPRequestHandler):
+    """静态文件服务，支持单个Range请求（用于分块重新获取）"""
+
+    protocol_version = "HTTP/1.1"  # 支持keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if not range_header or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start, _, end = range_header.replace("bytes=", "").partition("-")
+        start = int(start)
+        end = min(int(end) if end else size - 1, size - 1)
+        if start > end:
+            self.send_error(416)
+            return None
+
+        f = open(path, "rb")
+        f.seek(start)
+        self._range_remaining = end - start + 1
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(self._range_remaining))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, "_range_remaining", None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        while remaining > 0:
+            data = source.read(min(1024 * 1024, remaining))
+            if not data:
+                break
+            outputfile.write(data)
+            remaining -= len(data)
+        self._range_remaining = None
+
+
+class LocalFileServer:
+    """在后台线程中运行的本地HTTP文件服务"""
+
+    def __init__(self, directory, host="127.0.0.1", port=0):
+        handler = partial(_RangeFileHandler, directory=str(directory))
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, name):
+        return f"{self.base_url}/{name}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _serve_files(directory, host, conn):
+    server = LocalFileServer(directory, host)
+    conn.send(server.httpd.server_address[1])
+    server.httpd.serve_forever()
+
+
+class LocalFileServerProcess:
+    """在独立进程中运行的本地HTTP文件服务，测量客户端CPU开销时使用（服务端CPU不计入当前进程）"""
+
+    def __init__(self, directory, host="127.0.0.1"):
+        self.directory = str(directory)
+        self.host = host
+        self.port = None
+        self.process = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def url(self, name):
+        return f"{self.base_url}/{name}"
+
+    def __enter__(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve_files, args=(self.directory, self.host, child_conn), daemon=True
+        )
+        self.process.start()
+        self.port = parent_conn.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+
+class _Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else str(payload).encode()
+
+
+class _StandInClient:
+    """模拟paho客户端中agent用到的部分接口"""
+
+    def __init__(self, broker):
+        self._broker = broker
+        self.on_message = None
+
+    def subscribe(self, topic, qos=0):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for topic_filter, _ in topics:
+            self._broker.router.add(topic_filter, self._deliver, topic_filter)
+
+    def unsubscribe(self, topic):
+        for topic_filter in topic if isinstance(topic, list) else [topic]:
+            self._broker.router.remove(topic_filter)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self._broker.publish(topic, payload)
+
+    def is_connected(self):
+        return True
+
+    def _deliver(self, message):
+        if self.on_message:
+            self.on_message(self, None, message)
+
+
+class InProcessBroker:
+    """
+    进程内MQTT broker替身
+    提供与MQTTManager相同的safe_publish/check_connection等接口，记录所有发布的消息
+    """
+
+    def __init__(self):
+        self.router = TopicRouter()
+        self.client = _StandInClient(self)
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        with self._lock:
+            self.messages.append((time.time(), topic, payload))
+        message = _Message(topic, payload)
+        for handler, _ in self.router.match(topic):
+            handler(message)
+        return True
+
+    # MQTTManager兼容接口
+    def safe_publish(self, topic, payload, **kwargs):
+        return self.publish(topic, payload)
+
+    def check_connection(self, timeout=1.0):
+        return True
+
+    def wait_until_connected(self, timeout=None):
+        return True
+
+    def subscribe_many(self, topics, qos=0):
+        self.client.subscribe([(topic, qos) for topic in topics])
+
+    def unsubscribe_many(self, topics):
+        self.client.unsubscribe(list(topics))
+
+    def stop(self):
+        pass
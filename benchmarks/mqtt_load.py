@@ -0,0 +1,399 @@
+"""
+MQTT负载生成与延迟测试：通过本地broker驱动agent，模拟N个绑定设备、OTA命令风暴和M个按R次/秒发送心跳的程序
+
+需要本地运行MQTT broker（如mosquitto，监听1883端口）。在项目根目录运行：
+    python -m benchmarks.mqtt_load --devices 200 --programs 50 --rate 1 --storm-rate 100 --duration 60
+
+默认会启动一个agent子进程（指向本地broker和本工具提供的模拟HTTP接口），
+也可以通过 --agent-pid 测量已在运行的agent
+
+心跳的处理数、延迟与超时取自agent的 /metrics（压测前后两次抓取的差值），
+反映agent实际处理的情况，而不是broker的投递情况
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+import paho.mqtt.client as mqtt
+import psutil
+
+from config.constant import (
+    DEVICE_ID,
+    GET_HEARTBEAT_TOPIC,
+    GET_MSG_DOWN_TOPIC,
+    GET_MSG_UP_TOPIC,
+)
+from utils.metrics import (
+    HEARTBEAT_LATENESS_SECONDS,
+    HEARTBEAT_TIMEOUTS_TOTAL,
+    PROCESS_RESTARTS_TOTAL,
+)
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def new_client():
+    """兼容paho 1.x/2.x的客户端创建"""
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    return mqtt.Client()
+
+
+class _ControlPlaneHandler(BaseHTTPRequestHandler):
+    """模拟控制面接口：/robot/list 返回机器人信息，/api/agentDevices 返回模拟的绑定设备"""
+
+    def __init__(self, robot_code, device_ids, *args, **kwargs):
+        self.robot_code = robot_code
+        self.device_ids = device_ids
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/robot/list":
+            body = {"code": 200, "data": {"list": [{"robotCode": self.robot_code}]}}
+        elif path == "/api/agentDevices":
+            body = {
+                "status": 200,
+                "data": [
+                    {
+                        "isCustomDevice": False,
+                        "device": {"deviceId": device_id},
+                        "directory": f"/tmp/loadsim/{device_id}",
+                        "entryName": f"{device_id}.py",
+                    }
+                    for device_id in self.device_ids
+                ],
+            }
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 2)
+
+    return {
+        "count": len(values),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": round(values[-1] * 1000, 2),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2),
+    }
+
+
+_SAMPLE_LINE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$")
+
+
+def scrape_metrics(url):
+    """抓取Prometheus文本格式指标，返回 {(名称, 标签文本): 值}"""
+    with urlopen(url, timeout=5) as response:
+        text = response.read().decode()
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE_LINE.match(line)
+        if match:
+            samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples
+
+
+def histogram_delta(before, after, name):
+    """两次抓取之间直方图各分桶（累计）计数的增量，返回 [(上界, 累计计数)]"""
+    buckets = []
+    for (metric, labels), value in after.items():
+        if metric != f"{name}_bucket":
+            continue
+        le = re.search(r'le="([^"]+)"', labels).group(1)
+        buckets.append((float(le), value - before.get((metric, labels), 0)))
+    return sorted(buckets)
+
+
+def bucket_percentiles(buckets):
+    """按分桶上界估计分位数（毫秒）"""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return {}
+
+    def pick(p):
+        for bound, cumulative in buckets:
+            if cumulative >= total * p:
+                return None if bound == float("inf") else round(bound * 1000, 2)
+
+    return {"count": int(total), "p50_le_ms": pick(0.50), "p90_le_ms": pick(0.90), "p99_le_ms": pick(0.99)}
+
+
+def agent_heartbeat_stats(before, after, sent, rate):
+    """agent侧心跳统计：处理数、未处理数、超过一个心跳周期才处理的数量、延迟分布、超时与重启次数"""
+    buckets = histogram_delta(before, after, HEARTBEAT_LATENESS_SECONDS.name)
+    processed = int(buckets[-1][1]) if buckets else 0
+    period = 1.0 / rate
+    # 上界不超过一个心跳周期的分桶中的数量视为按时处理（分桶粒度内的近似）
+    on_time = max((c for bound, c in buckets if bound <= period), default=0)
+
+    def delta(name, labels=""):
+        return int(after.get((name, labels), 0) - before.get((name, labels), 0))
+
+    return {
+        "sent": sent,
+        "processed": processed,
+        "unprocessed": max(0, sent - processed),
+        "late": int(processed - on_time),
+        "lateness": bucket_percentiles(buckets),
+        "timeouts": delta(HEARTBEAT_TIMEOUTS_TOTAL.name),
+        "restarts": delta(PROCESS_RESTARTS_TOTAL.name, '{reason="heartbeat_timeout"}'),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.device_ids = [f"loadsim_{i:05d}" for i in range(args.devices)]
+        self.programs = [f"loadsim_prog_{j:04d}" for j in range(args.programs)]
+        self.client = new_client()
+        self.client.on_message = self._on_message
+        self.lock = threading.Lock()
+        # 每个设备待响应的OTA命令发送时间（先进先出匹配响应）
+        self.pending = defaultdict(deque)
+        self.ota_latencies = []
+        self.ota_sent = 0
+        # 心跳只统计发送数，处理情况取自agent指标
+        self.heartbeats_sent = 0
+        self.agent_online = threading.Event()
+        self.up_topics = {GET_MSG_UP_TOPIC(d): d for d in self.device_ids}
+
+    def _on_message(self, client, userdata, message):
+        now = time.time()
+        if message.topic == GET_MSG_UP_TOPIC(DEVICE_ID):
+            self.agent_online.set()
+            return
+        device_id = self.up_topics.get(message.topic)
+        if device_id:
+            with self.lock:
+                if self.pending[device_id]:
+                    self.ota_latencies.append(now - self.pending[device_id].popleft())
+
+    def connect(self):
+        self.client.connect(self.args.broker_host, self.args.broker_port, keepalive=60)
+        self.client.loop_start()
+        topics = [(GET_MSG_UP_TOPIC(DEVICE_ID), 0)]
+        topics += [(topic, 0) for topic in self.up_topics]
+        for i in range(0, len(topics), 100):
+            self.client.subscribe(topics[i:i + 100])
+
+    def ota_storm(self, stop_event):
+        """按固定速率轮流向各设备下发OTA停止命令（agent会立即回复update stopped）"""
+        interval = 1.0 / self.args.storm_rate
+        payload = json.dumps({"type": "OTA", "stop": True})
+        next_time = time.perf_counter()
+        index = 0
+        while not stop_event.is_set():
+            device_id = self.device_ids[index % len(self.device_ids)]
+            with self.lock:
+                self.pending[device_id].append(time.time())
+                self.ota_sent += 1
+            self.client.publish(GET_MSG_DOWN_TOPIC(device_id), payload)
+            index += 1
+            next_time += interval
+            time.sleep(max(0, next_time - time.perf_counter()))
+
+    def heartbeats(self, stop_event):
+        """M个程序以R次/秒发送心跳"""
+        interval = 1.0 / self.args.rate
+        topic = GET_HEARTBEAT_TOPIC(self.args.robot_code)
+        next_time = time.perf_counter()
+        while not stop_event.is_set():
+            for program in self.programs:
+                self.client.publish(
+                    topic,
+                    json.dumps(
+                        {
+                            "program": program,
+                            "timestamp": time.time(),
+                            "reload_command": "true",
+                        }
+                    ),
+                )
+            with self.lock:
+                self.heartbeats_sent += len(self.programs)
+            next_time += interval
+            time.sleep(max(0, next_time - time.perf_counter()))
+
+    def report(self, resource_samples, heartbeats):
+        with self.lock:
+            unanswered = sum(len(q) for q in self.pending.values())
+            return {
+                "config": {
+                    "devices": self.args.devices,
+                    "programs": self.args.programs,
+                    "heartbeat_rate": self.args.rate,
+                    "storm_rate": self.args.storm_rate,
+                    "duration": self.args.duration,
+                },
+                "ota": {
+                    "sent": self.ota_sent,
+                    "answered": len(self.ota_latencies),
+                    "unanswered": unanswered,
+                    "latency": percentiles(self.ota_latencies),
+                },
+                "heartbeats": heartbeats,
+                "agent": resource_samples,
+            }
+
+
+def sample_agent(pid, stop_event, interval=1.0):
+    """采样agent进程的CPU与内存占用"""
+    samples = {"cpu_percent": [], "rss_mb": []}
+    try:
+        proc = psutil.Process(pid)
+        proc.cpu_percent(None)
+        while not stop_event.wait(interval):
+            samples["cpu_percent"].append(proc.cpu_percent(None))
+            samples["rss_mb"].append(proc.memory_info().rss / 1048576)
+    except psutil.NoSuchProcess:
+        pass
+    return samples
+
+
+def summarize(samples):
+    return {
+        key: {
+            "mean": round(statistics.fmean(values), 2),
+            "max": round(max(values), 2),
+        }
+        for key, values in samples.items()
+        if values
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--broker-host", default="127.0.0.1")
+    parser.add_argument("--broker-port", type=int, default=1883)
+    parser.add_argument("--devices", type=int, default=100, help="模拟绑定设备数N")
+    parser.add_argument("--programs", type=int, default=20, help="发送心跳的程序数M")
+    parser.add_argument("--rate", type=float, default=1.0, help="每个程序的心跳频率R（次/秒）")
+    parser.add_argument("--storm-rate", type=float, default=50.0, help="OTA命令下发速率（条/秒）")
+    parser.add_argument("--duration", type=float, default=30.0, help="压测时长（秒）")
+    parser.add_argument("--robot-code", default="loadsim_robot")
+    parser.add_argument("--agent-pid", type=int, help="测量已运行的agent，不再启动子进程")
+    parser.add_argument(
+        "--metrics-url", help="agent指标地址（配合--agent-pid使用，默认 http://127.0.0.1:9108/metrics）"
+    )
+    parser.add_argument("--output", help="结果JSON输出文件")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args)
+    agent_process = None
+    http_server = None
+    work_dir = tempfile.TemporaryDirectory()
+    try:
+        if args.agent_pid:
+            agent_pid = args.agent_pid
+            metrics_url = args.metrics_url or "http://127.0.0.1:9108/metrics"
+        else:
+            metrics_port = free_port()
+            metrics_url = f"http://127.0.0.1:{metrics_port}/metrics"
+            handler = partial(_ControlPlaneHandler, args.robot_code, generator.device_ids)
+            http_server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+            threading.Thread(target=http_server.serve_forever, daemon=True).start()
+            control_plane = f"http://127.0.0.1:{http_server.server_address[1]}"
+            env = dict(
+                os.environ,
+                IOT_AGENT_MQTT_BROKER=args.broker_host,
+                IOT_AGENT_MQTT_TMS_BROKER=args.broker_host,
+                IOT_AGENT_HTTP_BASE_URL=control_plane,
+                IOT_AGENT_HTTP_TMS_BASE_URL=control_plane,
+                IOT_AGENT_METRICS_PORT=str(metrics_port),
+            )
+            # agent在工作目录中写入快照等文件，使用临时目录
+            agent_process = subprocess.Popen(
+                [sys.executable, str(ROOT_DIR / "IoTAgent.py")],
+                cwd=work_dir.name,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            agent_pid = agent_process.pid
+
+        generator.connect()
+        if not generator.agent_online.wait(30):
+            raise RuntimeError("agent未上线（30秒内未收到online消息）")
+        # 等待后台设备同步与批量订阅完成
+        time.sleep(2)
+        metrics_before = scrape_metrics(metrics_url)
+
+        stop_event = threading.Event()
+        samples = {}
+        sampler = threading.Thread(
+            target=lambda: samples.update(sample_agent(agent_pid, stop_event))
+        )
+        workers = [
+            threading.Thread(target=generator.ota_storm, args=(stop_event,)),
+            threading.Thread(target=generator.heartbeats, args=(stop_event,)),
+            sampler,
+        ]
+        for worker in workers:
+            worker.start()
+        time.sleep(args.duration)
+        stop_event.set()
+        for worker in workers:
+            worker.join()
+        # 等待最后的响应
+        time.sleep(2)
+        metrics_after = scrape_metrics(metrics_url)
+
+        heartbeats = agent_heartbeat_stats(
+            metrics_before, metrics_after, generator.heartbeats_sent, args.rate
+        )
+        report = generator.report(summarize(samples), heartbeats)
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if args.output:
+            Path(args.output).write_text(output, encoding="utf-8")
+        print(output)
+    finally:
+        generator.client.loop_stop()
+        if agent_process:
+            agent_process.terminate()
+            agent_process.wait()
+        if http_server:
+            http_server.shutdown()
+        work_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,72 @@
 # 设备常量配置
 
-from getmac import get_mac_address
+import os
+from utils.common import get_mac_address
 
 
-MQTT_BROKER = "39.105.185.216"
-MQTT_TMS_BROKER = "121.5.162.11"
-HTTP_BASE_URL = "http://39.105.185.216:8848"
-HTTP_TMS_BASE_URL = "http://121.5.162.11:8081"
+# 服务地址（可通过环境变量覆盖，便于接入本地broker做压测）
+MQTT_BROKER = os.environ.get("IOT_AGENT_MQTT_BROKER", "39.105.185.216")
+MQTT_TMS_BROKER = os.environ.get("IOT_AGENT_MQTT_TMS_BROKER", "121.5.162.11")
+HTTP_BASE_URL = os.environ.get("IOT_AGENT_HTTP_BASE_URL", "http://39.105.185.216:8848")
+HTTP_TMS_BASE_URL = os.environ.get("IOT_AGENT_HTTP_TMS_BASE_URL", "http://121.5.162.11:8081")
 MAX_BACKUP_COUNT = 3
+# HTTP连接池大小（每个主机）、DNS缓存时间（秒，0表示不缓存）与DNS缓存最大条目数
+HTTP_POOL_MAXSIZE = 10
+DNS_CACHE_TTL = 300
+DNS_CACHE_MAX_ENTRIES = 64
 PRODUCT_AGENT_ID = "681ac31f6cc0a3de12b5020a"
 
 AGENT_FILE_PATH = "/home/rm/Jett/IoTAgent"
 OTA_SELF_FULL_PATH = "/home/rm/Jett/ota_self.py"
+# 使用通配符订阅所有设备下发主题（需broker ACL允许），否则按设备批量订阅
+MQTT_WILDCARD_SUBSCRIBE = False
+# 分块哈希并行校验线程数
+INTEGRITY_WORKERS = min(4, os.cpu_count() or 1)
+# 蓝绿升级等待新版本就绪的超时时间（秒）；程序心跳不带pid/version（无法区分新旧实例）且未配置
+# 就绪探测地址时，新进程持续运行该时间（秒）即视为就绪
+BLUE_GREEN_READY_TIMEOUT = 60
+BLUE_GREEN_LEGACY_READY_SECONDS = 10
+# 组升级同时升级的设备数上限
+GROUP_OTA_MAX_WORKERS = 2
+# 启动时在后台校准各格式的解压后端（原生工具/Python实现）；校准结果缓存文件（后端版本与文件系统未变化时复用）
+EXTRACT_CALIBRATION = True
+EXTRACT_CALIBRATION_CACHE = "extract_calibration.json"
+# 绑定设备本地快照文件
+DEVICE_SNAPSHOT_PATH = "device_snapshot.json"
+# 指标导出：HTTP端口（0表示不启动）、node_exporter textfile文件（空表示不写入）、MQTT上报间隔（秒，0表示不上报）
+METRICS_HTTP_PORT = int(os.environ.get("IOT_AGENT_METRICS_PORT", "9108"))
+METRICS_TEXTFILE_PATH = os.environ.get("IOT_AGENT_METRICS_TEXTFILE", "")
+METRICS_MQTT_INTERVAL = 60
+# OTA任务耗时追踪的本地历史记录文件与保留条数
+OTA_TRACE_HISTORY_PATH = "ota_traces.jsonl"
+OTA_TRACE_HISTORY_SIZE = 20
+# OTA任务预写日志（agent重启后恢复中断的任务、复用已校验的资源包）
+OTA_JOURNAL_PATH = "ota_journal.jsonl"
+# 远程诊断采集：结果上传接口（相对HTTP_BASE_URL）、单次采集最长时间（秒）、CPU采样开销上限、
+# 内存基线记录后未对比时自动停止tracemalloc的时间（秒）
+PROFILE_UPLOAD_URL = "/api/agentProfiles"
+PROFILE_MAX_SECONDS = 60
+PROFILE_MAX_OVERHEAD = 0.02
+PROFILE_TRACEMALLOC_TIMEOUT = 300
+# 本机心跳通道：Unix套接字路径（位于agent私有目录）、除root与agent用户外允许发送心跳的用户uid、
+# 汇总转发到TMS broker的间隔（秒，0表示不转发）
+HEARTBEAT_IPC_SOCKET = os.environ.get("IOT_AGENT_HEARTBEAT_SOCKET", "/run/iot_agent/heartbeat.sock")
+HEARTBEAT_IPC_ALLOWED_UIDS = tuple(
+    int(uid) for uid in os.environ.get("IOT_AGENT_HEARTBEAT_UIDS", "").split(",") if uid.strip()
+)
+HEARTBEAT_FORWARD_INTERVAL = 10
+# 程序心跳超时时间（秒）；健康摘要状态变化时最短发布间隔、无变化时的发布周期（秒）
+HEARTBEAT_TIMEOUT = 5
+HEALTH_MIN_INTERVAL = 5
+HEALTH_MAX_INTERVAL = 60
+# 健康摘要中超时/退出程序的保留时间（秒）与最多跟踪的程序数
+HEALTH_RETENTION = 600
+HEALTH_MAX_PROGRAMS = 64
 
 DEVICE_ID = f"{PRODUCT_AGENT_ID}_{get_mac_address(interface='eth0')}_agent"
 
 GET_HEARTBEAT_TOPIC = lambda robot_code: f"/robot/{robot_code}/heartbeat"
+GET_HEARTBEAT_BATCH_TOPIC = lambda robot_code: f"/robot/{robot_code}/heartbeat/batch"
+GET_HEALTH_TOPIC = lambda robot_code: f"/robot/{robot_code}/health"
 GET_MSG_UP_TOPIC = lambda device_id: f"/devices/{device_id}/sys/messages/up"
 GET_MSG_DOWN_TOPIC = lambda device_id: f"/devices/{device_id}/sys/messages/down"
@@ -1,3 +1,10 @@
 class ArchiveError(Exception):
   """压缩包处理异常基类"""
-  pass
\ No newline at end of file
+  pass
+
+
+class OperationCancelled(Exception):
+  """操作被取消（收到停止升级请求）"""
+
+  def __init__(self, message="终止升级"):
+    super().__init__(message)
@@ -1,9 +1,14 @@
+import os
 import sys
 import argparse
 import time
 import logging
 import shutil
+import socket
 import subprocess
+import threading
+import http.client
+import xmlrpc.client
 from pathlib import Path
 import paho.mqtt.client as mqtt
 import json
@@ -14,12 +19,23 @@ from getmac import get_mac_address
 # 配置常量
 PRODUCT_AGENT_ID = "681ac31f6cc0a3de12b5020a"
 MAIN_AGENT_NAME = "IoTAgent.py"
-CURRENT_AGENT_DIR = "/home/rm/Jett/IoTAgent"  # 当前Agent安装目录
-TEMP_DOWNLOAD_DIR = "/home/rm/Jett/tmp/agent_upgrade"  # 临时下载目录
-BACKUP_DIR = "/home/rm/Jett/agent_backup"  # 旧版本备份目录
+CURRENT_AGENT_DIR = "/home/rm/Jett/IoTAgent"  # 当前Agent安装目录（指向活动槽位的符号链接）
+# A/B槽位目录，须与CURRENT_AGENT_DIR位于同一文件系统（切换只需重命名）
+SLOTS_DIR = "/home/rm/Jett/IoTAgent_slots"
+SLOT_NAMES = ("a", "b")
+# 需要从旧版本带到新版本的运行状态文件（相对agent目录）
+STATE_FILES = (
+    "device_snapshot.json",
+    "version.json",
+    "ota_traces.jsonl",
+    "ota_journal.jsonl",
+)
 
 # Supervisor配置
 SUPERVISOR_SERVICE_NAME = "IoTAgent"  # supervisor配置中的服务名
+# supervisord的XML-RPC Unix套接字（[unix_http_server] file），不可访问时回退到supervisorctl
+SUPERVISOR_SOCKET = "/var/run/supervisor.sock"
+SUPERVISOR_RPC_TIMEOUT = 60
 
 # ================== MQTT配置 ==================
 MQTT_CONFIG = {
@@ -49,6 +65,11 @@ class MQTTNotifier:
         self.config = config
         self.client = None
         self.connected = False
+        # 连接建立前的状态消息，连接后按顺序发送
+        self._pending = []
+        # 已发出、等待确认的消息
+        self._inflight = []
+        self._lock = threading.Lock()
 
         # 初始化客户端
         self.client = mqtt.Client()
@@ -68,44 +89,39 @@ class MQTTNotifier:
     def _on_connect(self, client, userdata, flags, rc):
         """连接回调"""
         if rc == 0:
-            self.connected = True
+            with self._lock:
+                self.connected = True
+                pending, self._pending = self._pending, []
+                # 在网络线程中只发出消息，不等待确认
+                for payload in pending:
+                    self._publish(payload)
             print("MQTT连接成功")
         else:
             logger.error(f"MQTT连接失败，错误码: {rc}")
 
     def _on_disconnect(self, client, userdata, rc):
         """断开连接回调"""
-        self.connected = False
+        with self._lock:
+            self.connected = False
         if rc != 0:
             logger.warning(f"MQTT异常断开，错误码: {rc}")
 
     def connect(self):
-        """建立连接"""
+        """在后台线程中建立连接，不等待连接结果（升级流程同时进行）"""
         try:
-            self.client.connect(
+            self.client.connect_async(
                 self.config["host"],
                 port=self.config["port"],
                 keepalive=self.config["keepalive"],
             )
             self.client.loop_start()  # 启动后台线程
-            # 等待连接建立
-            for _ in range(5):  # 最大等待5秒
-                if self.connected:
-                    return True
-                time.sleep(1)
-            return False
+            return True
         except Exception as e:
             logger.error(f"MQTT连接异常: {str(e)}")
             return False
 
     def publish_status(self, status, error=None):
-        """发布状态消息"""
-        if not self.connected:
-            logger.warning("MQTT未连接，无法发送状态")
-            return False
-
-        topic = self.config["topic"]
-
+        """发布状态消息，未连接时排队，连接建立后发送"""
         payload = {
             "type": "OTA",
             "status": status,
@@ -113,6 +129,14 @@ class MQTTNotifier:
         if error:  # 如果指定了版本，则添加到消息中
             payload["error"] = error
 
+        with self._lock:
+            if not self.connected:
+                self._pending.append(payload)
+                return True
+            return self._publish(payload)
+
+    def _publish(self, payload):
+        topic = self.config["topic"]
         try:
             result = self.client.publish(
                 topic,
@@ -120,9 +144,30 @@ class MQTTNotifier:
                 qos=self.config["qos"],
             )
             print("发送mqtt消息：", topic, payload)
-            # 确保消息发送完成
-            result.wait_for_publish(timeout=5)
-            return result.is_published()
+            self._inflight.append(result)
+            return True
+        except Exception as e:
+            logger.error(f"消息发布失败: {str(e)}")
+            return False
+
+    def flush(self, timeout=5):
+        """等待排队和已发出的状态消息送达（进程退出前调用），返回是否全部送达"""
+        deadline = time.time() + timeout
+        while True:
+            with self._lock:
+                if self.connected and not self._pending:
+                    inflight, self._inflight = self._inflight, []
+                    break
+                pending = len(self._pending)
+            if time.time() >= deadline:
+                if pending:
+                    logger.warning(f"MQTT未连接，{pending}条状态消息未发送")
+                return False
+            time.sleep(0.1)
+        try:
+            for result in inflight:
+                result.wait_for_publish(timeout=max(0.1, deadline - time.time()))
+            return all(result.is_published() for result in inflight)
         except Exception as e:
             logger.error(f"消息发布失败: {str(e)}")
             return False
@@ -140,6 +185,107 @@ class UpgradeFailed(Exception):
     pass
 
 
+class _UnixSocketHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class _UnixSocketTransport(xmlrpc.client.Transport):
+    """通过Unix套接字发送XML-RPC请求"""
+
+    def __init__(self, path, timeout):
+        super().__init__()
+        self.path = path
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        return _UnixSocketHTTPConnection(self.path, self.timeout)
+
+
+class SupervisorRPC:
+    """
+    supervisord XML-RPC接口
+    startProcess/stopProcess使用wait=True，由supervisord在进程进入RUNNING/STOPPED后立即返回，无需轮询
+    （事件监听器只能在supervisord配置中静态声明，升级程序这类临时进程无法订阅）
+    """
+
+    # supervisor.xmlrpc.Faults
+    ABNORMAL_TERMINATION = 40
+    SPAWN_ERROR = 50
+    ALREADY_STARTED = 60
+    NOT_RUNNING = 70
+
+    def __init__(self, path=None, timeout=None):
+        transport = _UnixSocketTransport(
+            path or SUPERVISOR_SOCKET, timeout or SUPERVISOR_RPC_TIMEOUT
+        )
+        self.proxy = xmlrpc.client.ServerProxy("http://localhost", transport=transport)
+
+    @classmethod
+    def connect(cls):
+        """套接字可访问且supervisord处于运行状态时返回实例，否则返回None"""
+        if not Path(SUPERVISOR_SOCKET).exists():
+            return None
+        try:
+            rpc = cls()
+            if rpc.proxy.supervisor.getState()["statename"] != "RUNNING":
+                return None
+            return rpc
+        except (OSError, xmlrpc.client.Error) as e:
+            logger.warning(f"supervisord XML-RPC不可用，使用supervisorctl: {str(e)}")
+            return None
+
+    def _call(self, method, *args):
+        try:
+            return method(*args)
+        except xmlrpc.client.Fault as e:
+            raise UpgradeFailed(f"Supervisor fault {e.faultCode}: {e.faultString}")
+        except OSError as e:
+            raise UpgradeFailed(f"Supervisor RPC error: {str(e)}")
+
+    def get_state(self, name):
+        return self._call(self.proxy.supervisor.getProcessInfo, name)["statename"]
+
+    def stop(self, name):
+        try:
+            self.proxy.supervisor.stopProcess(name, True)
+        except xmlrpc.client.Fault as e:
+            if e.faultCode != self.NOT_RUNNING:
+                raise UpgradeFailed(f"Stop failed: {e.faultString} ({e.faultCode})")
+            logger.info("Service is not running, skip stopping")
+        except OSError as e:
+            raise UpgradeFailed(f"Supervisor RPC error: {str(e)}")
+
+    def start(self, name, allow_running=True):
+        """
+        返回时进程已持续运行startsecs秒（RUNNING状态）
+        :param allow_running: 为False时进程已在运行（含STARTING/BACKOFF）视为失败
+        """
+        try:
+            self.proxy.supervisor.startProcess(name, True)
+        except xmlrpc.client.Fault as e:
+            if e.faultCode != self.ALREADY_STARTED or not allow_running:
+                raise UpgradeFailed(f"Start failed: {e.faultString} ({e.faultCode})")
+        except OSError as e:
+            raise UpgradeFailed(f"Supervisor RPC error: {str(e)}")
+
+
+_supervisor_rpc = None
+
+
+def get_supervisor_rpc():
+    global _supervisor_rpc
+    if _supervisor_rpc is None:
+        _supervisor_rpc = SupervisorRPC.connect() or False
+    return _supervisor_rpc or None
+
+
 def supervisor_command(cmd: str, timeout=10) -> str:
     """执行supervisorctl命令并返回输出"""
     try:
@@ -160,6 +306,11 @@ def supervisor_command(cmd: str, timeout=10) -> str:
 
 def stop_service():
     """安全停止Supervisor服务"""
+    rpc = get_supervisor_rpc()
+    if rpc:
+        logger.info("Stopping supervisor service...")
+        rpc.stop(SUPERVISOR_SERVICE_NAME)
+        return
     try:
         status_output = supervisor_command("status")
         if "running" in status_output.lower():
@@ -176,18 +327,43 @@ def stop_service():
             raise
 
 
-def start_service():
-    """启动Supervisor服务"""
+def start_service(allow_running=True):
+    """
+    启动Supervisor服务
+    :param allow_running: 为False时服务已在运行视为失败（回滚时必须是真正的重新启动）
+    """
     print("Starting supervisor service...")
+    rpc = get_supervisor_rpc()
+    if rpc:
+        rpc.start(SUPERVISOR_SERVICE_NAME, allow_running)
+        return
     output = supervisor_command("start")
 
-    # 验证启动是否成功
-    if "started" not in output.lower():
+    # 验证启动是否成功（已在运行时输出为 "ERROR (already started)"）
+    if "started" not in output.lower() or (
+        not allow_running and "already" in output.lower()
+    ):
         raise UpgradeFailed(f"Start failed: {output}")
 
 
 def check_service_status(retries=5, interval=3) -> bool:
     """检查服务是否正常运行"""
+    rpc = get_supervisor_rpc()
+    if rpc:
+        # startProcess(wait=True)返回时已确认RUNNING，这里只需短暂等待中间状态
+        deadline = time.time() + retries * interval
+        while True:
+            try:
+                state = rpc.get_state(SUPERVISOR_SERVICE_NAME)
+            except UpgradeFailed as e:
+                logger.error(str(e))
+                return False
+            if state == "RUNNING":
+                return True
+            if state not in ("STARTING", "BACKOFF") or time.time() >= deadline:
+                logger.error(f"Service state: {state}")
+                return False
+            time.sleep(0.2)
     for _ in range(retries):
         try:
             status = supervisor_command("status")
@@ -200,39 +376,14 @@ def check_service_status(retries=5, interval=3) -> bool:
     return False
 
 
-def create_backup():
-    """创建备份（独立步骤）"""
-    try:
-        backup_path = Path(BACKUP_DIR)
-
-        # 清理旧备份
-        if backup_path.exists():
-            shutil.rmtree(backup_path, ignore_errors=True)
-
-        # 创建新备份
-        print(f"Creating backup from {CURRENT_AGENT_DIR} to {BACKUP_DIR}")
-        shutil.copytree(
-            CURRENT_AGENT_DIR,
-            BACKUP_DIR,
-            dirs_exist_ok=True,
-            ignore=shutil.ignore_patterns("*.tmp"),
-        )
-        print("Backup created successfully")
-    except Exception as e:
-        logger.error(f"备份创建失败: {str(e)}")
-        raise UpgradeFailed("无法创建备份，终止升级")
-
-
-def get_real_source_dir() -> Path:
+def get_real_source_dir(extract_dir: Path) -> Path:
     """自动检测解压后的真实目录"""
-    temp_dir = Path(TEMP_DOWNLOAD_DIR)
-
     # 情况1：直接包含程序文件
-    if (temp_dir / MAIN_AGENT_NAME).exists():
-        return temp_dir
+    if (extract_dir / MAIN_AGENT_NAME).exists():
+        return extract_dir
 
     # 情况2：包含单一子目录
-    subdirs = [d for d in temp_dir.iterdir() if d.is_dir()]
+    subdirs = [d for d in extract_dir.iterdir() if d.is_dir()]
     if len(subdirs) == 1:
         candidate = subdirs[0]
         if (candidate / MAIN_AGENT_NAME).exists():
@@ -241,57 +392,128 @@ def get_real_source_dir() -> Path:
     raise UpgradeFailed("无法识别解压后的目录结构")
 
 
-def replace_files():
-    """安全替换文件（处理目录层级）"""
+def get_active_slot() -> Path:
+    """
+    当前活动槽位
+    CURRENT_AGENT_DIR仍是普通目录（未迁移）时返回None
+    """
+    current = Path(CURRENT_AGENT_DIR)
+    if current.is_symlink():
+        return Path(os.path.realpath(current))
+    return None
+
+
+def get_inactive_slot(active_slot) -> Path:
+    """
+    新版本使用的槽位（未迁移时旧目录将成为槽位a，新版本放入槽位b）
+    两侧都解析为真实路径后比较，SLOTS_DIR包含符号链接时也不会选中活动槽位
+    """
+    slots = [Path(os.path.realpath(Path(SLOTS_DIR) / name)) for name in SLOT_NAMES]
+    if active_slot is None:
+        return slots[1]
+    active_slot = Path(os.path.realpath(active_slot))
+    slot = slots[0] if active_slot == slots[1] else slots[1]
+    if slot == active_slot:
+        raise UpgradeFailed(f"无法确定非活动槽位: {active_slot}")
+    return slot
+
+
+def extract_package(zipPath, dest: Path):
+    """解压升级包到指定目录"""
     try:
-        source_dir = get_real_source_dir()
-        target_dir = Path(CURRENT_AGENT_DIR)
-
-        # 清空目标目录
-        print(f"清理目标目录: {target_dir}")
-        shutil.rmtree(target_dir, ignore_errors=True)
-        target_dir.mkdir(parents=True)
-
-        # 复制内容
-        print(f"从 {source_dir} 复制到 {target_dir}")
-        for item in source_dir.iterdir():
-            dest = target_dir / item.name
-            if item.is_dir():
-                shutil.copytree(item, dest)
-            else:
-                shutil.copy2(item, dest)
-
-        print("文件替换成功")
+        if zipPath.lower().endswith(".zip"):
+            # 使用zipfile解压ZIP文件
+            with zipfile.ZipFile(zipPath, "r") as zf:
+                zf.extractall(dest)
+        else:
+            # 使用rarfile解压RAR文件
+            with rarfile.RarFile(zipPath, "r") as rf:
+                rf.extractall(dest)
     except Exception as e:
-        logger.error(f"文件替换失败: {str(e)}")
-        raise UpgradeFailed("文件替换失败")
+        logger.error(f"解压失败: {str(e)}")
+        raise UpgradeFailed(f"文件解压失败: {str(e)}")
+
+
+def prepare_slot(zipPath) -> Path:
+    """
+    在旧版本继续运行时准备新版本槽位（解压到临时目录后重命名为槽位目录）
+    返回新槽位目录
+    """
+    slot = get_inactive_slot(get_active_slot())
+    slots_dir = Path(SLOTS_DIR)
+    slots_dir.mkdir(parents=True, exist_ok=True)
+    extract_dir = slots_dir / f".{slot.name}_extracting"
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    extract_dir.mkdir()
+    try:
+        print(f"解压文件: {zipPath} -> {extract_dir}")
+        extract_package(zipPath, extract_dir)
+        source_dir = get_real_source_dir(extract_dir)
+        # 槽位中的上上个版本不再保留
+        shutil.rmtree(slot, ignore_errors=True)
+        source_dir.rename(slot)
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+    print(f"新版本槽位已准备: {slot}")
+    return slot
+
+
+def carry_over_state(source_dir: Path, slot: Path):
+    """将运行状态文件复制到新槽位（服务停止后执行，保证是最新内容）"""
+    for name in STATE_FILES:
+        source = source_dir / name
+        if source.is_file():
+            shutil.copy2(source, slot / name)
+
+
+def point_agent_dir(slot: Path):
+    """原子切换CURRENT_AGENT_DIR符号链接"""
+    current = Path(CURRENT_AGENT_DIR)
+    tmp_link = current.with_name(f".{current.name}.link")
+    if tmp_link.is_symlink() or tmp_link.exists():
+        tmp_link.unlink()
+    tmp_link.symlink_to(slot, target_is_directory=True)
+    os.replace(tmp_link, current)
+
+
+def activate_slot(slot: Path) -> Path:
+    """
+    切换到新槽位（服务停止期间执行，只包含重命名操作）
+    返回之前的活动目录，用于回滚
+    """
+    current = Path(CURRENT_AGENT_DIR)
+    previous = get_active_slot()
+    if previous is None:
+        # 首次使用槽位：将现有目录迁移为槽位a
+        previous = Path(SLOTS_DIR) / SLOT_NAMES[0]
+        shutil.rmtree(previous, ignore_errors=True)
+        print(f"迁移现有目录到槽位: {current} -> {previous}")
+        current.rename(previous)
+        point_agent_dir(previous)
+    try:
+        carry_over_state(previous, slot)
+        point_agent_dir(slot)
+    except Exception:
+        point_agent_dir(previous)
+        raise
+    print(f"已切换到新版本槽位: {slot}")
+    return previous
 
 
-def perform_rollback() -> None:
-    """执行回滚操作"""
+def perform_rollback(previous_slot) -> None:
+    """执行回滚操作：停止新版本实例后将符号链接指回之前的槽位，无需复制"""
     try:
         logger.warning("Starting rollback...")
-
-        backup_path = Path(BACKUP_DIR)
-        current_path = Path(CURRENT_AGENT_DIR)
-
-        # 检查备份是否存在
-        if not backup_path.exists():
-            logger.critical("回滚失败：备份目录不存在")
-            logger.critical("请手动从以下位置恢复：")
-            logger.critical(f"备份应存在于: {BACKUP_DIR}")
-            raise UpgradeFailed("无法回滚：备份丢失")
-
-        # 删除当前损坏的文件
-        if current_path.exists():
-            logger.info("Removing corrupted files...")
-            shutil.rmtree(current_path, ignore_errors=True)
-
-        # 恢复备份
-        logger.info("Restoring backup...")
-        shutil.copytree(backup_path, current_path, dirs_exist_ok=True)
-
-        print("Rollback completed")
+        if previous_slot is None:
+            logger.info("尚未切换槽位，无需回滚")
+            return
+        if not Path(previous_slot).is_dir():
+            logger.critical(f"回滚失败：槽位目录不存在 {previous_slot}")
+            raise UpgradeFailed("无法回滚：旧版本槽位丢失")
+        # 新版本实例可能仍处于STARTING/BACKOFF，不停止的话后续启动不会生效
+        stop_service()
+        point_agent_dir(Path(previous_slot))
+        print(f"Rollback completed: {previous_slot}")
     except Exception as e:
         logger.critical(f"Rollback failed! Manual intervention needed: {str(e)}")
         sys.exit(2)
@@ -299,63 +521,33 @@ def perform_rollback() -> None:
 
 def main(zipPath):
     notifier = MQTTNotifier(MQTT_CONFIG)
+    previous_slot = None
     try:
-        # 初始化MQTT连接
+        # 初始化MQTT连接（异步进行，状态消息在连接建立后发送）
         if not notifier.connect():
             logging.error("无法连接到MQTT服务器，但继续升级流程")
 
         notifier.publish_status("start update")
-        # 0. 初始化
-        Path(TEMP_DOWNLOAD_DIR).mkdir(parents=True, exist_ok=True)
 
-        # 1. 停止服务
+        # 1. 旧版本运行期间准备新版本槽位（与MQTT连接并行）
+        new_slot = prepare_slot(zipPath)
+
+        # 2. 停止服务
         print("Stopping main process")
         stop_service()
 
-        # 2. 创建备份（独立步骤）
-        create_backup()  # 如果失败会直接终止
+        # 3. 切换槽位（仅重命名，停机时间最短）
+        previous_slot = activate_slot(new_slot)
 
-        # 3. 解压文件
-        print(f"解压文件: {zipPath}")
-        try:
-            if zipPath.lower().endswith(".zip"):
-                # 使用zipfile解压ZIP文件
-                with zipfile.ZipFile(zipPath, "r") as zf:
-                    zf.extractall(TEMP_DOWNLOAD_DIR)
-            else:
-                # 使用rarfile解压RAR文件
-                with rarfile.RarFile(zipPath, "r") as rf:
-                    rf.extractall(TEMP_DOWNLOAD_DIR)
-        except Exception as e:
-            logger.error(f"解压失败: {str(e)}")
-            raise UpgradeFailed(f"文件解压失败: {str(e)}")
-
-        # print(f"解压文件: {zipPath}")
-        # if zipPath.lower().endswith(".zip"):
-        #     subprocess.run(
-        #         ["/usr/bin/unzip", "-o", zipPath, "-d", TEMP_DOWNLOAD_DIR],
-        #         check=True,
-        #         stdout=subprocess.DEVNULL,  # 隐藏解压输出
-        #     )
-        # else:
-        #     subprocess.run(
-        #         ["/usr/bin/unrar", "x", zipPath, TEMP_DOWNLOAD_DIR],
-        #         check=True,
-        #         stdout=subprocess.DEVNULL,
-        #     )
-
-        # 4. 替换文件
-        replace_files()
-
-        # 5. 启动服务
+        # 4. 启动服务
         start_service()
 
-        # 步骤6: 验证新进程启动
+        # 步骤5: 验证新进程启动
         print("Verifying new process...")
         if not check_service_status():
             raise UpgradeFailed("Service did not enter running state")
 
-        # 步骤7: 安全关闭子进程
+        # 步骤6: 安全关闭子进程
         print("New agent confirmed running. Exiting upgrader.")
 
         notifier.publish_status("update success")
@@ -364,9 +556,11 @@ def main(zipPath):
 
     except Exception as e:
         logger.error(f"Upgrade failed: {str(e)}")
-        perform_rollback()
+        perform_rollback(previous_slot)
         try:
-            start_service()  # 尝试重新启动旧版本
+            # 已切换槽位时服务已在回滚中停止，必须真正启动旧版本；
+            # 未切换时旧版本可能仍在运行，已运行即可
+            start_service(allow_running=previous_slot is None)  # 尝试重新启动旧版本
             notifier.publish_status(
                 "update failed", "has restart origin agent." + str(e)
             )
@@ -376,8 +570,8 @@ def main(zipPath):
         sys.exit(1)
 
     finally:
-        # 清理临时文件
-        shutil.rmtree(TEMP_DOWNLOAD_DIR)
+        # 退出前等待状态消息送达
+        notifier.flush()
         # 确保子进程退出（新增）
         sys.exit(0)  # 明确退出
 
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from config.constant import DEVICE_ID, DEVICE_SNAPSHOT_PATH, GET_MSG_UP_TOPIC
+from utils.cancel import CancelToken
+
+logger = logging.getLogger(__name__)
+
+# 运行时状态字段，不写入本地快照
+TRANSIENT_FIELDS = ("downloading", "stop_flag", "updating")
+# 需要与服务端保持一致的设备配置字段
+# blueGreen：该设备默认使用蓝绿升级（OTA消息中的blueGreen可单次指定）
+CONFIG_FIELDS = (
+    "isCustomDevice",
+    "directory",
+    "entryName",
+    "condaEnv",
+    "startCommand",
+    "blueGreen",
+)
+
+
+def get_device_sign(item):
+    """根据接口返回的绑定信息计算设备标识（自定义设备为 目录/入口文件）"""
+    if item.get("isCustomDevice"):
+        if not item.get("directory") or not item.get("entryName"):
+            return None
+        return item.get("directory") + "/" + item.get("entryName")
+    return (item.get("device") or {}).get("deviceId")
+
+
+class IllegalTransition(Exception):
+    pass
+
+
+class DeviceRecord:
+    """
+    绑定设备信息与OTA状态
+    OTA状态：idle -> downloading -> idle，idle -> updating -> idle，状态转换在锁内原子完成，
+    非法转换（如下载中再次下载、升级中再次升级）直接拒绝
+    每个任务开始时创建取消标记，停止请求设置该标记，下载与解压在分块/文件之间检查
+    兼容原字典用法：device_detail["downloading"] / ["updating"] / ["stop_flag"] 及配置字段
+    """
+
+    IDLE = "idle"
+    DOWNLOADING = "downloading"
+    UPDATING = "updating"
+
+    __slots__ = CONFIG_FIELDS + ("MSG_UP_TOPIC", "_state", "_cancel")
+    # 状态转换只涉及几次赋值，所有设备共用一把锁（无需每个设备一个锁对象）
+    _lock = threading.Lock()
+
+    def __init__(self, MSG_UP_TOPIC=None, **config):
+        for key in CONFIG_FIELDS:
+            setattr(self, key, config.get(key))
+        self.MSG_UP_TOPIC = MSG_UP_TOPIC
+        self._state = self.IDLE
+        self._cancel = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def busy(self):
+        return self._state != self.IDLE
+
+    @property
+    def stop_requested(self):
+        cancel = self._cancel
+        return cancel is not None and cancel.cancelled
+
+    @property
+    def cancel_token(self):
+        """当前任务的取消标记（空闲时为None）"""
+        return self._cancel
+
+    def begin(self, state):
+        """从idle进入downloading/updating，设备正忙时返回False"""
+        with self._lock:
+            if self._state != self.IDLE:
+                return False
+            self._state = state
+            self._cancel = CancelToken()
+            return True
+
+    def finish(self, state):
+        """结束当前任务回到idle（停止请求随任务的取消标记一起清除）"""
+        with self._lock:
+            if self._state != state:
+                raise IllegalTransition(f"设备状态为{self._state}，无法结束{state}")
+            self._state = self.IDLE
+            self._cancel = None
+
+    def request_stop(self):
+        """请求停止进行中的任务，设备空闲时返回False"""
+        with self._lock:
+            if self._state == self.IDLE:
+                return False
+            self._cancel.cancel()
+            return True
+
+    def config(self):
+        """写入本地快照的配置字段"""
+        return {key: getattr(self, key) for key in CONFIG_FIELDS}
+
+    # 兼容原字典用法
+    def __getitem__(self, key):
+        if key == "downloading":
+            return self._state == self.DOWNLOADING
+        if key == "updating":
+            return self._state == self.UPDATING
+        if key == "stop_flag":
+            return self.stop_requested
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in TRANSIENT_FIELDS:
+            raise IllegalTransition(f"{key}只能通过状态转换修改")
+        if key not in self.__slots__ or key.startswith("_"):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return f"DeviceRecord({self.directory}/{self.entryName}, {self._state})"
+
+
+def build_device_detail(item, device_sign):
+    """根据绑定信息构造设备详情"""
+    return DeviceRecord(
+        MSG_UP_TOPIC=(
+            GET_MSG_UP_TOPIC(device_sign)
+            if not item.get("isCustomDevice")
+            else GET_MSG_UP_TOPIC(DEVICE_ID)
+        ),
+        **{key: item.get(key) for key in CONFIG_FIELDS},
+    )
+
+
+def diff_devices(current, latest):
+    """
+    比较本地与服务端设备信息
+    返回 (新增设备标识列表, 配置变更设备标识列表, 删除设备标识列表)
+    """
+    added = [sign for sign in latest if sign not in current]
+    removed = [sign for sign in current if sign not in latest]
+    updated = [
+        sign
+        for sign in latest
+        if sign in current
+        and any(current[sign].get(k) != latest[sign].get(k) for k in CONFIG_FIELDS)
+    ]
+    return added, updated, removed
+
+
+class DeviceSnapshot:
+    """绑定设备本地快照（启动时无需等待服务端即可恢复设备信息）"""
+
+    def __init__(self, path=DEVICE_SNAPSHOT_PATH):
+        self.path = Path(path)
+        self.etag = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """读取快照，返回设备信息字典（运行时状态重置为初始值）"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"设备快照读取失败: {str(e)}")
+            return {}
+
+        self.etag = data.get("etag")
+        devices = {}
+        for device_sign, item in (data.get("devices") or {}).items():
+            devices[device_sign] = build_device_detail(item, device_sign)
+        return devices
+
+    def save(self, device_info, etag=None):
+        """原子写入快照（去除运行时状态字段）"""
+        with self._lock:
+            if etag is not None:
+                self.etag = etag
+            data = {
+                "etag": self.etag,
+                "devices": {
+                    device_sign: detail.config()
+                    for device_sign, detail in list(device_info.items())
+                },
+            }
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.error(f"设备快照写入失败: {str(e)}")
@@ -1,35 +1,83 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import os
 import shutil
 import subprocess
+import tempfile
 import threading
 import time
 import json
+import uuid
 from pathlib import Path
 import logging
 
-from config.constant import AGENT_FILE_PATH, MAX_BACKUP_COUNT, OTA_SELF_FULL_PATH
+from config.constant import (
+    AGENT_FILE_PATH,
+    BLUE_GREEN_LEGACY_READY_SECONDS,
+    BLUE_GREEN_READY_TIMEOUT,
+    GROUP_OTA_MAX_WORKERS,
+    MAX_BACKUP_COUNT,
+    OTA_JOURNAL_PATH,
+    OTA_SELF_FULL_PATH,
+    OTA_TRACE_HISTORY_PATH,
+    OTA_TRACE_HISTORY_SIZE,
+)
 from utils import downloader, archive_handler
 from utils.common import get_conda_executable_path
-from utils.process_manager import kill_process, find_and_start_app
+from exceptions import OperationCancelled
+from services.device_manager import CONFIG_FIELDS, DeviceRecord
+from utils.cancel import CancelToken
+from utils.metrics import OTA_JOBS_TOTAL, PROCESS_RESTARTS_TOTAL
+from utils.ota_journal import DONE, OTAJournal
+from utils.trace import OTATrace, TraceHistory
+from utils.process_manager import (
+    find_and_start_app,
+    find_process_pids,
+    kill_process,
+    terminate_pids,
+    terminate_process_group,
+)
 
 logger = logging.getLogger(__name__)
 
+# 组升级时多个线程同时更新version.json
+_version_file_lock = threading.Lock()
+
 
 class OTAService:
-    def __init__(self, mqtt_manager):
+    def __init__(self, mqtt_manager, on_process_started=None):
         # self.device_manager = device_manager
         self.mqtt_manager = mqtt_manager
+        # 新版本程序启动后的回调 (程序入口, 进程)，用于健康状态跟踪
+        self.on_process_started = on_process_started
         self.downloader = downloader.SecureFileDownloader()
+        # 已预解压的资源包：资源包路径 -> {"dir", "directory", "ready", "error", "cancel"}
+        self._staged = {}
+        self._staged_lock = threading.Lock()
+        # 最近收到的程序心跳：程序名 -> (接收时间, 心跳内容)，用于蓝绿切换的就绪判断
+        self._heartbeats = {}
+        self._heartbeat_cond = threading.Condition()
+        # 已下载待升级资源包的任务追踪：资源包路径 -> OTATrace
+        self._traces = OrderedDict()
+        self.trace_history = TraceHistory(OTA_TRACE_HISTORY_PATH, OTA_TRACE_HISTORY_SIZE)
+        # 任务阶段预写日志（以任务追踪ID为任务ID），agent重启后恢复中断的任务
+        self.journal = OTAJournal(OTA_JOURNAL_PATH)
 
-    def download_file(self, url, expected_md5, device_detail):
-        """下载更新压缩包"""
-        if not device_detail["downloading"]:
-            device_detail["downloading"] = True
+    def download_file(self, url, expected_md5, device_detail, manifest=None):
+        """下载更新压缩包（设备正在下载或升级时忽略）"""
+        if device_detail.begin(DeviceRecord.DOWNLOADING):
+            trace = OTATrace()
             # 通知IOT系统开始下载
             self.mqtt_manager.safe_publish(
                 device_detail["MSG_UP_TOPIC"],
                 json.dumps(
-                    {"type": "OTA", "status": "downloading", "timestamp": time.time()}
+                    {
+                        "type": "OTA",
+                        "status": "downloading",
+                        "traceId": trace.trace_id,
+                        "timestamp": time.time(),
+                    }
                 ),
             )
             # if publish:
@@ -41,13 +89,29 @@ class OTAService:
                     url,
                     expected_md5,
                     device_detail,
+                    manifest,
+                    trace,
+                    time.perf_counter(),
                 ),
                 daemon=True,
             ).start()
             # return result.get("path", None)
+        else:
+            logger.warning(f"设备{device_detail.state}中，忽略下载请求")
 
-    def download_file_thread(self, url, expected_md5, device_detail):
-        result = self.downloader.download(url, expected_md5=expected_md5)
+    def download_file_thread(
+        self, url, expected_md5, device_detail, manifest=None, trace=None, queued_at=None
+    ):
+        trace = trace or OTATrace()
+        if queued_at is not None:
+            trace.add("queue", queued_at, time.perf_counter() - queued_at)
+        try:
+            result = self.fetch_package(
+                url, expected_md5, manifest, trace, device_detail, device_detail.cancel_token
+            )
+        finally:
+            # 先回到空闲状态再通知结果，收到通知后立即下发的startUpdate不会被拒绝
+            device_detail.finish(DeviceRecord.DOWNLOADING)
         if result["status"] == "success":
             print(f"下载成功：{result['path']}")
             # 通知IOT系统下载成功
@@ -59,16 +123,41 @@ class OTAService:
                         "status": "download success",
                         "path": result["path"],
                         "timestamp": time.time(),
+                        "trace": trace.compact(),
+                    }
+                ),
+            )
+            self._keep_trace(result["path"], trace)
+            # 旧程序继续运行的同时预解压新版本，缩短升级时的停机时间
+            self.prestage_package(result["path"], device_detail, trace)
+            return
+        elif result["status"] == "cancelled":
+            print("下载已终止")
+            OTA_JOBS_TOTAL.inc(result="stopped")
+            self.mqtt_manager.safe_publish(
+                device_detail["MSG_UP_TOPIC"],
+                json.dumps(
+                    {
+                        "type": "OTA",
+                        "status": "update stopped",
+                        "trace": trace.compact(),
                     }
                 ),
             )
+            self.trace_history.record(
+                trace, "update stopped", device_detail.get("entryName")
+            )
         else:
             print(f"下载失败：{result['message']}")
+            OTA_JOBS_TOTAL.inc(result="download_failed")
             time.sleep(1)  # 延迟1秒，防止1ms内就下载完成
             errMsg = result["message"]
             if "MD5校验失败" in errMsg:
                 print("MD5校验失败")
                 errMsg = "MD5校验失败"
+            elif "分块校验失败" in errMsg:
+                print("分块校验失败")
+                errMsg = "分块校验失败"
             elif "Internal Server Error" in errMsg:
                 print("接口请求失败")
                 errMsg = "接口请求失败"
@@ -76,25 +165,366 @@ class OTAService:
             self.mqtt_manager.safe_publish(
                 device_detail["MSG_UP_TOPIC"],
                 json.dumps(
-                    {"type": "OTA", "status": "download failed", "error": errMsg}
+                    {
+                        "type": "OTA",
+                        "status": "download failed",
+                        "error": errMsg,
+                        "trace": trace.compact(),
+                    }
                 ),
             )
-        device_detail["downloading"] = False
+            self.trace_history.record(
+                trace, "download failed", device_detail.get("entryName")
+            )
+
+    def fetch_package(
+        self, url, expected_md5, manifest, trace, device_detail=None, cancel=None
+    ):
+        """下载资源包；任务日志中有MD5或分块根哈希相同的已校验资源包时直接复用，不再重新下载"""
+        root = (manifest or {}).get("root") if isinstance(manifest, dict) else None
+        self._journal(
+            trace,
+            "downloading",
+            url=url,
+            md5=expected_md5,
+            root=root,
+            device=self._journal_device(device_detail),
+        )
+        package = self.journal.find_download(expected_md5, root)
+        if package:
+            logger.info(f"复用已下载的资源包: {package}")
+            result = {"status": "success", "path": package, "reused": True}
+        else:
+            result = self.downloader.download(
+                url, expected_md5=expected_md5, manifest=manifest, trace=trace, cancel=cancel
+            )
+        if result["status"] == "success":
+            stat = os.stat(result["path"])
+            self._journal(
+                trace,
+                "downloaded",
+                package=result["path"],
+                size=stat.st_size,
+                mtime=stat.st_mtime_ns,
+                md5=result.get("md5") or expected_md5,
+                root=result.get("root") or root,
+            )
+        else:
+            status = "update stopped" if result["status"] == "cancelled" else "download failed"
+            self._journal(trace, DONE, status=status, error=result["message"])
+        return result
+
+    def _journal(self, trace, phase, **fields):
+        return self.journal.record(trace.trace_id, phase, **fields)
+
+    def _journal_device(self, device_detail):
+        if not device_detail:
+            return None
+        return {k: device_detail.get(k) for k in CONFIG_FIELDS + ("MSG_UP_TOPIC",)}
+
+    def _package_key(self, zip_path):
+        return str(Path(zip_path).resolve())
+
+    def _staging_key(self, zip_path, device_detail):
+        # 同一资源包可能预解压到多个设备目录（组升级）
+        return f"{self._package_key(zip_path)}|{device_detail.get('directory')}"
+
+    def _keep_trace(self, zip_path, trace, limit=32):
+        """保存下载完成的任务追踪，供后续startUpdate继续记录"""
+        with self._staged_lock:
+            self._traces[self._package_key(zip_path)] = trace
+            while len(self._traces) > limit:
+                self._traces.popitem(last=False)
+
+    def _take_trace(self, zip_path):
+        with self._staged_lock:
+            return self._traces.pop(self._package_key(zip_path), None)
+
+    def prestage_package(self, zip_path, device_detail, trace=None, cancel=None):
+        """
+        下载完成后将新版本解压到暂存目录（与运行目录同一文件系统，切换时只需重命名）
+        暂存目录被丢弃、等待中的升级被终止或cancel取消时逐文件中止解压
+        """
+        directory = device_detail.get("directory")
+        if not directory or device_detail.get("entryName") == "IoTAgent.py":
+            # agent自身升级由ota_self处理
+            return
+        directory = Path(directory)
+        staging_dir = directory.parent / f".{directory.name}_staging_{Path(zip_path).name}"
+        key = self._staging_key(zip_path, device_detail)
+        entry = {
+            "dir": staging_dir,
+            "directory": str(directory),
+            "ready": threading.Event(),
+            "error": None,
+            "cancel": CancelToken(cancel),
+        }
+        with self._staged_lock:
+            # 同一设备只保留最新的暂存版本
+            stale = [
+                k
+                for k, v in self._staged.items()
+                if v["directory"] == entry["directory"] and v["ready"].is_set()
+            ]
+            for k in stale:
+                self.discard_staged(k)
+            self._staged[key] = entry
+
+        work_dir = None
+        try:
+            start = time.perf_counter()
+            # 先解压到私有临时目录（与运行目录同一文件系统），完成后再重命名为暂存目录，
+            # 压缩包内容无论如何都不会落到运行目录的父目录中
+            directory.parent.mkdir(parents=True, exist_ok=True)
+            work_dir = Path(tempfile.mkdtemp(prefix=f".{directory.name}_", dir=directory.parent))
+            extract_dir = work_dir / "extract"
+            with (trace or OTATrace()).span("stage"):
+                archive_handler.ArchiveHandler(
+                    Path(zip_path), extract_dir, cancel=entry["cancel"]
+                ).extract_archive()
+                entry["cancel"].check()
+                if staging_dir.exists():
+                    shutil.rmtree(staging_dir)
+                extract_dir.rename(staging_dir)
+            logger.info(
+                f"预解压完成: {staging_dir} ({time.perf_counter() - start:.2f}s)"
+            )
+        except OperationCancelled as e:
+            logger.info(f"预解压已终止: {staging_dir}")
+            entry["error"] = str(e)
+        except Exception as e:
+            logger.error(f"预解压失败，升级时将重新解压: {str(e)}")
+            entry["error"] = str(e)
+        finally:
+            if work_dir is not None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            entry["ready"].set()
+
+    def discard_staged(self, key):
+        """清理未使用的暂存目录（调用方持有_staged_lock）"""
+        entry = self._staged.pop(key, None)
+        if entry:
+            entry["cancel"].cancel()
+            if entry["dir"].exists():
+                shutil.rmtree(entry["dir"], ignore_errors=True)
+
+    def take_staged(self, zip_path, device_detail, trace=None):
+        """取出已预解压的暂存目录，预解压未完成时等待，不可用时返回None"""
+        key = self._staging_key(zip_path, device_detail)
+        with self._staged_lock:
+            entry = self._staged.pop(key, None)
+        if not entry:
+            return None
+        if not entry["ready"].is_set():
+            with (trace or OTATrace()).span("stage_wait"):
+                try:
+                    while not entry["ready"].wait(0.5):
+                        self.check_stop_flag(device_detail)
+                except OperationCancelled:
+                    # 升级已终止，后台预解压随之中止并清理暂存目录
+                    entry["cancel"].cancel()
+                    raise
+        if entry["error"] or not entry["dir"].exists():
+            return None
+        return entry["dir"]
+
+    def stage_package(self, zip_path, device_detail, trace=None):
+        """立即预解压（未提前预解压时使用），返回暂存目录"""
+        self.prestage_package(zip_path, device_detail, trace, device_detail.cancel_token)
+        # 预解压因停止请求中止时按终止处理，而不是解压失败
+        self.check_stop_flag(device_detail)
+        return self.take_staged(zip_path, device_detail, trace)
+
+    def notify_heartbeat(self, params):
+        """接收程序心跳（由TMS心跳主题转发）"""
+        program = params.get("program")
+        if not program:
+            return
+        with self._heartbeat_cond:
+            self._heartbeats[program] = (time.time(), params)
+            self._heartbeat_cond.notify_all()
+
+    def _is_new_instance_heartbeat(self, params, process, version_info):
+        """
+        心跳是否来自新版本实例（通过pid或版本号区分新旧实例）
+        本机心跳通道的心跳自动携带pid；经TMS主题发送的心跳需程序自行带上pid或version
+        """
+        if params.get("version") and params.get("version") == version_info:
+            return True
+        pid = params.get("pid")
+        if not pid:
+            return False
+        import psutil
+
+        try:
+            new_pids = {process.pid} | {
+                child.pid for child in psutil.Process(process.pid).children(recursive=True)
+            }
+        except psutil.NoSuchProcess:
+            return False
+        return pid in new_pids
+
+    def _probe_ready(self, url):
+        try:
+            response = self.downloader.session.get(url, timeout=2)
+            response.close()
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def wait_until_ready(self, process, params, device_detail, since):
+        """
+        等待新版本就绪：收到新实例的首个心跳或就绪探测地址返回200
+        程序心跳既不带pid也不带version（旧版心跳格式，无法区分新旧实例）且未配置就绪探测地址时，
+        新进程持续运行BLUE_GREEN_LEGACY_READY_SECONDS秒即视为就绪
+        新进程提前退出或超时返回False
+        """
+        program = params.get("readyProgram") or device_detail.get("entryName")
+        probe_url = params.get("readinessUrl")
+        version_info = params.get("version")
+        deadline = time.time() + float(params.get("readyTimeout") or BLUE_GREEN_READY_TIMEOUT)
+        legacy_ready_at = since + BLUE_GREEN_LEGACY_READY_SECONDS
+        legacy = False
+        while time.time() < deadline:
+            self.check_stop_flag(device_detail)
+            if process.poll() is not None:
+                logger.error(f"新版本进程已退出，返回码: {process.returncode}")
+                return False
+            if probe_url and self._probe_ready(probe_url):
+                return True
+            if legacy and time.time() >= legacy_ready_at:
+                logger.warning("程序心跳不带pid/version，按新进程持续运行判定就绪")
+                return True
+            with self._heartbeat_cond:
+                beat = self._heartbeats.get(program)
+                if beat and beat[0] >= since:
+                    if self._is_new_instance_heartbeat(beat[1], process, version_info):
+                        return True
+                    legacy = not probe_url and not (
+                        beat[1].get("pid") or beat[1].get("version")
+                    )
+                self._heartbeat_cond.wait(0.5)
+        return False
+
+    def apply_update_blue_green(
+        self, params, zip_path, target_dir, device_detail, trace=None
+    ):
+        """
+        蓝绿升级：新版本在暂存目录中与旧版本并行启动，就绪后再终止旧版本并切换目录
+        新版本未就绪时终止新版本，旧版本保持运行
+        """
+        trace = trace or OTATrace()
+        version_info = params.get("version", "unknown")
+        staged_dir = self.take_staged(
+            zip_path, device_detail, trace
+        ) or self.stage_package(zip_path, device_detail, trace)
+        if not staged_dir:
+            raise Exception("新版本预解压失败")
+        self._journal(
+            trace,
+            "applying",
+            target=str(target_dir),
+            version=version_info,
+            staged=str(staged_dir),
+            device=self._journal_device(device_detail),
+        )
+        try:
+            with trace.span("version_write"):
+                self.write_version_file(staged_dir, version_info)
+            old_pids = find_process_pids(device_detail["entryName"])
+
+            self.check_stop_flag(device_detail)
+            since = time.time()
+            print(f"正在启动新版本（与旧版本并行）：{staged_dir}")
+            with trace.span("start"):
+                process = find_and_start_app(staged_dir, device_detail)
+            if not process:
+                raise Exception("新版本启动失败")
+            self._journal(trace, "started", pid=process.pid)
+
+            try:
+                with trace.span("ready_wait"):
+                    ready = self.wait_until_ready(process, params, device_detail, since)
+            except Exception:
+                terminate_process_group(process)
+                raise
+            if not ready:
+                terminate_process_group(process)
+                raise Exception("新版本未就绪，已保留旧版本运行")
+            logger.info(f"新版本已就绪，用时 {time.time() - since:.2f}s")
+            self._process_started(device_detail, process)
+
+            # 终止旧版本并切换目录（运行中进程的工作目录随重命名一起移动）
+            cutover_start = time.perf_counter()
+            with trace.span("kill"):
+                terminate_pids(old_pids)
+            # 先记录将要执行的操作再执行（预写），恢复时根据目录实际状态判断是否已完成
+            backup_dir = self.plan_backup(target_dir)
+            self._journal(trace, "backing_up", backup=backup_dir and str(backup_dir))
+            with trace.span("backup"):
+                self.backup_directory(target_dir, backup_dir)
+            self._journal(trace, "swapping")
+            with trace.span("swap"):
+                target_dir.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    staged_dir.rename(target_dir)
+                except OSError as e:
+                    # 新版本以暂存目录为工作目录运行，不能复制后删除，只能放弃切换并恢复旧版本
+                    self._abort_cutover(process, target_dir, backup_dir, device_detail)
+                    raise Exception(f"目录切换失败，已恢复旧版本: {str(e)}") from e
+            self._journal(trace, "swapped")
+            PROCESS_RESTARTS_TOTAL.inc(reason="ota")
+            logger.info(f"蓝绿切换完成，用时 {time.perf_counter() - cutover_start:.2f}s")
+        finally:
+            if staged_dir.exists():
+                shutil.rmtree(staged_dir, ignore_errors=True)
+
+        self.update_agent_versions(device_detail.get("entryName"), version_info)
+        # 新版本在旧版本终止前已经在提供服务，无停机
+        return {"version": version_info, "downtime": 0}
+
+    def _abort_cutover(self, process, target_dir, backup_dir, device_detail):
+        """蓝绿切换失败：终止新版本，备份目录恢复原位并重新启动旧版本"""
+        terminate_process_group(process)
+        if backup_dir and backup_dir.exists() and not target_dir.exists():
+            backup_dir.rename(target_dir)
+        if target_dir.exists():
+            self._process_started(device_detail, find_and_start_app(target_dir, device_detail))
+            PROCESS_RESTARTS_TOTAL.inc(reason="ota_rollback")
+
+    def _process_started(self, device_detail, process):
+        if self.on_process_started and process:
+            self.on_process_started(device_detail.get("entryName"), process)
 
     def check_stop_flag(self, device_detail):
-        """检查停止标志位"""
-        if device_detail["stop_flag"]:
+        """检查停止请求，已请求时抛出OperationCancelled"""
+        if device_detail.stop_requested:
             print("停止标志位已设置，正在退出...")
-            raise Exception("终止升级")
+            raise OperationCancelled()
 
-    def backup_directory(self, target_dir):
+    def plan_backup(self, target_dir):
         """
-        安全备份目录
+        生成备份目录路径（不执行备份），目标目录不存在时返回None
+        升级流程先将该路径写入任务日志再调用backup_directory
+        """
+        if not target_dir.exists():
+            return None
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        backup_dir = target_dir.with_name(f"{target_dir.name}_backup_{timestamp}")
+        index = 1
+        while backup_dir.exists():
+            backup_dir = target_dir.with_name(f"{target_dir.name}_backup_{timestamp}_{index}")
+            index += 1
+        return backup_dir
+
+    def backup_directory(self, target_dir, backup_dir=None):
+        """
+        安全备份目录（backup_dir为空时自动生成）
         返回实际备份目录
         """
-        if target_dir.exists():
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            backup_dir = target_dir.with_name(f"{target_dir.name}_backup_{timestamp}")
+        if backup_dir is None:
+            backup_dir = self.plan_backup(target_dir)
+        if backup_dir is not None:
             target_dir.rename(backup_dir)
             # 清理旧备份（保留最多5个）
             try:
@@ -116,11 +546,166 @@ class OTAService:
             except Exception as e:
                 logger.error(f"备份清理失败: {str(e)}")
                 raise f"备份清理失败: {str(e)}"
+        return backup_dir
+
+    def write_version_file(self, target_dir, version_info):
+        """更新设备代码中的版本号"""
+        version_file = target_dir / "version.txt"
+        try:
+            with open(version_file, "w", encoding="utf-8") as f:
+                f.write(version_info)
+            logger.info(f"版本文件已生成：{version_file}")
+        except Exception as e:
+            logger.error(f"版本文件写入失败: {str(e)}")
+            raise f"版本文件写入失败: {str(e)}"
+
+    def update_agent_versions(self, entry_file, version_info):
+        """更新Agent版本号管理"""
+        version_agent_file = Path("./version.json")
+        with _version_file_lock:
+            version_data = {}
+            try:
+                if version_agent_file.exists():
+                    with open(version_agent_file, "r", encoding="utf-8") as f:
+                        version_data = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError) as e:
+                logger.warning(f"版本文件读取失败: {str(e)}，将创建新文件")
+
+            version_data[entry_file] = version_info
+            with open(version_agent_file, "w", encoding="utf-8") as f:
+                json.dump(version_data, f, indent=2, ensure_ascii=False)
+        logger.info("agent版本管理文件已更新")
+
+    def apply_update(self, params, zip_path, target_dir, device_detail, trace=None):
+        """
+        替换设备程序并重启
+        已预解压时停机期间只需停止旧程序、切换目录、启动新程序
+        返回 {"version": 版本号, "downtime": 停机时长（秒）}
+        """
+        trace = trace or OTATrace()
+        version_info = params.get("version", "unknown")
+        staged_dir = self.take_staged(zip_path, device_detail, trace)
+        if staged_dir:
+            # 停机前写入版本文件
+            with trace.span("version_write"):
+                self.write_version_file(staged_dir, version_info)
+        self._journal(
+            trace,
+            "applying",
+            target=str(target_dir),
+            version=version_info,
+            staged=staged_dir and str(staged_dir),
+            device=self._journal_device(device_detail),
+        )
+
+        backup_dir = None
+        killed = False
+        backed_up = False
+        started = False
+        try:
+            # 终止旧进程
+            self.check_stop_flag(device_detail)
+            downtime_start = time.perf_counter()
+            with trace.span("kill"):
+                killed = True
+                if not kill_process(device_detail["entryName"]):
+                    print("没有找到运行的进程")
+                else:
+                    time.sleep(2)  # 等待资源释放
+
+            # 备份资源包
+            self.check_stop_flag(device_detail)
+            # 先记录将要执行的操作再执行（预写），恢复时根据目录实际状态判断是否已完成
+            backup_dir = self.plan_backup(target_dir)
+            self._journal(trace, "backing_up", backup=backup_dir and str(backup_dir))
+            with trace.span("backup"):
+                self.backup_directory(target_dir, backup_dir)
+            backed_up = True
+
+            self.check_stop_flag(device_detail)
+            self._journal(trace, "swapping")
+            if staged_dir:
+                # 同一文件系统内重命名即可完成切换
+                with trace.span("swap"):
+                    target_dir.parent.mkdir(parents=True, exist_ok=True)
+                    try:
+                        staged_dir.rename(target_dir)
+                    except OSError:
+                        shutil.move(str(staged_dir), str(target_dir))
+                logger.info(f"已切换到预解压版本: {target_dir}")
+            else:
+                with trace.span("extract"):
+                    _archive_handler = archive_handler.ArchiveHandler(
+                        Path(zip_path), target_dir, cancel=device_detail.cancel_token
+                    )
+                    _archive_handler.extract_archive()
+                with trace.span("version_write"):
+                    self.write_version_file(target_dir, version_info)
+            self._journal(trace, "swapped")
+
+            # 启动新程序
+            self.check_stop_flag(device_detail)
+            print(f"正在启动新程序：{target_dir}")
+            with trace.span("start"):
+                process = find_and_start_app(target_dir, device_detail)
+            started = True
+            self._process_started(device_detail, process)
+            PROCESS_RESTARTS_TOTAL.inc(reason="ota")
+        except Exception:
+            # 旧程序已终止后升级终止或失败：恢复备份并重新启动旧程序，避免设备上没有程序运行
+            if killed and not started:
+                self._rollback_update(trace, target_dir, backup_dir, backed_up, device_detail)
+            raise
+        finally:
+            # 未使用的暂存目录（升级终止或失败）直接清理
+            if staged_dir and staged_dir.exists():
+                shutil.rmtree(staged_dir, ignore_errors=True)
+        downtime = time.perf_counter() - downtime_start
+        trace.add("downtime", downtime_start, downtime)
+        logger.info(f"升级停机时长: {downtime:.2f}s")
+
+        self.update_agent_versions(device_detail.get("entryName"), version_info)
+        return {"version": version_info, "downtime": round(downtime, 3)}
+
+    def _rollback_update(self, trace, target_dir, backup_dir, backed_up, device_detail):
+        """
+        删除未完成的新版本目录，备份目录恢复原位并重新启动旧程序（回滚失败只记录日志）
+        备份目录不存在且backed_up为False时目标目录仍是旧版本，只需重新启动
+        """
+        self._journal(trace, "rolling_back")
+        try:
+            has_backup = bool(backup_dir) and backup_dir.exists()
+            if (backed_up or has_backup) and target_dir.exists():
+                shutil.rmtree(target_dir)
+            if has_backup:
+                backup_dir.rename(target_dir)
+                logger.info(f"已从备份恢复: {backup_dir} -> {target_dir}")
+            if target_dir.exists():
+                process = find_and_start_app(target_dir, device_detail)
+                self._process_started(device_detail, process)
+                PROCESS_RESTARTS_TOTAL.inc(reason="ota_rollback")
+        except Exception as e:
+            logger.error(f"升级回滚失败: {str(e)}")
+
+    def resolve_target_dir(self, params, zip_path, target_path):
+        """根据资源包名称确定程序目录"""
+        file_name = (
+            params.get("filename") or Path(zip_path).name or params.get("version")
+        )
+        print(f"正在更新：{file_name}")
+        _target_path = (
+            target_path
+            if target_path.split("/")[-1] == file_name
+            else f"{target_path}/{file_name}"
+        )
+        return Path(_target_path)
 
     def handle_start_update(self, params, target_path, device_detail):
         """处理startUpdate的独立线程函数"""
+        zip_path = params.get("path")
+        # 沿用下载阶段的任务追踪，直接升级时新建
+        trace = (zip_path and self._take_trace(zip_path)) or OTATrace()
         try:
-            zip_path = params.get("path")
             entry_file = device_detail.get("entryName")
             if not zip_path or not Path(zip_path).exists():
                 self.mqtt_manager.safe_publish(
@@ -130,21 +715,15 @@ class OTAService:
                             "type": "OTA",
                             "status": "update failed",
                             "error": "未找到资源包",
+                            "trace": trace.compact(),
                         }
                     ),
                 )
+                self.trace_history.record(trace, "update failed", entry_file)
+                self._journal(trace, DONE, status="update failed")
                 return
 
-            file_name = (
-                params.get("filename") or Path(zip_path).name or params.get("version")
-            )
-            print(f"正在更新：{file_name}")
-            _target_path = (
-                target_path
-                if target_path.split("/")[-1] == file_name
-                else f"{target_path}/{file_name}"
-            )
-            target_dir = Path(_target_path)
+            target_dir = self.resolve_target_dir(params, zip_path, target_path)
             print(f"目标目录：{target_dir}")
 
             # 发送开始更新通知
@@ -200,79 +779,296 @@ class OTAService:
                     )
                 return
 
-            # 终止旧进程
-            self.check_stop_flag(device_detail)
-            if not kill_process(device_detail["entryName"]):
-                print("没有找到运行的进程")
-
-            time.sleep(2)  # 等待资源释放
-
-            # 备份资源包
-            self.check_stop_flag(device_detail)
-            self.backup_directory(target_dir)
-
-            self.check_stop_flag(device_detail)
-            _archive_handler = archive_handler.ArchiveHandler(
-                Path(zip_path), target_dir
-            )
-            _archive_handler.extract_archive()
-
-            # 更新设备代码中的版本号
-            version_file = target_dir / "version.txt"
-            version_info = params.get("version", "unknown")
-            try:
-                with open(version_file, "w", encoding="utf-8") as f:
-                    f.write(version_info)
-                logger.info(f"版本文件已生成：{version_file}")
-            except Exception as e:
-                logger.error(f"版本文件写入失败: {str(e)}")
-                raise f"版本文件写入失败: {str(e)}"
-
-            # 启动新程序
-            self.check_stop_flag(device_detail)
-            print(f"正在启动新程序：{target_dir}")
-            find_and_start_app(target_dir, device_detail)
-
-            # 更新Agent版本号管理
-            version_agent_file = Path("./version.json")
-            version_data = {}
-            try:
-                if version_agent_file.exists():
-                    with open(version_agent_file, "r", encoding="utf-8") as f:
-                        version_data = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError) as e:
-                logger.warning(f"版本文件读取失败: {str(e)}，将创建新文件")
-
-            version_data[entry_file] = version_info
-            with open(version_agent_file, "w", encoding="utf-8") as f:
-                json.dump(version_data, f, indent=2, ensure_ascii=False)
-            logger.info("agent版本管理文件已更新")
+            if params.get("blueGreen") or device_detail.get("blueGreen"):
+                if device_detail.get("startCommand"):
+                    # 自定义启动命令无法指定新版本目录，只能按普通方式升级
+                    logger.warning("自定义启动命令不支持蓝绿升级，使用普通升级")
+                    result = self.apply_update(
+                        params, zip_path, target_dir, device_detail, trace
+                    )
+                else:
+                    result = self.apply_update_blue_green(
+                        params, zip_path, target_dir, device_detail, trace
+                    )
+            else:
+                result = self.apply_update(
+                    params, zip_path, target_dir, device_detail, trace
+                )
 
             # 更新成功通知
+            OTA_JOBS_TOTAL.inc(result="success")
             self.mqtt_manager.safe_publish(
                 device_detail["MSG_UP_TOPIC"],
                 json.dumps(
-                    {"type": "OTA", "status": "update success", "version": version_info}
+                    {
+                        "type": "OTA",
+                        "status": "update success",
+                        "version": result["version"],
+                        "downtime": result["downtime"],
+                        "trace": trace.compact(),
+                    }
                 ),
             )
+            self.trace_history.record(trace, "update success", entry_file)
+            self._journal(trace, DONE, status="update success")
 
         except Exception as e:
-            error = str(e)
-            if error == "终止升级":
+            if isinstance(e, OperationCancelled):
                 logger.info("终止升级")
+                OTA_JOBS_TOTAL.inc(result="stopped")
                 self.mqtt_manager.safe_publish(
                     device_detail["MSG_UP_TOPIC"],
-                    json.dumps({"type": "OTA", "status": "update stopped"}),
+                    json.dumps(
+                        {
+                            "type": "OTA",
+                            "status": "update stopped",
+                            "trace": trace.compact(),
+                        }
+                    ),
+                )
+                self.trace_history.record(
+                    trace, "update stopped", device_detail.get("entryName")
                 )
+                self._journal(trace, DONE, status="update stopped")
             else:
                 logger.error(f"更新失败: {str(e)}")
+                OTA_JOBS_TOTAL.inc(result="failed")
                 self.mqtt_manager.safe_publish(
                     device_detail["MSG_UP_TOPIC"],
                     json.dumps(
-                        {"type": "OTA", "status": "update failed", "error": str(e)}
+                        {
+                            "type": "OTA",
+                            "status": "update failed",
+                            "error": str(e),
+                            "trace": trace.compact(),
+                        }
+                    ),
+                )
+                self.trace_history.record(
+                    trace, "update failed", device_detail.get("entryName")
+                )
+                self._journal(trace, DONE, status="update failed", error=str(e))
+
+        finally:
+            device_detail.finish(DeviceRecord.UPDATING)
+
+    def handle_group_update(self, params, device_info, reply_topic):
+        """
+        组升级：资源包只下载、校验一次，然后在多个设备目录中并行预解压并升级（限制并发数）
+        所有设备完成后通过一条汇总消息上报各设备结果
+        """
+        group_id = params.get("groupId") or uuid.uuid4().hex[:16]
+        trace = OTATrace()
+        results = {}
+        targets = {}
+        for device_sign in params.get("targets") or []:
+            device_detail = device_info.get(device_sign)
+            if params.get("processPath"):
+                # 各设备目录不同，单一processPath会让所有设备升级到同一目录
+                results[device_sign] = {
+                    "status": "update failed",
+                    "error": "组升级不支持processPath，使用各设备的目录",
+                }
+            elif not device_detail:
+                results[device_sign] = {"status": "update failed", "error": "未找到设备信息"}
+            elif device_detail.get("entryName") == "IoTAgent.py":
+                results[device_sign] = {"status": "update failed", "error": "agent不支持组升级"}
+            elif not device_detail.get("directory"):
+                results[device_sign] = {"status": "update failed", "error": "未找到目标路径"}
+            elif not device_detail.begin(DeviceRecord.UPDATING):
+                results[device_sign] = {"status": "update failed", "error": "设备正在升级"}
+            else:
+                targets[device_sign] = device_detail
+
+        try:
+            if targets:
+                self.mqtt_manager.safe_publish(
+                    reply_topic,
+                    json.dumps(
+                        {
+                            "type": "groupOTA",
+                            "groupId": group_id,
+                            "status": "downloading",
+                            "targets": list(targets),
+                            "timestamp": time.time(),
+                        }
                     ),
                 )
+                download = self.fetch_package(
+                    params.get("url"), params.get("md5"), params.get("manifest"), trace
+                )
+                if download["status"] == "success":
+                    self._apply_group(params, download["path"], targets, results)
+                else:
+                    OTA_JOBS_TOTAL.inc(result="download_failed")
+                    for device_sign in targets:
+                        results[device_sign] = {
+                            "status": "download failed",
+                            "error": download["message"],
+                        }
+        finally:
+            for device_detail in targets.values():
+                device_detail.finish(DeviceRecord.UPDATING)
+
+        succeeded = sum(1 for r in results.values() if r["status"] == "update success")
+        if succeeded == len(results) and results:
+            status = "update success"
+        else:
+            status = "partial success" if succeeded else "update failed"
+        self.mqtt_manager.safe_publish(
+            reply_topic,
+            json.dumps(
+                {
+                    "type": "groupOTA",
+                    "groupId": group_id,
+                    "status": status,
+                    "version": params.get("version"),
+                    "results": results,
+                    "trace": trace.compact(),
+                    "timestamp": time.time(),
+                }
+            ),
+        )
+        self.trace_history.record(trace, status, f"group:{group_id}")
+        self._journal(trace, DONE, status=status)
+
+    def _apply_group(self, params, zip_path, targets, results):
+        max_workers = min(
+            int(params.get("maxWorkers") or GROUP_OTA_MAX_WORKERS),
+            GROUP_OTA_MAX_WORKERS,
+            len(targets),
+        )
+
+        def update_one(device_sign):
+            device_detail = targets[device_sign]
+            trace = OTATrace()
+            try:
+                target_dir = self.resolve_target_dir(
+                    params, zip_path, device_detail["directory"]
+                )
+                # 旧版本运行期间预解压，停机时只需切换目录
+                self.prestage_package(
+                    zip_path, device_detail, trace, device_detail.cancel_token
+                )
+                result = self.apply_update(
+                    params, zip_path, target_dir, device_detail, trace
+                )
+                OTA_JOBS_TOTAL.inc(result="success")
+                self._journal(trace, DONE, status="update success")
+                return dict(result, status="update success", trace=trace.compact())
+            except Exception as e:
+                status = "update stopped" if isinstance(e, OperationCancelled) else "update failed"
+                OTA_JOBS_TOTAL.inc(result="stopped" if status == "update stopped" else "failed")
+                self._journal(trace, DONE, status=status, error=str(e))
+                logger.error(f"组升级失败 {device_sign}: {str(e)}")
+                return {"status": status, "error": str(e), "trace": trace.compact()}
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="group-ota") as executor:
+            for device_sign, result in zip(targets, executor.map(update_one, targets)):
+                results[device_sign] = result
 
+    def recover_jobs(self, device_info):
+        """
+        agent启动时重放任务日志：
+        中断的下载上报失败（已校验的资源包保留，后续同一资源包直接复用）
+        中断的升级已切换到新版本时补完（确保新版本运行并记录版本号），否则回滚到旧版本
+        """
+        for job in self.journal.unfinished():
+            phase = job.get("phase")
+            if phase == "downloaded":
+                continue
+            device = job.get("device") or {}
+            try:
+                if phase == "downloading":
+                    status, error = "download failed", "agent重启，下载中断"
+                else:
+                    status, error = self._recover_update(job, device_info)
+            except Exception as e:
+                logger.error(f"OTA任务恢复失败 {job['job']}: {str(e)}")
+                status, error = "update failed", f"agent重启，升级恢复失败: {str(e)}"
+            logger.warning(f"恢复中断的OTA任务 {job['job']}（{phase}）: {status}")
+            OTA_JOBS_TOTAL.inc(result="recovered" if status == "update success" else "failed")
+            self.journal.record(job["job"], DONE, status=status, error=error)
+            if device.get("MSG_UP_TOPIC"):
+                message = {
+                    "type": "OTA",
+                    "status": status,
+                    "traceId": job["job"],
+                    "recovered": True,
+                }
+                if error:
+                    message["error"] = error
+                if job.get("version"):
+                    message["version"] = job["version"]
+                self.mqtt_manager.safe_publish(device["MSG_UP_TOPIC"], json.dumps(message))
+
+    def _find_device(self, device, device_info):
+        """按目录与入口文件找到当前设备详情，已不在绑定列表中时使用日志中记录的配置"""
+        for device_detail in device_info.values():
+            if device_detail.get("directory") == device.get(
+                "directory"
+            ) and device_detail.get("entryName") == device.get("entryName"):
+                return device_detail
+        return DeviceRecord(**device)
+
+    def _recover_update(self, job, device_info):
+        device_detail = self._find_device(job.get("device") or {}, device_info)
+        entry_file = device_detail.get("entryName")
+        target_dir = Path(job["target"])
+        if not device_detail.begin(DeviceRecord.UPDATING):
+            raise Exception("设备正在升级")
+        try:
+            phase = job["phase"]
+            staged = job.get("staged")
+            if phase == "swapping" and staged:
+                # 预解压目录的切换是单次重命名：暂存目录仍在且目标目录不存在说明尚未切换，
+                # 新版本已完整就位，继续完成切换
+                if Path(staged).is_dir() and not target_dir.exists():
+                    target_dir.parent.mkdir(parents=True, exist_ok=True)
+                    Path(staged).rename(target_dir)
+                    logger.info(f"已完成中断的目录切换: {staged} -> {target_dir}")
+                if target_dir.exists() and not Path(staged).exists():
+                    phase = "swapped"
+            if phase == "swapped":
+                # 新版本已就位，只差启动与版本记录
+                self._ensure_running(target_dir, device_detail)
+                self.update_agent_versions(entry_file, job.get("version", "unknown"))
+                return "update success", None
+
+            if job.get("pid"):
+                # 蓝绿升级中启动的新版本实例
+                self._terminate_instance(job["pid"], entry_file)
+            backup = job.get("backup")
+            if backup and Path(backup).exists():
+                # 备份重命名已完成：目标目录不存在，或是未解压完成的新版本
+                if target_dir.exists():
+                    shutil.rmtree(target_dir)
+                Path(backup).rename(target_dir)
+                logger.info(f"已从备份恢复: {backup} -> {target_dir}")
+            if staged and Path(staged).exists():
+                shutil.rmtree(staged, ignore_errors=True)
+            if target_dir.exists():
+                self._ensure_running(target_dir, device_detail)
+            return "update failed", "agent重启，升级已回滚"
         finally:
-            device_detail["stop_flag"] = False
-            device_detail["updating"] = False
+            device_detail.finish(DeviceRecord.UPDATING)
+
+    def _ensure_running(self, target_dir, device_detail):
+        """程序未运行时（升级过程中已被终止）重新启动"""
+        if find_process_pids(device_detail["entryName"]):
+            return
+        process = find_and_start_app(target_dir, device_detail)
+        self._process_started(device_detail, process)
+        PROCESS_RESTARTS_TOTAL.inc(reason="ota_recovery")
+
+    def _terminate_instance(self, pid, entry_file):
+        """终止指定实例及其子进程（pid已被复用为其他程序时跳过）"""
+        if pid not in find_process_pids(entry_file):
+            return
+        import psutil
+
+        try:
+            children = psutil.Process(pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        terminate_pids([pid] + [child.pid for child in children])
@@ -1,27 +1,231 @@
 import logging
+import os
+from contextlib import contextmanager
 from pathlib import Path
 import shutil
-from typing import Dict, Set
+import tarfile
+import threading
+import time
+from typing import Dict, List, Optional, Set
+import uuid
 import zipfile
-import py7zr
-import rarfile
+import zlib
 
-from exceptions import ArchiveError
+from exceptions import ArchiveError, OperationCancelled
 
 logger = logging.getLogger(__name__)
 
+# 文件头魔数：(偏移, 魔数, 格式)
+_MAGIC_NUMBERS = (
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"PK\x05\x06", "zip"),  # 空zip
+    (0, b"Rar!\x1a\x07", "rar"),
+    (0, b"7z\xbc\xaf\x27\x1c", "7z"),
+    (0, b"\x1f\x8b", "tar.gz"),
+    (0, b"\x28\xb5\x2f\xfd", "tar.zst"),
+    (257, b"ustar", "tar"),
+)
+# 无法识别魔数时按后缀判断
+_SUFFIX_FORMATS = {
+    ".zip": "zip",
+    ".rar": "rar",
+    ".7z": "7z",
+    ".7zip": "7z",
+    ".tar": "tar",
+    ".tgz": "tar.gz",
+    ".gz": "tar.gz",
+    ".tzst": "tar.zst",
+    ".zst": "tar.zst",
+}
+TAR_FORMATS = ("tar", "tar.gz", "tar.zst")
+
+# Linux下调大管道缓冲区（F_SETPIPE_SZ），减少解压线程与解包线程之间的切换
+_F_SETPIPE_SZ = 1031
+_PIPE_SIZE = 1024 * 1024
+
+
+def detect_format(file_path: Path) -> str:
+    """根据文件头魔数识别压缩格式，无法识别时按后缀判断"""
+    with open(file_path, "rb") as f:
+        header = f.read(262)
+    for offset, magic, fmt in _MAGIC_NUMBERS:
+        if header[offset:offset + len(magic)] == magic:
+            return fmt
+    ext = Path(file_path).suffix.lower()
+    if ext in _SUFFIX_FORMATS:
+        return _SUFFIX_FORMATS[ext]
+    raise ArchiveError(f"不支持的压缩格式: {ext or header[:8]!r}")
+
+
+def analyze_names(all_files: List[str]) -> Dict:
+    """根据成员路径判断压缩包是否只有单一顶层目录"""
+    top_dirs: Set[str] = set()
+    for name in all_files:
+        parts = name.replace("\\", "/").split("/")
+        if len(parts) > 1 and parts[0]:
+            top_dirs.add(parts[0])
+        else:
+            # 处理根目录文件
+            if "." in parts[-1]:  # 判断是否为文件
+                top_dirs.add("root_files")
+            elif parts[0]:
+                top_dirs.add(parts[0])
+    return {
+        "is_single_dir": len(top_dirs) == 1 and "root_files" not in top_dirs,
+        "top_dir": next(iter(top_dirs)) if len(top_dirs) == 1 else None,
+    }
+
+
+class _GzipDecompressor:
+    """支持多成员gzip流的解压器"""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(wbits=31)
+
+    @property
+    def complete(self):
+        return self._decompressor.eof
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            data = self._decompressor.unused_data
+            if not data.strip(b"\0"):
+                # 末尾的填充字节
+                break
+            self._decompressor = zlib.decompressobj(wbits=31)
+        return b"".join(output)
+
+
+class _ZstdDecompressor:
+    def __init__(self):
+        import pyzstd  # 仅OTA时需要，延迟导入
+
+        # 支持多帧（多线程压缩生成的文件由多个帧组成）
+        self._decompressor = pyzstd.EndlessZstdDecompressor()
+
+    @property
+    def complete(self):
+        return self._decompressor.at_frame_edge
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+_DECOMPRESSORS = {"tar.gz": _GzipDecompressor, "tar.zst": _ZstdDecompressor}
+
+
+class _DecompressPipe:
+    """
+    在独立线程中解压并写入管道，tar解包从管道读取
+    zstd/zlib解压时释放GIL，解压与解包写盘可在两个核心上并行
+    """
+
+    def __init__(self, path: Path, decompressor, chunk_size=1024 * 1024):
+        read_fd, self._write_fd = os.pipe()
+        try:
+            import fcntl
+
+            fcntl.fcntl(self._write_fd, _F_SETPIPE_SZ, _PIPE_SIZE)
+        except (ImportError, OSError):
+            pass
+        self.reader = os.fdopen(read_fd, "rb", buffering=chunk_size)
+        self.error: Optional[Exception] = None
+        self._thread = threading.Thread(
+            target=self._run, args=(path, decompressor, chunk_size), daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, path, decompressor, chunk_size):
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    view = memoryview(decompressor.decompress(chunk))
+                    while view:
+                        written = os.write(self._write_fd, view)
+                        view = view[written:]
+            if not decompressor.complete:
+                raise ArchiveError("压缩数据不完整")
+        except BrokenPipeError:
+            # 解包端提前结束
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(self._write_fd)
+
+    def close(self):
+        self.reader.close()
+        self._thread.join()
+
+
+@contextmanager
+def open_tar_stream(path: Path, fmt: str):
+    """以流模式打开tar包（只顺序读取一遍，无需随机访问）"""
+    if fmt == "tar":
+        with tarfile.open(path, mode="r|") as tf:
+            yield tf
+        return
+
+    pipe = _DecompressPipe(path, _DECOMPRESSORS[fmt]())
+    try:
+        with tarfile.open(fileobj=pipe.reader, mode="r|") as tf:
+            yield tf
+    except Exception:
+        pipe.close()
+        # 解压失败时tar端只会看到数据提前结束，优先报告解压错误
+        if pipe.error:
+            raise pipe.error from None
+        raise
+    pipe.close()
+    if pipe.error:
+        raise pipe.error
+
+
+def _member_path(member: tarfile.TarInfo) -> Optional[str]:
+    """成员的规范路径（目录以/结尾），"./"根目录项返回None"""
+    name = os.path.normpath(member.name.replace("\\", "/"))
+    if name == ".":
+        return None
+    return name + "/" if member.isdir() else name
+
+
+def _is_safe_member(member: tarfile.TarInfo) -> bool:
+    """拒绝绝对路径、跳出目标目录的路径、指向目录外的链接以及设备文件"""
+    name = member.name.replace("\\", "/")
+    if name.startswith("/") or ".." in name.split("/"):
+        return False
+    if member.issym() or member.islnk():
+        link = member.linkname.replace("\\", "/")
+        if link.startswith("/"):
+            return False
+        base = os.path.dirname(name) if member.issym() else ""
+        if os.path.normpath(os.path.join(base, link)).startswith(".."):
+            return False
+    return member.isreg() or member.isdir() or member.issym() or member.islnk()
+
 
 class ArchiveHandler:
-    def __init__(self, src_path: Path, target_dir: Path):
+    def __init__(self, src_path: Path, target_dir: Path, cancel=None):
+        """
+        :param cancel: 取消标记，逐文件检查，取消时清理已解压内容并抛出OperationCancelled
+        """
         self.src_path = src_path
         self.target_dir = target_dir
+        self.cancel = cancel
 
     def analyze_archive_structure(self, file_path: Path) -> Dict:
         """
-        分析压缩包结构（支持ZIP/RAR/7Z）
+        分析压缩包结构（支持ZIP/RAR/7Z/TAR/TAR.GZ/TAR.ZST）
         返回结构：
         {
-          "format": "zip/rar/7z",
+          "format": "zip/rar/7z/tar/tar.gz/tar.zst",
           "is_single_dir": bool,
           "top_dir": str,
           "file_count": int,
@@ -29,44 +233,39 @@ class ArchiveHandler:
         }
         """
         try:
-            ext = file_path.suffix.lower()
+            fmt = detect_format(file_path)
             all_files = []
-            top_dirs: Set[str] = set()
 
             # ZIP格式处理
-            if ext == ".zip":
+            if fmt == "zip":
                 with zipfile.ZipFile(file_path, "r") as zf:
                     all_files = zf.namelist()
 
             # RAR格式处理
-            elif ext == ".rar":
+            elif fmt == "rar":
+                import rarfile  # 仅OTA时需要，延迟导入
+
                 with rarfile.RarFile(file_path, "r", charset="gbk") as rf:
                     all_files = [f.filename for f in rf.infolist()]
 
             # 7Z格式处理
-            elif ext in (".7z", ".7zip"):
+            elif fmt == "7z":
+                import py7zr  # 仅OTA时需要，延迟导入
+
                 with py7zr.SevenZipFile(file_path, "r") as z7:
                     all_files = z7.getnames()
 
+            # TAR格式处理（需要完整读取一遍）
             else:
-                raise ArchiveError(f"不支持的压缩格式: {ext}")
+                with open_tar_stream(file_path, fmt) as tf:
+                    all_files = [
+                        name for name in map(_member_path, tf) if name is not None
+                    ]
 
             # 统一分析文件结构
-            for name in all_files:
-                parts = name.replace("\\", "/").split("/")
-                if len(parts) > 1 and parts[0]:
-                    top_dirs.add(parts[0])
-                else:
-                    # 处理根目录文件
-                    if "." in parts[-1]:  # 判断是否为文件
-                        top_dirs.add("root_files")
-                    elif parts[0]:
-                        top_dirs.add(parts[0])
-
             return {
-                "format": ext[1:],
-                "is_single_dir": len(top_dirs) == 1 and "root_files" not in top_dirs,
-                "top_dir": next(iter(top_dirs)) if len(top_dirs) == 1 else None,
+                "format": fmt,
+                **analyze_names(all_files),
                 "file_count": len(all_files),
                 "all_files": all_files,
             }
@@ -76,54 +275,48 @@ class ArchiveHandler:
 
     def extract_archive(self):
         """
-        安全解压压缩包（支持ZIP/RAR/7Z）
+        安全解压压缩包（支持ZIP/RAR/7Z/TAR/TAR.GZ/TAR.ZST）
+        按格式使用校准选定的解压后端，单一顶层目录时将其提升为目标目录
         """
+        from utils.extract_backends import EXTRACTORS  # 避免循环导入
+
         try:
             # 自动清理已存在目录
             if self.target_dir.exists():
                 shutil.rmtree(self.target_dir)
                 logger.warning(f"已清理现有目录: {self.target_dir}")
 
-            # 分析压缩包结构
-            archive_info = self.analyze_archive_structure(self.src_path)
-
+            fmt = detect_format(self.src_path)
             # 创建父目录（延迟创建目标目录）
             self.target_dir.parent.mkdir(parents=True, exist_ok=True)
+            start = time.perf_counter()
+            backend = EXTRACTORS.extract(self.src_path, self.target_dir, fmt, self.cancel)
+            self._hoist_single_dir()
 
-            # ZIP格式解压
-            if archive_info["format"] == "zip":
-                with zipfile.ZipFile(self.src_path, "r") as zf:
-                    if archive_info["is_single_dir"]:
-                        zf.extractall(self.target_dir.parent)
-                        original_dir = self.target_dir.parent / archive_info["top_dir"]
-                        original_dir.rename(self.target_dir)
-                    else:
-                        zf.extractall(self.target_dir)
-
-            # RAR格式解压
-            elif archive_info["format"] == "rar":
-                with rarfile.RarFile(self.src_path, "r", charset="gbk") as rf:
-                    if archive_info["is_single_dir"]:
-                        rf.extractall(self.target_dir.parent)
-                        original_dir = self.target_dir.parent / archive_info["top_dir"]
-                        original_dir.rename(self.target_dir)
-                    else:
-                        rf.extractall(self.target_dir)
-
-            # 7Z格式解压
-            elif archive_info["format"] in ("7z", "7zip"):
-                with py7zr.SevenZipFile(self.src_path, "r") as z7:
-                    if archive_info["is_single_dir"]:
-                        z7.extractall(self.target_dir.parent)
-                        original_dir = self.target_dir.parent / archive_info["top_dir"]
-                        original_dir.rename(self.target_dir)
-                    else:
-                        z7.extractall(self.target_dir)
-
-            logger.info(f"成功解压 {self.src_path.name} 到 {self.target_dir}")
+            logger.info(
+                f"成功解压 {self.src_path.name} 到 {self.target_dir}"
+                f"（{fmt}/{backend}，{time.perf_counter() - start:.2f}s）"
+            )
 
+        except OperationCancelled:
+            logger.info(f"解压已取消: {self.src_path.name}")
+            if self.target_dir.exists():
+                shutil.rmtree(self.target_dir)
+            raise
         except Exception as e:
             logger.error(f"解压失败: {str(e)}")
             if self.target_dir.exists():
                 shutil.rmtree(self.target_dir)
             raise ArchiveError(f"解压操作失败: {str(e)}") from e
+
+    def _hoist_single_dir(self):
+        """压缩包只有单一顶层目录时，将该目录提升为目标目录"""
+        entries = list(self.target_dir.iterdir())
+        if len(entries) != 1 or not entries[0].is_dir() or entries[0].is_symlink():
+            return
+        temp_dir = self.target_dir.with_name(
+            f".{self.target_dir.name}_{uuid.uuid4().hex[:8]}"
+        )
+        entries[0].rename(temp_dir)
+        self.target_dir.rmdir()
+        temp_dir.rename(self.target_dir)
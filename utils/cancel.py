@@ -0,0 +1,35 @@
+from exceptions import OperationCancelled
+
+
+class CancelToken:
+    """
+    协作式取消标记：由停止请求设置，下载分块循环与逐文件解压中检查
+    子标记在自身或父标记取消时都视为已取消
+    """
+
+    __slots__ = ("_cancelled", "_parent")
+
+    def __init__(self, parent=None):
+        self._cancelled = False
+        self._parent = parent
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled or (self._parent is not None and self._parent.cancelled)
+
+    def child(self):
+        return CancelToken(self)
+
+    def check(self):
+        """已取消时抛出OperationCancelled"""
+        if self.cancelled:
+            raise OperationCancelled()
+
+
+def check_cancelled(cancel):
+    """cancel为None时不检查"""
+    if cancel is not None:
+        cancel.check()
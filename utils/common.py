@@ -1,8 +1,26 @@
+import functools
 import os
 import shutil
 from pathlib import Path
 
 
+@functools.lru_cache(maxsize=None)
+def get_mac_address(interface="eth0"):
+    """获取网卡MAC地址（优先读取sysfs，避免getmac探测带来的启动开销）"""
+    try:
+        with open(f"/sys/class/net/{interface}/address", "r") as f:
+            mac = f.read().strip().lower()
+        if mac:
+            return mac
+    except OSError:
+        pass
+
+    # sysfs不可用时再回退到getmac（延迟导入）
+    from getmac import get_mac_address as _get_mac_address
+
+    return _get_mac_address(interface=interface)
+
+
 def get_conda_executable_path():
     # 检查CONDA_EXE环境变量
     conda_exe = os.environ.get("CONDA_EXE")
@@ -1,19 +1,55 @@
+import logging
+import os
+import time
 import uuid
-import requests
 import hashlib
+from contextlib import nullcontext
 from pathlib import Path
 
+from requests.exceptions import RequestException
+
+from exceptions import OperationCancelled
+from utils.cancel import check_cancelled
+from utils.integrity import ChunkManifest, verify_chunks
+from utils.metrics import DOWNLOAD_BYTES_TOTAL, DOWNLOAD_THROUGHPUT_MBPS
+from utils.transport import HttpTransport
+
+logger = logging.getLogger(__name__)
+
+
 class SecureFileDownloader:
-    def __init__(self, base_dir="downloads"):
+    def __init__(self, base_dir="downloads", transport=None, engine=None):
+        """
+        :param transport: 共享HTTP传输层，默认使用全局连接池
+        :param engine: 可选的下载引擎（如DownloadEngine），默认使用iter_content逐块下载
+            （本地基准测试中引擎相比iter_content没有吞吐与CPU优势，因此不默认启用）
+        """
         self.base_dir = Path(base_dir)
         self.base_dir.mkdir(parents=True, exist_ok=True)
+        # 复用共享连接池，连续下载时无需重新建立TCP连接
+        self.session = (transport or HttpTransport()).session
+        self.engine = engine
         
-    def download(self, url, save_name=None, expected_md5=None):
-        """安全下载文件"""
+    def download(
+        self, url, save_name=None, expected_md5=None, manifest=None, trace=None, cancel=None
+    ):
+        """
+        安全下载文件
+        :param manifest: 分块哈希清单，提供时并行校验各分块并只重新获取损坏的分块，否则使用MD5校验
+        :param trace: OTA任务追踪，记录download、verify阶段耗时
+        :param cancel: 取消标记，分块之间检查；取消时关闭连接、删除已下载部分，返回status为cancelled
+        """
+        span = trace.span if trace else lambda name: nullcontext()
         try:
             save_path = None  # 初始化 save_path
+            response = None
+            chunk_manifest = ChunkManifest.from_dict(manifest) if manifest else None
+            if chunk_manifest and not chunk_manifest.check_root():
+                raise ValueError("分块校验失败: 分块哈希与根哈希不一致")
+            check_cancelled(cancel)
+
             # 发送请求
-            response = requests.get(
+            response = self.session.get(
               url,
               stream=True,
               headers={"User-Agent": "SecureDownloader/1.0"},
@@ -23,16 +59,47 @@ class SecureFileDownloader:
 
             # 确定保存路径
             save_path = self._get_save_path(response, save_name)
+            content_length = int(response.headers.get("Content-Length") or 0) or None
+
+            # 分块下载并计算哈希（有分块清单时无需整体MD5）
+            md5_hash = None if chunk_manifest else hashlib.md5()
+            hashers = [md5_hash] if md5_hash else []
+            download_start = time.perf_counter()
+            try:
+                with span("download"):
+                    if self.engine and self.engine.supports(response):
+                        stats = self.engine.run(
+                            response, save_path, hashers, content_length, cancel
+                        )
+                    else:
+                        stats = self._stream_simple(response, save_path, hashers, cancel)
+                mb_per_s = stats["bytes"] / 1048576 / max(stats["seconds"], 1e-6)
+                DOWNLOAD_BYTES_TOTAL.inc(stats["bytes"])
+                DOWNLOAD_THROUGHPUT_MBPS.observe(mb_per_s)
+                logger.info(f"下载完成: {stats['bytes'] / 1048576:.1f}MB, {mb_per_s:.1f}MB/s")
+            except RequestException as e:
+                if not chunk_manifest:
+                    raise
+                # 有分块清单时保留已下载部分，缺失的分块稍后按范围重新获取
+                logger.warning(f"下载中断，将按分块补齐: {str(e)}")
 
-            # 分块下载并计算哈希
-            md5_hash = hashlib.md5()
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024*1024):
-                    if chunk:
-                        f.write(chunk)
-                        md5_hash.update(chunk)
+            if chunk_manifest:
+                response.close()
+                with span("verify"):
+                    self._verify_and_repair(
+                        url, save_path, chunk_manifest, chunk_manifest.size, cancel
+                    )
+                return {
+                    "status": "success",
+                    "path": str(save_path),
+                    "size": save_path.stat().st_size,
+                    "root": chunk_manifest.root,
+                }
 
-            # 校验哈希值
+            # 校验哈希值（兼容旧版本的整体MD5）
+            # MD5在下载过程中边接收边计算，verify阶段记录的是累计哈希耗时（与download阶段重叠）
+            if trace:
+                trace.add("verify", download_start, stats["hash_seconds"])
             actual_md5 = md5_hash.hexdigest()
             if expected_md5 and actual_md5 != expected_md5:
                 raise ValueError(f"MD5校验失败: {actual_md5} vs {expected_md5}")
@@ -46,7 +113,88 @@ class SecureFileDownloader:
         except Exception as e:
             if save_path and save_path.exists():
                 save_path.unlink()
+            if isinstance(e, OperationCancelled):
+                logger.info(f"下载已取消: {url}")
+                return {"status": "cancelled", "message": str(e)}
             return {"status": "error", "message": str(e)}
+        finally:
+            # 归还连接到连接池
+            if response is not None:
+                response.close()
+
+    def _stream_simple(self, response, save_path, hashers, cancel=None):
+        """逐块下载（每个分块分配新的bytes对象，写盘与哈希在接收线程中进行）"""
+        start = time.perf_counter()
+        total = 0
+        hash_seconds = 0.0
+        with open(save_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024*1024):
+                check_cancelled(cancel)
+                if chunk:
+                    f.write(chunk)
+                    total += len(chunk)
+                    hash_start = time.perf_counter()
+                    for h in hashers:
+                        h.update(chunk)
+                    hash_seconds += time.perf_counter() - hash_start
+        return {
+            "bytes": total,
+            "seconds": time.perf_counter() - start,
+            "hash_seconds": hash_seconds,
+        }
+
+    def _verify_and_repair(self, url, save_path, manifest, size, cancel=None, max_attempts=3):
+        """并行校验分块，校验失败的分块通过Range请求重新获取"""
+        if save_path.stat().st_size != size:
+            # 对齐到清单大小，缺失部分作为损坏分块重新获取
+            os.truncate(save_path, size)
+        bad_chunks = verify_chunks(save_path, manifest)
+        for attempt in range(1, max_attempts + 1):
+            if not bad_chunks:
+                return
+            check_cancelled(cancel)
+            logger.warning(f"{len(bad_chunks)} 个分块校验失败，第{attempt}次重新获取")
+            self._refetch_chunks(url, save_path, manifest, bad_chunks, size, cancel)
+            bad_chunks = verify_chunks(save_path, manifest, bad_chunks)
+        if bad_chunks:
+            raise ValueError(f"分块校验失败: {len(bad_chunks)} 个分块无法修复")
+
+    def _refetch_chunks(self, url, save_path, manifest, indexes, size, cancel=None):
+        """按连续区间合并损坏分块，使用Range请求重新下载并原位写入"""
+        runs = []
+        for index in sorted(indexes):
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+
+        fd = os.open(save_path, os.O_WRONLY)
+        try:
+            for first, last in runs:
+                start = first * manifest.chunk_size
+                end = min((last + 1) * manifest.chunk_size, size) - 1
+                with self.session.get(
+                    url,
+                    stream=True,
+                    headers={
+                        "User-Agent": "SecureDownloader/1.0",
+                        "Range": f"bytes={start}-{end}",
+                    },
+                    timeout=(3.05, 30),
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise ValueError("服务器不支持Range请求，无法按分块重新获取")
+                    offset = start
+                    for chunk in response.iter_content(chunk_size=1024*1024):
+                        check_cancelled(cancel)
+                        view = memoryview(chunk)
+                        while view:
+                            written = os.pwrite(fd, view, offset)
+                            offset += written
+                            view = view[written:]
+        finally:
+            os.close(fd)
 
     def _get_save_path(self, response, save_name):
         """生成安全的保存路径"""
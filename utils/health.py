@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HealthAggregator:
+    """
+    汇总本机各程序的运行状态（心跳、心跳超时、进程退出），生成整机健康摘要
+    状态变化时发布（两次发布至少间隔min_interval秒），无变化时每max_interval秒发布一次
+    超时或退出超过retention秒的程序不再跟踪，最多跟踪max_programs个程序
+    """
+
+    def __init__(self, publish, heartbeat_timeout=5, min_interval=5, max_interval=60,
+                 retention=600, max_programs=64):
+        self.publish = publish
+        self.heartbeat_timeout = heartbeat_timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.retention = retention
+        self.max_programs = max_programs
+        # 程序名 -> {"lastSeen", "timeouts", "restarts", "exitCode", "updated"}
+        self._programs = {}
+        # 程序名 -> agent启动的进程
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._last_states = None
+        self._last_publish = 0.0
+
+    def _program(self, name):
+        program = self._programs.get(name)
+        if program is None:
+            if len(self._programs) >= self.max_programs:
+                self._prune(time.time(), limit=self.max_programs - 1)
+            program = self._programs[name] = {
+                "lastSeen": None,
+                "timeouts": 0,
+                "restarts": 0,
+                "exitCode": None,
+            }
+        program["updated"] = time.time()
+        return program
+
+    def _prune(self, now, limit=None):
+        """
+        移除超时或退出超过retention秒的程序；仍超过limit时按最后更新时间淘汰最旧的程序
+        （agent启动的进程仍在运行时保留）
+        """
+        for name, program in list(self._programs.items()):
+            if name in self._processes:
+                continue
+            if self._state(name, program, now) in ("alive", "running"):
+                continue
+            if now - program["updated"] > self.retention:
+                del self._programs[name]
+        if limit is not None and len(self._programs) > limit:
+            candidates = sorted(
+                (program["updated"], name)
+                for name, program in self._programs.items()
+                if name not in self._processes
+            )
+            for _, name in candidates[: len(self._programs) - limit]:
+                del self._programs[name]
+
+    def forget(self, name):
+        """不再跟踪该程序（心跳监控放弃该程序时调用）"""
+        with self._lock:
+            self._programs.pop(name, None)
+            self._processes.pop(name, None)
+
+    def program_seen(self, name, timestamp):
+        with self._lock:
+            program = self._program(name)
+            program["lastSeen"] = timestamp
+            program["exitCode"] = None
+
+    def program_timeout(self, name):
+        with self._lock:
+            self._program(name)["timeouts"] += 1
+
+    def process_started(self, name, process):
+        """记录agent启动（或重启）的进程，之后轮询其退出状态"""
+        if not name or process is None:
+            return
+        with self._lock:
+            program = self._program(name)
+            if name in self._processes:
+                program["restarts"] += 1
+            program["exitCode"] = None
+            self._processes[name] = process
+
+    def _poll_processes(self):
+        for name, process in list(self._processes.items()):
+            returncode = process.poll()
+            if returncode is not None:
+                self._program(name)["exitCode"] = returncode
+                del self._processes[name]
+
+    def _state(self, name, program, now):
+        if program["exitCode"] is not None:
+            return "exited"
+        if program["lastSeen"] is not None:
+            if now - program["lastSeen"] <= self.heartbeat_timeout:
+                return "alive"
+            return "timeout"
+        return "running" if name in self._processes else "unknown"
+
+    def summary(self):
+        now = time.time()
+        with self._lock:
+            self._poll_processes()
+            self._prune(now)
+            programs = {}
+            counts = {}
+            for name, program in self._programs.items():
+                state = self._state(name, program, now)
+                counts[state] = counts.get(state, 0) + 1
+                item = {"state": state}
+                if program["lastSeen"] is not None:
+                    item["age"] = round(now - program["lastSeen"], 1)
+                for key in ("timeouts", "restarts"):
+                    if program[key]:
+                        item[key] = program[key]
+                if program["exitCode"] is not None:
+                    item["exitCode"] = program["exitCode"]
+                programs[name] = item
+        healthy = counts.get("alive", 0) + counts.get("running", 0) == len(programs)
+        return {"healthy": healthy, "counts": counts, "programs": programs}
+
+    def check(self):
+        """状态变化或到达最长间隔时发布摘要，返回是否发布"""
+        summary = self.summary()
+        states = {name: item["state"] for name, item in summary["programs"].items()}
+        elapsed = time.monotonic() - self._last_publish
+        changed = states != self._last_states
+        if not (changed and elapsed >= self.min_interval) and elapsed < self.max_interval:
+            return False
+        summary["timestamp"] = time.time()
+        try:
+            self.publish(summary)
+        except Exception as e:
+            logger.error(f"健康摘要发布失败: {str(e)}")
+            return False
+        self._last_states = states
+        self._last_publish = time.monotonic()
+        return True
+
+    def run(self, interval=1):
+        while True:
+            self.check()
+            time.sleep(interval)
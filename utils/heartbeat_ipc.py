@@ -0,0 +1,186 @@
+"""
+本机程序心跳通道：程序通过Unix套接字（SOCK_SEQPACKET，保留消息边界）直接向agent发送心跳，无需经过远程broker
+心跳可携带重启命令，agent通过SO_PEERCRED校验对端用户，只接受root与agent同用户（及配置的用户）的连接；
+套接字放在agent私有目录中，不提供无法鉴权的UDP回退
+
+程序端用法（仅依赖标准库，可直接复制本文件使用）：
+    from utils.heartbeat_ipc import send_heartbeat
+    send_heartbeat("my_program", reload_command="python3 /opt/app/main.py")
+"""
+
+import json
+import logging
+import os
+import selectors
+import socket
+import stat
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 与config.constant中的HEARTBEAT_IPC_SOCKET保持一致
+DEFAULT_SOCKET_PATH = os.environ.get(
+    "IOT_AGENT_HEARTBEAT_SOCKET", "/run/iot_agent/heartbeat.sock"
+)
+
+_MAX_MESSAGE = 65536
+_PEERCRED = struct.Struct("3i")  # pid, uid, gid
+
+
+def _ensure_private_dir(directory):
+    """创建套接字目录（0750），已存在时要求为agent所有的真实目录且其他用户不可写"""
+    os.makedirs(directory, mode=0o750, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise OSError(f"心跳套接字目录不是目录: {directory}")
+    if info.st_uid != os.geteuid():
+        raise OSError(f"心跳套接字目录不属于当前用户: {directory}")
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError(f"心跳套接字目录可被其他用户写入: {directory}")
+
+
+def _peer_uid(conn):
+    _, uid, _ = _PEERCRED.unpack(
+        conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size)
+    )
+    return uid
+
+
+class HeartbeatServer:
+    """接收本机心跳消息，逐条交给handler处理（在后台线程中运行）"""
+
+    def __init__(self, handler, path=DEFAULT_SOCKET_PATH, allowed_uids=()):
+        self.handler = handler
+        self.path = path
+        self.allowed_uids = {0, os.geteuid()} | set(allowed_uids)
+        self.sock = None
+        self._selector = None
+
+    def _bind(self):
+        _ensure_private_dir(os.path.dirname(self.path))
+        try:
+            os.unlink(self.path)  # 清理上次运行残留的套接字文件
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.bind(self.path)
+            os.chmod(self.path, 0o660)
+            sock.listen(16)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def start(self):
+        self.sock = self._bind()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.sock, selectors.EVENT_READ)
+        threading.Thread(target=self._serve, name="heartbeat-ipc", daemon=True).start()
+        logger.info(f"本机心跳通道已启动: {self.path}")
+        return self
+
+    def _accept(self):
+        conn, _ = self.sock.accept()
+        try:
+            uid = _peer_uid(conn)
+        except OSError as e:
+            logger.warning(f"无法获取心跳连接的对端身份: {str(e)}")
+            conn.close()
+            return
+        if uid not in self.allowed_uids:
+            logger.warning(f"拒绝来自用户 {uid} 的心跳连接")
+            conn.close()
+            return
+        self._selector.register(conn, selectors.EVENT_READ)
+
+    def _receive(self, conn):
+        try:
+            data = conn.recv(_MAX_MESSAGE)
+        except OSError:
+            data = b""
+        if not data:
+            self._selector.unregister(conn)
+            conn.close()
+            return
+        try:
+            params = json.loads(data)
+            if isinstance(params, dict):
+                self.handler(params)
+        except Exception as e:
+            logger.warning(f"心跳消息处理失败: {str(e)}")
+
+    def _serve(self):
+        while self.sock is not None:
+            try:
+                events = self._selector.select(timeout=1)
+            except (OSError, ValueError):
+                # 套接字已关闭
+                return
+            for key, _ in events:
+                if key.fileobj is self.sock:
+                    try:
+                        self._accept()
+                    except OSError:
+                        return
+                else:
+                    self._receive(key.fileobj)
+
+    def stop(self):
+        sock, self.sock = self.sock, None
+        if sock:
+            for key in list(self._selector.get_map().values()):
+                key.fileobj.close()
+            self._selector.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class HeartbeatClient:
+    """心跳发送端，保持一个连接，断开后自动重连；发送失败（agent未运行）时静默忽略"""
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH):
+        self.path = path
+        self._sock = None
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def send(self, program, reload_command=None, **fields):
+        payload = dict(fields, program=program, timestamp=time.time(), pid=os.getpid())
+        if reload_command:
+            payload["reload_command"] = reload_command
+        data = json.dumps(payload).encode()
+        # agent重启后原连接失效，重连一次
+        for _ in range(2):
+            try:
+                if self._sock is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                    try:
+                        sock.connect(self.path)
+                    except OSError:
+                        sock.close()
+                        raise
+                    self._sock = sock
+                self._sock.send(data)
+                return True
+            except OSError:
+                self._close()
+        return False
+
+
+_default_client = None
+
+
+def send_heartbeat(program, reload_command=None, **fields):
+    """使用默认地址发送一次心跳"""
+    global _default_client
+    if _default_client is None:
+        _default_client = HeartbeatClient()
+    return _default_client.send(program, reload_command, **fields)
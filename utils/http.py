@@ -1,10 +1,45 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
 import requests
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from requests.structures import CaseInsensitiveDict
+
+from utils.metrics import HTTP_GET_TOTAL
+from utils.transport import HttpTransport
+
+
+def _copy_response(response):
+    """复制已读取完毕的响应（状态、响应头、响应体），每个调用方拿到独立的对象"""
+    copy = requests.Response()
+    copy.status_code = response.status_code
+    copy.headers = CaseInsensitiveDict(response.headers)
+    copy._content = response.content
+    copy._content_consumed = True
+    copy.url = response.url
+    copy.encoding = response.encoding
+    copy.reason = response.reason
+    copy.elapsed = response.elapsed
+    copy.request = response.request
+    copy.history = list(response.history)
+    copy.cookies = response.cookies.copy()
+    return copy
+
+
+class _CacheEntry:
+    __slots__ = ("response", "etag", "stored_at")
+
+    def __init__(self, response, etag, stored_at):
+        self.response = response
+        self.etag = etag
+        self.stored_at = stored_at
+
 
 class HttpTool:
-    def __init__(self, retries=3, backoff_factor=0.3, retry_status_codes=(500, 502, 503, 504), timeout=10, base_url=None):
+    def __init__(self, retries=3, backoff_factor=0.3, retry_status_codes=(500, 502, 503, 504), timeout=10, base_url=None,
+                 cache_ttl=0, stale_ttl=0, cache_max_entries=256):
         """
         HTTP工具类初始化
         :param retries: 最大重试次数
@@ -12,23 +47,32 @@ class HttpTool:
         :param retry_status_codes: 需要重试的状态码列表
         :param timeout: 默认超时时间（秒）
         :param base_url: 默认请求地址
+        :param cache_ttl: GET响应缓存有效期（秒），0表示默认不缓存，可按请求通过cache_ttl开启
+        :param stale_ttl: 缓存过期后仍可返回旧数据并后台重新验证的时间窗口（秒）
+        :param cache_max_entries: 最大缓存条目数，超出时淘汰最久未使用的条目
         """
-        self.session = requests.Session()
+        # 与下载器共用连接池
+        self.session = HttpTransport(retries, backoff_factor, retry_status_codes).session
         self.timeout = timeout
         self.base_url = base_url
-        
-        # 配置重试策略
-        retry = Retry(
-            total=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=list(retry_status_codes),
-            allowed_methods=['GET', 'POST', 'PUT', 'DELETE']  # 需要重试的HTTP方法
-        )
-        
-        # 挂载适配器
-        adapter = HTTPAdapter(max_retries=retry)
-        self.session.mount('http://', adapter)
-        self.session.mount('https://', adapter)
+        self.cache_ttl = cache_ttl
+        self.stale_ttl = stale_ttl
+        self.cache_max_entries = cache_max_entries
+
+        # 响应缓存、后台重新验证中的请求与进行中的相同GET请求（single-flight）
+        self._cache = OrderedDict()
+        self._revalidating = set()
+        self._cache_lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._stats = {
+            "issued": 0,
+            "coalesced": 0,
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+        }
 
     def _request(self, method, url, **kwargs):
         """
@@ -43,15 +87,153 @@ class HttpTool:
             kwargs['timeout'] = self.timeout
 
         try:
-            full_url = self.base_url + url if self.base_url and not url.lower().startswith(("http://", "https://")) else url
+            full_url = self._full_url(url)
             response = self.session.request(method=method, url=full_url, **kwargs)
             response.raise_for_status()  # 如果状态码不是200，抛出HTTPError异常
             return response
         except RequestException as e:
             raise Exception(f"Request failed after multiple retries: {str(e)}")
 
-    def get(self, url, params=None, **kwargs):
-        return self._request('GET', url, params=params, **kwargs)
+    def _full_url(self, url):
+        if self.base_url and not url.lower().startswith(("http://", "https://")):
+            return self.base_url + url
+        return url
+
+    def _request_key(self, url, params, headers):
+        """相同地址、参数、请求头的GET请求视为同一请求"""
+        prepared_url = requests.Request("GET", self._full_url(url), params=params).prepare().url
+        return prepared_url, tuple(sorted((headers or {}).items()))
+
+    def _count(self, name):
+        with self._cache_lock:
+            self._stats[name] += 1
+        HTTP_GET_TOTAL.inc(result=name)
+
+    def _single_flight(self, key, func):
+        """
+        合并进行中的相同请求，只有第一个调用方真正发出请求
+        func返回已读取完毕的响应，每个调用方（包括发起方）得到各自的副本
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            self._count("coalesced")
+            return _copy_response(future.result())
+
+        try:
+            response = func()
+            future.set_result(response)
+            return _copy_response(response)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    def _fetch(self, url, params, kwargs):
+        """发出GET请求并读取完整响应体"""
+        self._count("issued")
+        response = self._request('GET', url, params=params, **kwargs)
+        response.content  # 读取响应体并归还连接，之后只复制不再读取
+        return response
+
+    def _fetch_and_store(self, key, url, params, kwargs):
+        """发起请求并写入缓存，已有缓存时携带If-None-Match重新验证"""
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        response = self._fetch(url, params, dict(kwargs, headers=headers))
+
+        if response.status_code == 304 and entry:
+            self._count("revalidated")
+            with self._cache_lock:
+                entry.stored_at = time.monotonic()
+            return entry.response
+
+        if response.status_code == 200:
+            with self._cache_lock:
+                self._cache[key] = _CacheEntry(
+                    response, response.headers.get("ETag"), time.monotonic()
+                )
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_max_entries:
+                    self._cache.popitem(last=False)
+        return response
+
+    def _revalidate_in_background(self, key, url, params, kwargs):
+        """每个缓存条目同时只有一个后台重新验证线程"""
+        with self._cache_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def worker():
+            try:
+                self._single_flight(key, lambda: self._fetch_and_store(key, url, params, dict(kwargs)))
+            except Exception:
+                pass  # 保留旧缓存，下次请求再重试
+            finally:
+                with self._cache_lock:
+                    self._revalidating.discard(key)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def get(self, url, params=None, cache_ttl=None, stale_ttl=None, **kwargs):
+        """
+        GET请求（合并进行中的相同请求，stream=True时不缓存也不合并）
+        :param cache_ttl: 本次请求的缓存有效期（秒），为None时使用默认配置，0表示不缓存
+        :param stale_ttl: 本次请求允许返回过期缓存的时间窗口（秒）
+        """
+        if kwargs.get("stream"):
+            self._count("issued")
+            return self._request('GET', url, params=params, **kwargs)
+
+        ttl = self.cache_ttl if cache_ttl is None else cache_ttl
+        stale = self.stale_ttl if stale_ttl is None else stale_ttl
+        key = self._request_key(url, params, kwargs.get("headers"))
+
+        if not ttl:
+            return self._single_flight(key, lambda: self._fetch(url, params, kwargs))
+
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry:
+                self._cache.move_to_end(key)
+                age = time.monotonic() - entry.stored_at
+        if entry:
+            if age < ttl:
+                self._count("hits")
+                return _copy_response(entry.response)
+            if age < ttl + stale:
+                self._count("stale_hits")
+                self._revalidate_in_background(key, url, params, kwargs)
+                return _copy_response(entry.response)
+
+        self._count("misses")
+        return self._single_flight(key, lambda: self._fetch_and_store(key, url, params, dict(kwargs)))
+
+    def cache_stats(self):
+        """
+        请求与缓存统计，用于调整TTL
+        issued为实际发出的GET请求数，coalesced为合并到进行中请求的次数
+        """
+        with self._cache_lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._cache)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
 
     def post(self, url, data=None, json=None, **kwargs):
         return self._request('POST', url, data=data, json=json, **kwargs)
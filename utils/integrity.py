@@ -0,0 +1,126 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from config.constant import INTEGRITY_WORKERS
+
+# 支持的分块哈希算法（blake2b使用32字节摘要）
+HASH_ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "blake2b": lambda data=b"": hashlib.blake2b(data, digest_size=32),
+}
+
+_READ_SIZE = 1024 * 1024
+
+
+class ManifestError(ValueError):
+    """分块哈希清单格式错误"""
+
+
+class ChunkManifest:
+    """
+    分块哈希清单（随OTA消息下发）
+    {
+      "algorithm": "sha256/blake2b",
+      "chunkSize": int,
+      "size": int,             # 文件总大小（必填，分块数须为 ceil(size / chunkSize)）
+      "chunks": [hex, ...],    # 每个分块的哈希
+      "root": hex              # 分块哈希构成的Merkle树根
+    }
+    """
+
+    def __init__(self, algorithm, chunk_size, chunks, root, size):
+        if algorithm not in HASH_ALGORITHMS:
+            raise ManifestError(f"不支持的哈希算法: {algorithm}")
+        if not chunk_size or chunk_size <= 0 or not chunks:
+            raise ManifestError("分块清单为空")
+        if size is None or int(size) <= 0:
+            raise ManifestError("分块清单缺少文件大小")
+        self.algorithm = algorithm
+        self.chunk_size = int(chunk_size)
+        self.chunks = [c.lower() for c in chunks]
+        self.root = root.lower()
+        self.size = int(size)
+        # 分块必须恰好覆盖整个文件，否则最后一个分块之后的数据不会被校验
+        expected_chunks = -(-self.size // self.chunk_size)
+        if len(self.chunks) != expected_chunks:
+            raise ManifestError(
+                f"分块数量与文件大小不符: {len(self.chunks)} vs {expected_chunks}"
+            )
+
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            return cls(
+                data["algorithm"],
+                data["chunkSize"],
+                data["chunks"],
+                data["root"],
+                data["size"],
+            )
+        except ManifestError:
+            raise
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ManifestError(f"分块清单格式错误: {str(e)}") from e
+
+    def new_hash(self):
+        return HASH_ALGORITHMS[self.algorithm]()
+
+    def chunk_range(self, index, file_size):
+        """返回分块的 (起始偏移, 长度)"""
+        start = index * self.chunk_size
+        return start, max(0, min(self.chunk_size, file_size - start))
+
+    def check_root(self):
+        """分块哈希与根哈希是否一致（防止清单被篡改或传输损坏）"""
+        return merkle_root(self.chunks, self.algorithm) == self.root
+
+
+def merkle_root(digests, algorithm):
+    """自底向上两两合并计算Merkle根，奇数个节点时最后一个直接晋升"""
+    new_hash = HASH_ALGORITHMS[algorithm]
+    level = [bytes.fromhex(d) for d in digests]
+    while len(level) > 1:
+        next_level = []
+        for i in range(0, len(level) - 1, 2):
+            next_level.append(new_hash(level[i] + level[i + 1]).digest())
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+def hash_chunk(fd, manifest, offset, length):
+    """计算文件中一个分块的哈希（pread不共享文件偏移，可多线程并行）"""
+    h = manifest.new_hash()
+    end = offset + length
+    while offset < end:
+        data = os.pread(fd, min(_READ_SIZE, end - offset), offset)
+        if not data:
+            break
+        h.update(data)
+        offset += len(data)
+    return h.hexdigest()
+
+
+def verify_chunks(path, manifest, indexes=None, workers=INTEGRITY_WORKERS):
+    """
+    多线程校验分块（hashlib在计算大块数据时会释放GIL）
+    返回校验失败的分块序号列表
+    """
+    file_size = os.path.getsize(path)
+    if indexes is None:
+        indexes = range(len(manifest.chunks))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        def check(index):
+            offset, length = manifest.chunk_range(index, manifest.size)
+            if offset + length > file_size:
+                return index, False
+            return index, hash_chunk(fd, manifest, offset, length) == manifest.chunks[index]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(check, indexes))
+    finally:
+        os.close(fd)
+    return [index for index, ok in results if not ok]
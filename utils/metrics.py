@@ -0,0 +1,293 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# 通用耗时分桶（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _header(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+    def summary(self):
+        with self._lock:
+            return {",".join(key) or "total": value for key, value in self._values.items()}
+
+
+class Gauge(_Metric):
+    """瞬时值，可由回调函数在导出时计算"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _collect(self):
+        if self._function:
+            try:
+                return {(): self._function()}
+            except Exception:
+                return {}
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = self._header()
+        for key, value in self._collect().items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+    def summary(self):
+        return {",".join(key) or "value": value for key, value in self._collect().items()}
+
+
+class Histogram(_Metric):
+    """固定分桶直方图（记录一次只需一次二分查找和加锁计数）"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各分桶计数..., +Inf计数, 总和]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            data[index] += 1
+            data[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _snapshot(self):
+        with self._lock:
+            return {key: list(data) for key, data in self._values.items()}
+
+    def render(self):
+        lines = self._header()
+        for key, data in self._snapshot().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), data[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}"
+                )
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {data[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def summary(self):
+        """按标签给出次数、均值和p90（取所在分桶上界）"""
+        result = {}
+        for key, data in self._snapshot().items():
+            counts = data[:-1]
+            total = sum(counts)
+            if not total:
+                continue
+            p90 = None
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                if cumulative >= total * 0.9:
+                    p90 = bound if bound != float("inf") else None
+                    break
+            result[",".join(key) or "all"] = {
+                "count": total,
+                "avg": round(data[-1] / total, 4),
+                "p90_le": p90,
+            }
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Prometheus文本格式（text/plain; version=0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """用于MQTT周期上报的精简摘要（省略无数据的指标）"""
+        with self._lock:
+            metrics = list(self._metrics)
+        return {m.name: s for m in metrics if (s := m.summary())}
+
+
+REGISTRY = Registry()
+
+OTA_PHASE_SECONDS = REGISTRY.histogram(
+    "iot_agent_ota_phase_seconds", "OTA各阶段耗时", ("phase",)
+)
+OTA_JOBS_TOTAL = REGISTRY.counter(
+    "iot_agent_ota_jobs_total", "OTA任务结果计数", ("result",)
+)
+DOWNLOAD_BYTES_TOTAL = REGISTRY.counter(
+    "iot_agent_download_bytes_total", "下载字节数"
+)
+DOWNLOAD_THROUGHPUT_MBPS = REGISTRY.histogram(
+    "iot_agent_download_throughput_mbps",
+    "单次下载吞吐量（MB/s）",
+    buckets=(0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+HTTP_GET_TOTAL = REGISTRY.counter(
+    "iot_agent_http_get_total",
+    "HttpTool GET请求计数（issued实际发出，coalesced合并到进行中的请求，hits/stale_hits/misses/revalidated为缓存结果）",
+    ("result",),
+)
+MQTT_PUBLISH_ENQUEUE_SECONDS = REGISTRY.histogram(
+    "iot_agent_mqtt_publish_enqueue_seconds",
+    "MQTT发布调用耗时（paho只将报文放入发送队列，不含网络发送）",
+    ("broker",),
+)
+MQTT_HANDLE_SECONDS = REGISTRY.histogram(
+    "iot_agent_mqtt_handle_seconds", "MQTT消息处理耗时", ("handler",)
+)
+MQTT_RECONNECTS_TOTAL = REGISTRY.counter(
+    "iot_agent_mqtt_reconnects_total", "MQTT重连次数", ("broker", "result")
+)
+HEARTBEAT_LATENESS_SECONDS = REGISTRY.histogram(
+    "iot_agent_heartbeat_lateness_seconds", "心跳从程序发出到agent处理的延迟"
+)
+HEARTBEAT_TIMEOUTS_TOTAL = REGISTRY.counter(
+    "iot_agent_heartbeat_timeouts_total", "心跳超时次数"
+)
+PROCESS_RESTARTS_TOTAL = REGISTRY.counter(
+    "iot_agent_process_restarts_total", "程序重启次数", ("reason",)
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        data = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """在后台线程中提供 /metrics 接口"""
+    httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    logger.info(f"指标接口已启动: http://{host}:{port}/metrics")
+    return httpd
+
+
+def start_textfile_exporter(path, interval=15):
+    """周期性写入node_exporter textfile collector目录（原子替换）"""
+
+    def loop():
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        while True:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(REGISTRY.render())
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.error(f"指标文件写入失败: {str(e)}")
+            time.sleep(interval)
+
+    threading.Thread(target=loop, daemon=True).start()
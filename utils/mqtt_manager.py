@@ -4,6 +4,8 @@ import threading
 import time
 import paho.mqtt.client as mqtt
 
+from utils.metrics import MQTT_PUBLISH_ENQUEUE_SECONDS, MQTT_RECONNECTS_TOTAL
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("MQTTManager")
@@ -17,6 +19,7 @@ class MQTTManager:
     _lock = threading.Lock()  # 类级线程锁
     _DEFAULT_RETRIES = 3      # 默认重试次数
     _DEFAULT_DELAY = 1        # 默认重试间隔(秒)
+    _SUBSCRIBE_BATCH_SIZE = 100  # 单个SUBSCRIBE报文携带的最大主题数
 
     def __new__(cls, host: str, port: int):
         """线程安全的多例模式实现"""
@@ -40,6 +43,7 @@ class MQTTManager:
         self._connect_attempts = 0
         self._reconnect_enabled = True
         self._last_ping = 0
+        self._connected_event = threading.Event()
 
         # 创建客户端
         self.client = mqtt.Client()
@@ -75,11 +79,13 @@ class MQTTManager:
         """连接成功回调"""
         if rc == 0:
             logger.info(f"Connected to {self.host}:{self.port}")
+            self._connected_event.set()
         else:
             logger.error(f"Connection failed with code {rc}")
 
     def _on_disconnect(self, client, userdata, rc):
         """断开连接回调"""
+        self._connected_event.clear()
         logger.warning(f"Disconnected from {self.host}:{self.port} (code: {rc})")
         if self._reconnect_enabled:
             self._auto_reconnect()
@@ -91,12 +97,18 @@ class MQTTManager:
             try:
                 self.client.reconnect()
                 logger.info("Reconnect successful")
+                MQTT_RECONNECTS_TOTAL.inc(broker=self.host, result="success")
                 return
             except Exception as e:
                 logger.error(f"Reconnect attempt {attempt} failed: {str(e)}")
+                MQTT_RECONNECTS_TOTAL.inc(broker=self.host, result="failed")
                 time.sleep(2 ** attempt)
         logger.error("Auto reconnect failed after maximum attempts")
 
+    def wait_until_connected(self, timeout: float = None) -> bool:
+        """阻塞等待CONNACK，连接建立后立即返回（替代固定sleep轮询）"""
+        return self._connected_event.wait(timeout)
+
     def check_connection(self, timeout: float = 1.0) -> bool:
         """验证连接状态（带主动PING）"""
         # 基础状态检查
@@ -122,7 +134,8 @@ class MQTTManager:
         """带异常处理的发布方法"""
         try:
             if self.check_connection():
-                return self.client.publish(topic, payload, **kwargs)
+                with MQTT_PUBLISH_ENQUEUE_SECONDS.time(broker=self.host):
+                    return self.client.publish(topic, payload, **kwargs)
             else:
                 logger.error("Cannot publish - connection is down")
                 return False
@@ -130,6 +143,20 @@ class MQTTManager:
             logger.error(f"Publish failed: {str(e)}")
             raise
 
+    def subscribe_many(self, topics, qos: int = 0):
+        """批量订阅，多个主题合并到同一个SUBSCRIBE报文中"""
+        topics = list(topics)
+        for i in range(0, len(topics), self._SUBSCRIBE_BATCH_SIZE):
+            batch = topics[i:i + self._SUBSCRIBE_BATCH_SIZE]
+            self.client.subscribe([(topic, qos) for topic in batch])
+        logger.info(f"Subscribed {len(topics)} topics")
+
+    def unsubscribe_many(self, topics):
+        """批量取消订阅"""
+        topics = list(topics)
+        for i in range(0, len(topics), self._SUBSCRIBE_BATCH_SIZE):
+            self.client.unsubscribe(topics[i:i + self._SUBSCRIBE_BATCH_SIZE])
+
     def stop(self):
         """停止客户端"""
         self._reconnect_enabled = False
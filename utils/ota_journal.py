@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 阶段：downloading -> downloaded -> applying -> (started) -> backing_up -> swapping -> swapped -> done
+# backing_up/swapping在对应的目录操作之前写入，恢复时根据目录实际状态判断操作是否已完成
+# 升级终止或失败时在恢复备份前写入rolling_back，恢复时按未完成的升级回滚
+DOWNLOADED = "downloaded"
+DONE = "done"
+
+
+class OTAJournal:
+    """
+    OTA任务预写日志（JSONL，每条记录写入后fsync）
+    每条记录为 {"job", "phase", "ts", ...}，同一任务的记录按顺序合并为任务状态
+    agent重启后据此恢复中断的任务；已完成的任务仅保留本地资源包仍存在的，用于复用下载
+    """
+
+    def __init__(self, path, keep_packages=32, compact_every=256):
+        self.path = Path(path)
+        self.keep_packages = keep_packages
+        self.compact_every = compact_every
+        self._jobs = {}
+        self._appended = 0
+        self._lock = threading.Lock()
+        self._load()
+        self._compact()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 写入过程中断电导致的不完整记录
+                        logger.warning("OTA任务日志存在不完整记录，已忽略")
+                        continue
+                    self._jobs.setdefault(record["job"], {}).update(record)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"OTA任务日志读取失败: {str(e)}")
+
+    def _has_package(self, state):
+        package = state.get("package")
+        return bool(package) and Path(package).is_file()
+
+    def _compact(self):
+        """
+        重写日志：保留进行中的任务，以及资源包仍存在的已下载/已完成任务（最多keep_packages个）
+        调用方持有锁或在初始化时调用
+        """
+        idle = [
+            job
+            for job, state in self._jobs.items()
+            if state.get("phase") in (DOWNLOADED, DONE)
+        ]
+        for job in idle:
+            if not self._has_package(self._jobs[job]):
+                del self._jobs[job]
+        packages = sorted(
+            (state["ts"], job)
+            for job, state in self._jobs.items()
+            if state.get("phase") in (DOWNLOADED, DONE)
+        )
+        for _, job in packages[: max(0, len(packages) - self.keep_packages)]:
+            del self._jobs[job]
+
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for state in self._jobs.values():
+                    f.write(json.dumps(state, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"OTA任务日志整理失败: {str(e)}")
+        self._appended = 0
+
+    def record(self, job, phase, **fields):
+        """追加一条阶段记录，返回合并后的任务状态"""
+        record = dict(fields, job=job, phase=phase, ts=time.time())
+        with self._lock:
+            state = self._jobs.setdefault(job, {})
+            state.update(record)
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logger.error(f"OTA任务日志写入失败: {str(e)}")
+            self._appended += 1
+            if self._appended >= self.compact_every:
+                self._compact()
+            return dict(state)
+
+    def unfinished(self):
+        """未完成的任务（按开始顺序）"""
+        with self._lock:
+            return [dict(state) for state in self._jobs.values() if state.get("phase") != DONE]
+
+    def find_download(self, md5=None, root=None):
+        """
+        查找已校验完成的资源包：只按MD5或分块根哈希匹配，没有哈希时不复用
+        （同一下载地址的内容可能已更新）；文件大小或修改时间与校验时记录的不一致时视为不可用
+        """
+        if not (md5 or root):
+            return None
+        with self._lock:
+            states = [dict(state) for state in self._jobs.values()]
+        for state in reversed(states):
+            if not state.get("package"):
+                continue
+            if not ((md5 and state.get("md5") == md5) or (root and state.get("root") == root)):
+                continue
+            try:
+                stat = os.stat(state["package"])
+            except OSError:
+                continue
+            if stat.st_size == state.get("size") and stat.st_mtime_ns == state.get("mtime"):
+                return state["package"]
+        return None
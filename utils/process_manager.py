@@ -1,45 +1,72 @@
 import logging
+import os
+import signal
 import subprocess
-import psutil
 
 logger = logging.getLogger(__name__)
 
 
-# 终止进程
-def kill_process(entryName):
-    """终止目标进程"""
-    killed = []
+def find_process_pids(entryName):
+    """查找命令行包含目标脚本的进程"""
+    import psutil  # 启动阶段用不到，延迟导入以加快冷启动
+
+    pids = []
     for proc in psutil.process_iter(["pid", "name", "cmdline"]):
         try:
             # 检查进程命令行是否包含目标脚本
             if any(entryName in cmd for cmd in proc.cmdline()):
-                proc.terminate()
-                killed.append(proc.pid)
+                pids.append(proc.pid)
         except (psutil.NoSuchProcess, psutil.AccessDenied):
             continue
-    print(f"终止进程: {killed}")
-    # 等待进程终止，并处理可能的 NoSuchProcess 异常
+    return pids
+
+
+def terminate_pids(pids, timeout=5):
+    """终止指定进程，超时未退出则强制结束"""
+    import psutil
+
     processes_to_wait = []
-    for pid in killed:
+    for pid in pids:
         try:
-            processes_to_wait.append(psutil.Process(pid))
+            proc = psutil.Process(pid)
+            proc.terminate()
+            processes_to_wait.append(proc)
         except psutil.NoSuchProcess:
             # 如果进程已经不存在，则跳过
             continue
-    gone, alive = psutil.wait_procs(processes_to_wait, timeout=5)
+    gone, alive = psutil.wait_procs(processes_to_wait, timeout=timeout)
     if alive:
         for p in alive:
             p.kill()
+
+
+def terminate_process_group(process, timeout=5):
+    """终止find_and_start_app启动的进程及其整个进程组（含conda run的子进程）"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=timeout)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+# 终止进程
+def kill_process(entryName):
+    """终止目标进程"""
+    killed = find_process_pids(entryName)
+    print(f"终止进程: {killed}")
+    terminate_pids(killed)
     return len(killed) > 0
 
 
 def find_and_start_app(target_dir, device_detail):
-    """查找并启动应用程序"""
+    """查找并启动应用程序，返回启动的进程"""
     if device_detail["startCommand"]:
         # 使用自定义启动命令
         command_list = device_detail["startCommand"].split()
         try:
-            subprocess.Popen(
+            process = subprocess.Popen(
                 command_list,
                 # cwd=target_dir,
                 stdout=subprocess.DEVNULL,
@@ -47,6 +74,7 @@ def find_and_start_app(target_dir, device_detail):
                 start_new_session=True,
             )
             print(f"应用程序已启动: {device_detail['startCommand']}")
+            return process
         except Exception as e:
             logger.error(f"应用程序启动失败: {str(e)}")
     else:
@@ -69,7 +97,7 @@ def find_and_start_app(target_dir, device_detail):
                     "python",
                     str(_entry_file),
                 ]
-            subprocess.Popen(
+            process = subprocess.Popen(
                 order,
                 cwd=target_dir,
                 stdout=subprocess.DEVNULL,
@@ -79,6 +107,7 @@ def find_and_start_app(target_dir, device_detail):
             # stdout, stderr = process.communicate()
             print(f"应用程序已启动: {_entry_file}")
             # print(stdout)
+            return process
         except Exception as e:
             logger.error(f"应用程序启动失败: {str(e)}")
             raise f"应用程序启动失败: {str(e)}"
@@ -0,0 +1,217 @@
+import gzip
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _thread_cpu_time(thread_id):
+    """线程累计CPU时间（秒），平台不支持按线程计时时返回None"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+def _collapse(frame, max_depth=64):
+    """折叠调用栈（根在前，分号分隔，flamegraph.pl/speedscope可直接读取）"""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Profiler:
+    """
+    运行中agent的诊断采集：采样式CPU分析、tracemalloc内存差异、线程栈转储
+    同一时间只允许一个采集任务（内存跟踪从baseline持续到diff或超时，期间也算作进行中）；
+    CPU采样根据自身耗时自动放大采样间隔，保证开销不超过上限
+    """
+
+    def __init__(
+        self, max_seconds=60, max_overhead=0.02, min_interval=0.005, tracemalloc_timeout=300
+    ):
+        """
+        :param max_seconds: 单次CPU采样最长时间（秒）
+        :param tracemalloc_timeout: 内存基线记录后未对比时自动停止跟踪的时间（秒）
+        """
+        self.max_seconds = max_seconds
+        self.max_overhead = max_overhead
+        self.min_interval = min_interval
+        self.tracemalloc_timeout = tracemalloc_timeout
+        self._lock = threading.Lock()
+        self._baseline = None
+        self._tracemalloc_timer = None
+
+    def run(self, mode, **options):
+        """执行采集，返回 (报告文本, 采集信息)；已有采集任务时抛出ProfilerBusy"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("已有采集任务正在运行")
+        try:
+            if self._baseline is not None and mode != "memory":
+                # tracemalloc的开销不受采样开销上限约束，不再叠加其他采集
+                raise ProfilerBusy("内存跟踪进行中，请先执行diff")
+            if mode == "cpu":
+                return self.sample_cpu(
+                    float(options.get("duration") or 10),
+                    float(options.get("interval") or 0.01),
+                )
+            if mode == "memory":
+                return self.memory(
+                    options.get("action") or "diff",
+                    int(options.get("top") or 50),
+                    int(options.get("frames") or 10),
+                )
+            if mode == "threads":
+                return self.dump_threads()
+            raise ValueError(f"不支持的采集类型: {mode}")
+        finally:
+            self._lock.release()
+
+    def sample_cpu(self, duration, interval):
+        """
+        按线程CPU时间加权的采样：两次采样之间线程消耗的CPU时间（微秒）计入当前调用栈，
+        阻塞在sleep/锁/IO上的线程不消耗CPU，不会出现在结果中
+        平台不支持按线程计时时退化为按采样次数统计（墙钟时间，info中clock为wall）
+        """
+        duration = min(duration, self.max_seconds)
+        interval = max(interval, self.min_interval)
+        own_id = threading.get_ident()
+        cpu_clock = _thread_cpu_time(own_id) is not None
+        last_cpu = {}
+        stacks = Counter()
+        samples = 0
+        busy = 0.0
+        start = time.perf_counter()
+        deadline = start + duration
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if not cpu_clock:
+                    stacks[_collapse(frame)] += 1
+                    continue
+                cpu = _thread_cpu_time(thread_id)
+                if cpu is None:
+                    continue
+                previous = last_cpu.get(thread_id)
+                last_cpu[thread_id] = cpu
+                if previous is not None and cpu > previous:
+                    stacks[_collapse(frame)] += round((cpu - previous) * 1e6)
+            samples += 1
+            cost = time.perf_counter() - now
+            busy += cost
+            # 单次采样耗时超出开销上限时放大采样间隔
+            interval = max(interval, cost / self.max_overhead)
+            time.sleep(min(interval, max(0.0, deadline - time.perf_counter())))
+        elapsed = time.perf_counter() - start
+        lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+        info = {
+            "clock": "cpu" if cpu_clock else "wall",
+            "unit": "us" if cpu_clock else "samples",
+            "samples": samples,
+            "seconds": round(elapsed, 3),
+            "interval": round(interval, 4),
+            "overhead": round(busy / max(elapsed, 1e-6), 4),
+        }
+        return "\n".join(lines) + "\n", info
+
+    def memory(self, action, top, frames):
+        """
+        baseline：开始跟踪并记录基线快照
+        diff：与基线对比，输出增长最多的分配位置并停止跟踪（tracemalloc本身有明显开销）
+        """
+        import tracemalloc
+
+        if action == "baseline":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._baseline = tracemalloc.take_snapshot()
+            # 忘记取差异时自动停止跟踪
+            self._schedule_tracemalloc_stop()
+            traced, peak = tracemalloc.get_traced_memory()
+            return f"baseline taken, traced={traced} peak={peak}\n", {
+                "action": "baseline",
+                "traced": traced,
+            }
+        if action != "diff":
+            raise ValueError(f"不支持的内存采集操作: {action}")
+        if self._baseline is None or not tracemalloc.is_tracing():
+            raise ValueError("未记录内存基线，请先执行baseline")
+
+        snapshot = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+        stats = snapshot.compare_to(self._baseline, "traceback")
+        self._baseline = None
+        tracemalloc.stop()
+        self._cancel_tracemalloc_stop()
+
+        lines = [f"traced={traced} peak={peak}"]
+        for stat in stats[:top]:
+            lines.append(
+                f"\n{stat.size_diff:+d} B ({stat.count_diff:+d} blocks), total {stat.size} B"
+            )
+            lines.extend(f"    {line}" for line in stat.traceback.format())
+        return "\n".join(lines) + "\n", {
+            "action": "diff",
+            "traced": traced,
+            "peak": peak,
+            "growth": sum(stat.size_diff for stat in stats),
+        }
+
+    def _schedule_tracemalloc_stop(self):
+        self._cancel_tracemalloc_stop()
+
+        def stop():
+            import tracemalloc
+
+            with self._lock:
+                if self._baseline is None:
+                    return
+                logger.warning("内存基线长时间未对比，已停止tracemalloc")
+                self._baseline = None
+                tracemalloc.stop()
+
+        self._tracemalloc_timer = threading.Timer(self.tracemalloc_timeout, stop)
+        self._tracemalloc_timer.daemon = True
+        self._tracemalloc_timer.start()
+
+    def _cancel_tracemalloc_stop(self):
+        if self._tracemalloc_timer:
+            self._tracemalloc_timer.cancel()
+            self._tracemalloc_timer = None
+
+    def dump_threads(self):
+        names = {thread.ident: thread for thread in threading.enumerate()}
+        sections = []
+        for thread_id, frame in sys._current_frames().items():
+            thread = names.get(thread_id)
+            name = thread.name if thread else "unknown"
+            daemon = " daemon" if thread and thread.daemon else ""
+            sections.append(
+                f'Thread "{name}" ({thread_id}){daemon}\n'
+                + "".join(traceback.format_stack(frame))
+            )
+        return "\n".join(sections), {"threads": len(sections)}
+
+
+def compress(report):
+    return gzip.compress(report.encode("utf-8"), compresslevel=6)
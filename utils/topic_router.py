@@ -0,0 +1,90 @@
+import threading
+
+
+class _TopicNode:
+    """主题前缀树节点"""
+
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children = {}
+        self.route = None
+
+
+class TopicRouter:
+    """
+    MQTT主题前缀树路由
+    按主题层级匹配订阅过滤器（支持 + 和 # 通配符），返回对应的处理函数与上下文（如设备标识），
+    匹配耗时只与主题层级数有关，与绑定设备数量无关
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter, handler, context=None):
+        """注册主题过滤器，重复注册时覆盖原有路由"""
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _TopicNode())
+            node.route = (handler, context)
+            self._filters[topic_filter] = node
+
+    def remove(self, topic_filter):
+        """移除主题过滤器，返回是否存在"""
+        with self._lock:
+            if self._filters.pop(topic_filter, None) is None:
+                return False
+            # 记录路径以便清理空节点
+            path = [(None, self._root)]
+            for level in topic_filter.split("/"):
+                path.append((level, path[-1][1].children[level]))
+            path[-1][1].route = None
+            for i in range(len(path) - 1, 0, -1):
+                level, node = path[i]
+                if node.route is not None or node.children:
+                    break
+                del path[i - 1][1].children[level]
+            return True
+
+    def match(self, topic):
+        """返回与主题匹配的全部路由 [(handler, context), ...]"""
+        routes = []
+        nodes = [self._root]
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                multi = children.get("#")
+                if multi is not None and multi.route is not None:
+                    routes.append(multi.route)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                single = children.get("+")
+                if single is not None:
+                    next_nodes.append(single)
+            if not next_nodes:
+                return routes
+            nodes = next_nodes
+        for node in nodes:
+            if node.route is not None:
+                routes.append(node.route)
+            # "a/#" 同样匹配 "a"
+            multi = node.children.get("#")
+            if multi is not None and multi.route is not None:
+                routes.append(multi.route)
+        return routes
+
+    def filters(self):
+        """返回已注册的全部主题过滤器"""
+        with self._lock:
+            return list(self._filters)
+
+    def __contains__(self, topic_filter):
+        return topic_filter in self._filters
+
+    def __len__(self):
+        return len(self._filters)
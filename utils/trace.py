@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+from utils.metrics import OTA_PHASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class OTATrace:
+    """
+    单个OTA任务的耗时追踪
+    各阶段记录为 [名称, 相对任务开始的毫秒数, 耗时毫秒数(, 错误)]，同时计入阶段耗时指标
+    """
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration, error=None):
+        """记录已完成的阶段（start为perf_counter时间）"""
+        span = [name, round((start - self._origin) * 1000), round(duration * 1000)]
+        if error:
+            span.append(error[:80])
+        with self._lock:
+            self.spans.append(span)
+        OTA_PHASE_SECONDS.observe(duration, phase=name)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            self.add(name, start, time.perf_counter() - start, error)
+
+    def compact(self):
+        """附加到MQTT状态消息中的精简格式"""
+        with self._lock:
+            spans = [list(span) for span in self.spans]
+        return {
+            "id": self.trace_id,
+            "start": round(self.started, 3),
+            "total": round((time.perf_counter() - self._origin) * 1000),
+            "spans": spans,
+        }
+
+
+class TraceHistory:
+    """最近的OTA追踪记录（内存中保留固定条数，同时写入本地JSONL文件）"""
+
+    def __init__(self, path, size=20):
+        self.path = Path(path)
+        self._records = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._records.append(json.loads(line))
+        except FileNotFoundError:
+            pass
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"OTA追踪记录读取失败: {str(e)}")
+
+    def record(self, trace, status, device=None):
+        record = dict(trace.compact(), status=status, device=device)
+        with self._lock:
+            self._records.append(record)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for item in self._records:
+                        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.error(f"OTA追踪记录写入失败: {str(e)}")
+        return record
+
+    def recent(self, count=None):
+        """最近count条记录（count来自远程请求：无效或不大于0时返回全部，超过保留条数时同样返回全部）"""
+        try:
+            count = int(count)
+        except (TypeError, ValueError, OverflowError):
+            count = 0
+        with self._lock:
+            records = list(self._records)
+        return records[-count:] if count > 0 else records
@@ -0,0 +1,153 @@
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+
+from config.constant import DNS_CACHE_MAX_ENTRIES, DNS_CACHE_TTL, HTTP_POOL_MAXSIZE
+
+logger = logging.getLogger(__name__)
+
+class DNSCache:
+    """
+    带TTL与条目上限的DNS解析缓存（解析失败不缓存，超出上限时淘汰最久未使用的条目）
+    只挂在HttpTransport的连接池上使用，不替换进程全局的socket.getaddrinfo
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL, max_entries=DNS_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """返回host的地址列表（保持getaddrinfo顺序并去重），解析失败时抛出socket.gaierror"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached and cached[0] > now:
+                self._entries.move_to_end(key)
+                return cached[1]
+        infos = socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        with self._lock:
+            self._entries[key] = (now + self.ttl, addresses)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return addresses
+
+
+class _CachedDNSConnectionMixin:
+    """建立连接时使用连接池所属的DNSCache解析主机名；SNI与证书校验仍使用原主机名"""
+
+    dns_cache = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = self.dns_cache.resolve(host, self.port)
+        except OSError:
+            # 解析失败交给urllib3按原流程解析并转换异常
+            return super()._new_conn()
+        try:
+            for index, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError):
+                    if index == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+
+
+def _dns_cached_pool_classes(dns_cache):
+    """为每个DNSCache生成独立的连接与连接池类，避免修改urllib3的全局类"""
+    http_connection = type(
+        "CachedDNSHTTPConnection", (_CachedDNSConnectionMixin, HTTPConnection), {"dns_cache": dns_cache}
+    )
+    https_connection = type(
+        "CachedDNSHTTPSConnection", (_CachedDNSConnectionMixin, HTTPSConnection), {"dns_cache": dns_cache}
+    )
+    return {
+        "http": type("CachedDNSHTTPConnectionPool", (HTTPConnectionPool,), {"ConnectionCls": http_connection}),
+        "https": type("CachedDNSHTTPSConnectionPool", (HTTPSConnectionPool,), {"ConnectionCls": https_connection}),
+    }
+
+
+class DNSCachingAdapter(HTTPAdapter):
+    """连接池使用DNSCache解析主机名的HTTPAdapter"""
+
+    def __init__(self, dns_cache, **kwargs):
+        # HTTPAdapter.__init__中会调用init_poolmanager，需先设置dns_cache
+        self.dns_cache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _dns_cached_pool_classes(self.dns_cache)
+
+
+class HttpTransport:
+    """
+    共享HTTP传输层
+    接口调用与安装包下载共用同一个连接池（keep-alive），统一重试与退避策略
+    """
+
+    _instances = {}
+    _lock = threading.Lock()  # 类级线程锁
+
+    def __new__(cls, retries=3, backoff_factor=0.3, retry_status_codes=(500, 502, 503, 504),
+                pool_maxsize=HTTP_POOL_MAXSIZE):
+        """相同配置共享同一个实例"""
+        instance_key = (retries, backoff_factor, tuple(retry_status_codes), pool_maxsize)
+
+        with cls._lock:
+            if instance_key not in cls._instances:
+                new_instance = super().__new__(cls)
+                new_instance._initialized = False
+                cls._instances[instance_key] = new_instance
+
+        return cls._instances[instance_key]
+
+    def __init__(self, retries=3, backoff_factor=0.3, retry_status_codes=(500, 502, 503, 504),
+                 pool_maxsize=HTTP_POOL_MAXSIZE):
+        """
+        :param retries: 最大重试次数
+        :param backoff_factor: 重试等待时间因子
+        :param retry_status_codes: 需要重试的状态码列表
+        :param pool_maxsize: 每个主机保持的最大连接数
+        """
+        if self._initialized:
+            return
+
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=list(retry_status_codes),
+            allowed_methods=['GET', 'POST', 'PUT', 'DELETE'],  # 需要重试的HTTP方法
+            raise_on_status=False,  # 重试耗尽后返回最后的响应，由调用方raise_for_status
+        )
+        adapter_options = dict(
+            max_retries=retry,
+            pool_connections=pool_maxsize,
+            pool_maxsize=pool_maxsize,
+        )
+        if DNS_CACHE_TTL > 0:
+            adapter = DNSCachingAdapter(DNSCache(), **adapter_options)
+        else:
+            adapter = HTTPAdapter(**adapter_options)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._initialized = True